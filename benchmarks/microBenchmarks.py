@@ -0,0 +1,335 @@
+'''
+   Copyright (c) 2019 Jack Farley
+   This file is part of iTunes_Backup_Reader
+   Usage or distribution of this software/code is subject to the
+   terms of the GNU GENERAL PUBLIC LICENSE.
+   microBenchmarks.py
+   ------------
+
+   Repeatable microbenchmarks of the parsing hot paths over the fixed corpus in benchmarks/corpus.
+   Each benchmark reports ops/s (best of several timed rounds) and the memory one call allocates:
+   the peak bytes traced by tracemalloc during a call and the blocks still allocated after it.
+   Results can be saved as a baseline, and a later run compared against it fails (exit code 1)
+   when any benchmark's ops/s dropped by more than the threshold.
+
+   python benchmarks/microBenchmarks.py --save-baseline baseline.json
+   python benchmarks/microBenchmarks.py --baseline baseline.json [--threshold 20]
+
+   The corpus is generated from a fixed seed by --build-corpus, --capture replaces its MBFile blobs
+   and Manifest.mbdb with ones captured from a real unencrypted backup.
+'''
+
+import argparse
+import datetime
+import fnmatch
+import gc
+import hashlib
+import io
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import biplist
+from Crypto.Cipher import AES
+
+import syntheticBackup
+from runBenchmarks import gitRevision
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from helpers import ccl_bplist, deserializer, manifestDbParser, mbdbReader, structs  # noqa: E402
+from helpers.iphone_backup_decrypt import google_iphone_dataprotection  # noqa: E402
+
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+
+'''MBFile blobs in the corpus are mbfile_<n>.bplist'''
+MBFILE_PATTERN = "mbfile_*.bplist"
+MBDB_NAME = "Manifest.mbdb"
+SINF_NAME = "ApplicationSINF.bin"
+FRPD_NAME = "iTunesPrefs.frpd"
+'''A 32 byte key encryption key followed by 40 byte wrapped keys'''
+WRAPPED_KEYS_NAME = "wrapped_keys.bin"
+
+CORPUS_SEED = 0
+CORPUS_MBFILES = 32
+CORPUS_MBDB_RECORDS = 500
+CORPUS_WRAPPED_KEYS = 64
+
+'''Seconds each timed round should take, and how many rounds the best is taken of'''
+ROUND_TIME = 0.2
+ROUNDS = 5
+
+DEFAULT_THRESHOLD = 20.0
+
+
+def buildCorpus(corpusDir, seed=CORPUS_SEED):
+    '''Writes the synthetic corpus, the same seed always gives the same bytes'''
+    r = random.Random(seed)
+    os.makedirs(corpusDir, exist_ok=True)
+    for i in range(CORPUS_MBFILES):
+        '''Mostly plain files, some directories, with extended attributes and with encryption keys'''
+        relativePath = "Media/DCIM/100APPLE/IMG_%04d.JPG" % i
+        encryptionKey = extendedAttributes = None
+        mode = 0o100644
+        if i % 8 == 1:
+            relativePath, mode = "Media/DCIM/1%02dAPPLE" % i, 0o40755
+        if i % 4 == 2:
+            extendedAttributes = biplist.writePlistToString({"com.apple.assetsd.UUID": str(i)})
+        if i % 2 == 0:
+            encryptionKey = b"\x03\x00\x00\x00" + syntheticBackup.randomBytes(r, 40)
+        with open(os.path.join(corpusDir, "mbfile_%02d.bplist" % i), "wb") as f:
+            f.write(syntheticBackup.mbFile(relativePath, r.randint(0, 1 << 24), mode, r.choice((1, 2, 3, 4)),
+                                           1000 + i, 1600000000 + i, encryptionKey, extendedAttributes))
+
+    scratch = tempfile.mkdtemp()
+    try:
+        syntheticBackup.generateMbdb(scratch, CORPUS_MBDB_RECORDS, r, 64, 256)
+        shutil.copyfile(os.path.join(scratch, MBDB_NAME), os.path.join(corpusDir, MBDB_NAME))
+    finally:
+        shutil.rmtree(scratch)
+
+    with open(os.path.join(corpusDir, SINF_NAME), "wb") as f:
+        f.write(syntheticBackup.sinfBlob("Bench Mark"))
+    with open(os.path.join(corpusDir, FRPD_NAME), "wb") as f:
+        f.write(syntheticBackup.frpdBlob("bench", "BENCH-PC"))
+
+    kek = syntheticBackup.randomBytes(r, 32)
+    with open(os.path.join(corpusDir, WRAPPED_KEYS_NAME), "wb") as f:
+        f.write(kek)
+        for _ in range(CORPUS_WRAPPED_KEYS):
+            f.write(syntheticBackup.aesWrap(kek, syntheticBackup.randomBytes(r, 32)))
+
+
+def captureCorpus(backupDir, corpusDir, count=CORPUS_MBFILES):
+    '''Replaces the corpus MBFile blobs, spread evenly over Manifest.db, and Manifest.mbdb with a real backup's'''
+    os.makedirs(corpusDir, exist_ok=True)
+    manifestDb = os.path.join(backupDir, "Manifest.db")
+    if os.path.isfile(manifestDb):
+        conn = sqlite3.connect("file:" + manifestDb + "?mode=ro", uri=True)
+        try:
+            total = conn.execute("SELECT COUNT(*) FROM Files").fetchone()[0]
+            step = max(1, total // count)
+            blobs = [row[0] for row in conn.execute("SELECT file FROM Files WHERE rowid % ? = 0 LIMIT ?",
+                                                    (step, count))]
+        finally:
+            conn.close()
+        for name in fnmatch.filter(os.listdir(corpusDir), MBFILE_PATTERN):
+            os.remove(os.path.join(corpusDir, name))
+        for i, blob in enumerate(blobs):
+            with open(os.path.join(corpusDir, "mbfile_%02d.bplist" % i), "wb") as f:
+                f.write(blob)
+        print("Captured " + str(len(blobs)) + " MBFile blobs from " + manifestDb)
+    manifestMbdb = os.path.join(backupDir, MBDB_NAME)
+    if os.path.isfile(manifestMbdb):
+        shutil.copyfile(manifestMbdb, os.path.join(corpusDir, MBDB_NAME))
+        print("Captured " + manifestMbdb)
+
+
+def _read(corpusDir, name):
+    with open(os.path.join(corpusDir, name), "rb") as f:
+        return f.read()
+
+
+def loadCorpus(corpusDir):
+    names = sorted(fnmatch.filter(os.listdir(corpusDir), MBFILE_PATTERN))
+    keys = _read(corpusDir, WRAPPED_KEYS_NAME)
+    corpus = {"mbfiles": [_read(corpusDir, name) for name in names],
+              "mbdb": _read(corpusDir, MBDB_NAME),
+              "sinf": _read(corpusDir, SINF_NAME),
+              "frpd": _read(corpusDir, FRPD_NAME),
+              "kek": keys[:32],
+              "wrapped": [keys[i:i + 40] for i in range(32, len(keys), 40)]}
+    digest = hashlib.sha256()
+    for name in names + [MBDB_NAME, SINF_NAME, FRPD_NAME, WRAPPED_KEYS_NAME]:
+        digest.update(_read(corpusDir, name))
+    corpus["sha256"] = digest.hexdigest()
+    return corpus
+
+
+def _cycle(items):
+    '''Next item of a list on every call, so a benchmark doesn't keep hitting one cached input'''
+    return itertools.cycle(items).__next__
+
+
+def benchmarks(corpus):
+    '''(name, function of no arguments) of every benchmark, one call is one op'''
+    logger = logging.getLogger("microbenchmarks")
+    logger.setLevel(logging.CRITICAL)
+    nextBlob = _cycle(corpus["mbfiles"])
+    nextWrapped = _cycle(corpus["wrapped"])
+    nextTime = _cycle([0, 1600000000, 1600000000.5, "1600000000", None])
+    mbdb = corpus["mbdb"]
+    kek = corpus["kek"]
+    cipher = AES.new(kek, AES.MODE_ECB)
+    records = sum(1 for _ in mbdbReader.iterRecords(mbdb))
+
+    return [
+        ("ccl_bplist.load", lambda: ccl_bplist.load(io.BytesIO(nextBlob()))),
+        ("deserializer.process_nsa_plist", lambda: deserializer.process_nsa_plist("", io.BytesIO(nextBlob()))),
+        ("manifestDbParser.getFileInfo", lambda: manifestDbParser.getFileInfo(nextBlob())),
+        ("manifestDbParser.ReadUnixTime", lambda: manifestDbParser.ReadUnixTime(nextTime())),
+        ("structs.MBDB_HEADER.parse[" + str(records) + " records]", lambda: structs.MBDB_HEADER.parse(mbdb)),
+        ("mbdbReader.iterRecords[" + str(records) + " records]",
+         lambda: sum(1 for _ in mbdbReader.iterRecords(mbdb))),
+        ("structs.sinfHelper", lambda: structs.sinfHelper(corpus["sinf"], logger)),
+        ("structs.frpdHelper", lambda: structs.frpdHelper(corpus["frpd"], logger)),
+        ("google_iphone_dataprotection._AESUnwrap",
+         lambda: google_iphone_dataprotection._AESUnwrap(kek, nextWrapped())),
+        ("google_iphone_dataprotection._AESUnwrapBatch[" + str(len(corpus["wrapped"])) + " keys]",
+         lambda: google_iphone_dataprotection._AESUnwrapBatch(cipher, corpus["wrapped"])),
+    ]
+
+
+def measureSpeed(fn, roundTime=ROUND_TIME, rounds=ROUNDS):
+    '''Best ops/s over rounds, each round calling fn enough times to take about roundTime'''
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter() - started
+        if elapsed >= roundTime / 10:
+            break
+        loops *= 10
+    loops = max(1, int(loops * roundTime / elapsed))
+
+    best = None
+    gcEnabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(rounds):
+            started = time.perf_counter()
+            for _ in range(loops):
+                fn()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        if gcEnabled:
+            gc.enable()
+    return loops / best
+
+
+def measureAllocations(fn, calls=100):
+    '''(peak bytes allocated during one call, blocks still allocated per call) averaged over calls'''
+    fn()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        peaks = 0
+        before = tracemalloc.take_snapshot()
+        for _ in range(calls):
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            fn()
+            peaks += tracemalloc.get_traced_memory()[1] - current
+        gc.collect()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    '''The snapshots themselves and this loop are not the benchmark's allocations'''
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+    retained = sum(stat.count_diff for stat in after.filter_traces(ignore).compare_to(before.filter_traces(ignore),
+                                                                                      "filename"))
+    return int(peaks / calls), round(retained / calls, 2)
+
+
+def runBenchmarks(corpus, selected=None, roundTime=ROUND_TIME, rounds=ROUNDS):
+    results = []
+    for name, fn in benchmarks(corpus):
+        if selected and not any(fnmatch.fnmatch(name, pattern) for pattern in selected):
+            continue
+        opsPerSecond = measureSpeed(fn, roundTime, rounds)
+        peakBytes, retainedBlocks = measureAllocations(fn)
+        results.append({"name": name, "ops_per_s": round(opsPerSecond, 1), "peak_alloc_bytes": peakBytes,
+                        "retained_blocks": retainedBlocks})
+        print("%-62s %14.1f ops/s %10d B/call %8.2f blocks/call" % (name, opsPerSecond, peakBytes, retainedBlocks),
+              flush=True)
+    return results
+
+
+def compareBaseline(results, corpus, baselinePath, threshold):
+    '''Prints the change of every benchmark in the baseline, returns the names that slowed down past threshold %'''
+    with open(baselinePath) as f:
+        baseline = json.load(f)
+    previous = {r["name"]: r for r in baseline.get("results", [])}
+    regressions = []
+    print("\nCompared with " + baselinePath + " (" + str(baseline.get("revision")) + ")")
+    if baseline.get("corpus") != corpus:
+        print("Warning: the baseline was measured on a different corpus")
+    for result in results:
+        old = previous.get(result["name"])
+        if old is None:
+            continue
+        change = (result["ops_per_s"] / old["ops_per_s"] - 1) * 100
+        regressed = change < -threshold
+        if regressed:
+            regressions.append(result["name"])
+        print("%-62s %+8.1f%% ops/s  %+d B/call%s" % (result["name"], change,
+                                                     result["peak_alloc_bytes"] - old["peak_alloc_bytes"],
+                                                     "  REGRESSION" if regressed else ""))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of iTunes_Backup_Reader's parsing hot paths")
+    parser.add_argument("--corpus", help="Corpus folder. Default is benchmarks/corpus", default=CORPUS_DIR,
+                        dest='corpus')
+    parser.add_argument("--build-corpus", help="Regenerate the synthetic corpus and exit", action="store_true",
+                        dest='build_corpus')
+    parser.add_argument("--capture", help="Capture MBFile blobs and Manifest.mbdb from this unencrypted backup into "
+                        "the corpus and exit", default=None, dest='capture', metavar='BACKUP')
+    parser.add_argument("--only", help="Only run benchmarks whose name matches this glob, can be given more than "
+                        "once", action="append", default=None, dest='only')
+    parser.add_argument("-o", "--output", help="JSON file the results are written to", default=None, dest='output')
+    parser.add_argument("--save-baseline", help="Also write the results to this baseline file", default=None,
+                        dest='save_baseline')
+    parser.add_argument("--baseline", help="Baseline results to compare against", default=None, dest='baseline')
+    parser.add_argument("--threshold", help="Fail when ops/s drops by more than this percentage against the "
+                        "baseline. Default is " + str(DEFAULT_THRESHOLD), default=DEFAULT_THRESHOLD, type=float,
+                        dest='threshold')
+    parser.add_argument("--round-time", help="Seconds per timed round. Default is " + str(ROUND_TIME),
+                        default=ROUND_TIME, type=float, dest='round_time')
+    parser.add_argument("--rounds", help="Timed rounds, the best is kept. Default is " + str(ROUNDS),
+                        default=ROUNDS, type=int, dest='rounds')
+    args = parser.parse_args()
+
+    if args.build_corpus:
+        buildCorpus(args.corpus)
+        print("Built the corpus in " + args.corpus)
+        return
+    if args.capture:
+        captureCorpus(args.capture, args.corpus)
+        return
+
+    corpus = loadCorpus(args.corpus)
+    print("Corpus " + args.corpus + " (" + corpus["sha256"][:16] + "), Python " + platform.python_version())
+    results = runBenchmarks(corpus, args.only, args.round_time, args.rounds)
+    report = {"revision": gitRevision(), "started": datetime.datetime.now().isoformat(timespec="seconds"),
+              "python": platform.python_version(), "platform": platform.platform(), "corpus": corpus["sha256"],
+              "results": results}
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2)
+
+    if args.baseline:
+        regressions = compareBaseline(results, corpus["sha256"], args.baseline, args.threshold)
+        if regressions:
+            print(str(len(regressions)) + " benchmarks slowed down by more than " + str(args.threshold) + "%: "
+                  + ", ".join(regressions))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
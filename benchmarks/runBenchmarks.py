@@ -0,0 +1,264 @@
+'''
+   Copyright (c) 2019 Jack Farley
+   This file is part of iTunes_Backup_Reader
+   Usage or distribution of this software/code is subject to the
+   terms of the GNU GENERAL PUBLIC LICENSE.
+   runBenchmarks.py
+   ------------
+
+   End to end benchmark of iTunes_Backup_Reader.py over synthetic backups. Every combination of
+   backup kind, size and mode runs in a fresh process, and files/s, MB/s and peak RSS of that
+   process and its worker processes are reported and saved as JSON, so releases can be compared with --compare.
+   Generated backups are kept in the work folder and reused by later runs with the same settings.
+
+   python benchmarks/runBenchmarks.py --sizes 10000,100000 -o results.json [--compare baseline.json]
+'''
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+
+from syntheticBackup import generateBackup
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from helpers.runMetrics import METRICS_NAME  # noqa: E402
+
+
+READER = os.path.join(REPO_DIR, "iTunes_Backup_Reader.py")
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+
+'''Backup kinds, (generator kind, encrypted)'''
+KINDS = {
+    "manifestdb": ("manifestdb", False),
+    "encrypted": ("manifestdb", True),
+    "mbdb": ("mbdb", False),
+}
+
+'''Modes, (reader arguments, True if the mode reads every blob so MB/s means something)'''
+MODES = {
+    "plists": ([], False),
+    "metadata-only": (["--metadata-only"], False),
+    "recreate": (["-r"], True),
+    "hash": (["-r", "--hash"], True),
+    "dedup": (["-r", "--dedup"], True),
+}
+
+
+def backupFor(workDir, kind, files, meanSize, seed):
+    '''Path and summary of the synthetic backup for kind and files, generated the first time it is needed'''
+    generatorKind, encrypted = KINDS[kind]
+    backupDir = os.path.join(workDir, "%s_%d_%d_%d" % (kind, files, meanSize, seed))
+    summaryPath = backupDir + ".json"
+    if os.path.isfile(summaryPath):
+        with open(summaryPath) as f:
+            return backupDir, json.load(f)
+
+    if os.path.isdir(backupDir):
+        '''Left behind by an interrupted generation'''
+        shutil.rmtree(backupDir)
+    print("Generating " + kind + " backup with " + str(files) + " files in " + backupDir, flush=True)
+    started = time.perf_counter()
+    summary = generateBackup(backupDir, files, generatorKind, encrypted, seed=seed, meanSize=meanSize)
+    print("  generated in %.1f s" % (time.perf_counter() - started), flush=True)
+    return backupDir, summary
+
+
+def _peakRssMb(rusage):
+    '''ru_maxrss is in kilobytes on Linux and in bytes on macOS'''
+    scale = 1 if sys.platform == "darwin" else 1024
+    return round(rusage.ru_maxrss * scale / (1024 * 1024), 1)
+
+
+'''How often the reader's process tree is sampled, in seconds'''
+SAMPLE_INTERVAL = 0.05
+
+'''Where /proc is missing only the reader's own peak is known, its worker processes are not counted'''
+TREE_RSS = os.path.isdir("/proc/self")
+
+
+def _descendants(pid):
+    '''The pid and every process below it, from the parent pid in each /proc/<pid>/stat'''
+    children = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open("/proc/" + name + "/stat", "rb") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        '''The command name in brackets may hold spaces, the parent pid is the second field after it'''
+        children.setdefault(int(stat[stat.rindex(b")") + 2:].split()[1]), []).append(int(name))
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, ()))
+    return tree
+
+
+def _memoryKb(pid):
+    '''Proportional set size of the process, so pages forked workers share with the reader are counted once.
+       Falls back to the resident set size on kernels without smaps_rollup'''
+    for path, field in (("/proc/%d/smaps_rollup", b"Pss:"), ("/proc/%d/status", b"VmRSS:")):
+        try:
+            with open(path % pid, "rb") as f:
+                for line in f:
+                    if line.startswith(field):
+                        return int(line.split()[1])
+        except (OSError, ValueError):
+            continue
+    return 0
+
+
+def _treeRssMb(pid):
+    return round(sum(_memoryKb(member) for member in _descendants(pid)) / 1024, 1)
+
+
+def runReader(backupDir, outputDir, args, password, logPath):
+    '''Runs the reader in its own process. Returns (seconds, peak RSS in MiB or None, return code).
+       With /proc the peak is that of the reader and its worker processes together, sampled every
+       SAMPLE_INTERVAL seconds, and never below the reader's own peak from wait4'''
+    command = [sys.executable, READER, "-i", backupDir, "-o", outputDir, "-t", "txt"] + args
+    if password is not None:
+        command += ["-p", password]
+    with open(logPath, "ab") as log:
+        started = time.perf_counter()
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+        if hasattr(os, "wait4"):
+            '''wait4 gives the rusage of this child alone, not the maximum over every child so far'''
+            treePeak = 0
+            while True:
+                if TREE_RSS:
+                    treePeak = max(treePeak, _treeRssMb(process.pid))
+                pid, status, rusage = os.wait4(process.pid, os.WNOHANG if TREE_RSS else 0)
+                if pid:
+                    break
+                time.sleep(SAMPLE_INTERVAL)
+            seconds = time.perf_counter() - started
+            process.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, "waitstatus_to_exitcode") else status
+            return seconds, max(treePeak, _peakRssMb(rusage)), process.returncode
+        process.wait()
+        return time.perf_counter() - started, None, process.returncode
+
+
+def runBenchmark(workDir, kind, files, mode, meanSize, seed, extraArgs, keep):
+    backupDir, summary = backupFor(workDir, kind, files, meanSize, seed)
+    modeArgs, readsBlobs = MODES[mode]
+    outputDir = os.path.join(workDir, "out_%s_%d_%s" % (kind, files, mode))
+    if os.path.isdir(outputDir):
+        shutil.rmtree(outputDir)
+    os.makedirs(outputDir)
+
+    seconds, peakRss, returnCode = runReader(backupDir, outputDir, modeArgs + extraArgs, summary.get("password"),
+                                             os.path.join(workDir, "benchmark.log"))
+    stages = None
+    metricsPath = os.path.join(outputDir, METRICS_NAME)
+    if os.path.isfile(metricsPath):
+        with open(metricsPath) as f:
+            stages = {name: stage["seconds"] for name, stage in json.load(f)["stages"].items() if stage["calls"]}
+    if not keep:
+        shutil.rmtree(outputDir, ignore_errors=True)
+
+    result = {"kind": kind, "files": files, "mode": mode, "bytes": summary["bytes"] if readsBlobs else 0,
+              "seconds": round(seconds, 3), "files_per_s": round(files / seconds, 1) if seconds else None,
+              "mb_per_s": round(summary["bytes"] / seconds / 1e6, 2) if readsBlobs and seconds else None,
+              "peak_rss_mb": peakRss, "returncode": returnCode, "stage_seconds": stages}
+    print("%-10s %8d %-14s %9.2f s %11s files/s %9s MB/s %9s MiB RSS%s" % (
+        kind, files, mode, seconds, result["files_per_s"], result["mb_per_s"], peakRss,
+        "" if returnCode == 0 else "  (exit code " + str(returnCode) + ")"), flush=True)
+    return result
+
+
+def gitRevision():
+    try:
+        return subprocess.check_output(["git", "-C", REPO_DIR, "describe", "--always", "--dirty"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compareResults(results, baselinePath):
+    '''Prints the files/s change of every result also in the baseline'''
+    with open(baselinePath) as f:
+        baseline = json.load(f)
+    previous = {(r["kind"], r["files"], r["mode"]): r for r in baseline.get("results", [])}
+    print("\nCompared with " + baselinePath + " (" + str(baseline.get("revision")) + ")")
+    for result in results:
+        old = previous.get((result["kind"], result["files"], result["mode"]))
+        if old is None or not old.get("files_per_s") or not result.get("files_per_s"):
+            continue
+        change = (result["files_per_s"] / old["files_per_s"] - 1) * 100
+        print("%-10s %8d %-14s %11s -> %11s files/s %+7.1f%%  RSS %s -> %s MiB" % (
+            result["kind"], result["files"], result["mode"], old["files_per_s"], result["files_per_s"], change,
+            old.get("peak_rss_mb"), result["peak_rss_mb"]))
+
+
+def _csv(value, allowed=None):
+    items = [item.strip() for item in value.split(",") if item.strip()]
+    if allowed is not None:
+        unknown = [item for item in items if item not in allowed]
+        if unknown:
+            raise argparse.ArgumentTypeError("unknown: " + ", ".join(unknown) + ", choose from "
+                                             + ", ".join(allowed))
+    return items
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end benchmarks of iTunes_Backup_Reader over synthetic "
+                                                 "backups")
+    parser.add_argument("--sizes", help="Comma separated file counts. Default is 10000,100000,1000000",
+                        default=DEFAULT_SIZES, type=lambda v: [int(n) for n in _csv(v)], dest='sizes')
+    parser.add_argument("--kinds", help="Comma separated backup kinds out of " + ", ".join(KINDS)
+                        + ". Default is all", default=list(KINDS), type=lambda v: _csv(v, KINDS), dest='kinds')
+    parser.add_argument("--modes", help="Comma separated modes out of " + ", ".join(MODES) + ". Default is all",
+                        default=list(MODES), type=lambda v: _csv(v, MODES), dest='modes')
+    parser.add_argument("--work-dir", help="Folder for generated backups and outputs. Default is "
+                        "benchmark_work in the current folder", default="benchmark_work", dest='work_dir')
+    parser.add_argument("-o", "--output", help="JSON file the results are written to. Default is "
+                        "benchmark_results.json", default="benchmark_results.json", dest='output')
+    parser.add_argument("--compare", help="Earlier results JSON to compare against", default=None, dest='compare')
+    parser.add_argument("--mean-size", help="Typical file size of generated backups in bytes. Default is 16384",
+                        default=16384, type=int, dest='mean_size')
+    parser.add_argument("--seed", help="Random seed of generated backups. Default is 0", default=0, type=int,
+                        dest='seed')
+    parser.add_argument("--workers", help="Passed to the reader as --workers", default=None, type=int,
+                        dest='workers')
+    parser.add_argument("--keep", help="Keep each run's output folder", action="store_true", dest='keep')
+    args = parser.parse_args()
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    extraArgs = ["--workers", str(args.workers)] if args.workers else []
+
+    report = {"revision": gitRevision(), "started": datetime.datetime.now().isoformat(timespec="seconds"),
+              "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+              "mean_size": args.mean_size, "seed": args.seed, "workers": args.workers,
+              "peak_rss_of": "reader and worker processes" if TREE_RSS else "reader process only", "results": []}
+    if not TREE_RSS:
+        print("No /proc here, peak RSS is that of the reader process only, its worker processes are not counted")
+    for kind in args.kinds:
+        for files in args.sizes:
+            for mode in args.modes:
+                report["results"].append(runBenchmark(args.work_dir, kind, files, mode, args.mean_size, args.seed,
+                                                      extraArgs, args.keep))
+                '''Written after every run, so a long session interrupted halfway still leaves its results'''
+                with open(args.output, "w") as f:
+                    json.dump(report, f, indent=2)
+
+    print("Results written to " + args.output)
+    if args.compare:
+        compareResults(report["results"], args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,422 @@
+'''
+   Copyright (c) 2019 Jack Farley
+   This file is part of iTunes_Backup_Reader
+   Usage or distribution of this software/code is subject to the
+   terms of the GNU GENERAL PUBLIC LICENSE.
+   syntheticBackup.py
+   ------------
+
+   Builds realistic fake backups offline for benchmarking, no device needed. A backup has
+   Manifest.plist, Info.plist and Status.plist, then either a Manifest.db whose "file" column holds
+   real NSKeyedArchiver MBFile blobs and blobs in the xx/ fan-out (iOS 10+), or a legacy
+   Manifest.mbdb with its blobs flat in the backup folder. The Manifest.db kind can also be
+   encrypted with a real keybag, so the whole decryption path runs.
+   Content is seeded, the same arguments always build the same backup.
+
+   python benchmarks/syntheticBackup.py -o /tmp/backup -n 10000 [--kind mbdb] [--encrypted]
+'''
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import struct
+import sys
+
+import biplist
+from biplist import Uid
+from Crypto.Cipher import AES
+
+
+KINDS = ("manifestdb", "mbdb")
+
+DEFAULT_PASSWORD = "benchmark"
+
+'''Real keybags use 10 million DPIC rounds, a benchmark shouldn't spend minutes unlocking'''
+DEFAULT_ITERATIONS = 1000
+
+'''Domains weighted roughly like a real backup, camera roll and app data dominate'''
+DOMAINS = (
+    ("CameraRollDomain", 30),
+    ("HomeDomain", 15),
+    ("MediaDomain", 10),
+    ("AppDomain-net.whatsapp.WhatsApp", 15),
+    ("AppDomainGroup-group.net.whatsapp.WhatsApp.shared", 10),
+    ("AppDomain-com.apple.mobilesafari", 5),
+    ("AppDomain-com.burbn.instagram", 8),
+    ("SysSharedContainerDomain-systemgroup.com.apple.media.shared.books", 3),
+    ("KeychainDomain", 1),
+    ("WirelessDomain", 3),
+)
+
+'''Folders files go into, {n} is replaced to spread large backups over more directories'''
+FOLDERS = (
+    "Media/DCIM/1{n:02d}APPLE",
+    "Media/PhotoData/Thumbnails/V2/DCIM/1{n:02d}APPLE",
+    "Library/Preferences",
+    "Library/Caches/com.apple.WebKit/{n}",
+    "Library/SMS/Attachments/{n:02x}/{n:02d}",
+    "Documents",
+    "Documents/Media/{n}",
+    "Library/Application Support",
+)
+
+'''(extension, leading bytes of the content, weight)'''
+FILE_TYPES = (
+    (".JPG", b"\xff\xd8\xff\xe0\x00\x10JFIF\x00", 30),
+    (".HEIC", b"\x00\x00\x00\x18ftypheic", 15),
+    (".PNG", b"\x89PNG\r\n\x1a\n", 10),
+    (".MOV", b"\x00\x00\x00\x14ftypqt  ", 3),
+    (".sqlite", b"SQLite format 3\x00", 10),
+    (".db", b"SQLite format 3\x00", 5),
+    (".plist", b"bplist00", 15),
+    (".txt", b"", 7),
+    (".bin", b"", 5),
+)
+
+'''Files per folder before the next numbered folder is used'''
+FILES_PER_FOLDER = 500
+
+INSERT_EVERY = 5000
+
+_KEYBAG_CLASSES = tuple(range(1, 12))
+
+_WRAP_IV = b"\xa6" * 8
+
+
+def randomBytes(r, n):
+    if hasattr(r, "randbytes"):
+        return r.randbytes(n)
+    return r.getrandbits(8 * n).to_bytes(n, "little") if n else b""
+
+
+def _weighted(r, choices):
+    '''One of choices, tuples whose last item is their weight'''
+    return r.choices(choices, [c[-1] for c in choices])[0]
+
+
+def aesWrap(kek, key):
+    '''RFC 3394 AES key wrap, the inverse of google_iphone_dataprotection._AESUnwrap'''
+    n = len(key) // 8
+    blocks = [key[i * 8:i * 8 + 8] for i in range(n)]
+    a = _WRAP_IV
+    cipher = AES.new(kek, AES.MODE_ECB)
+    for j in range(6):
+        for i in range(n):
+            b = cipher.encrypt(a + blocks[i])
+            a = (int.from_bytes(b[:8], "big") ^ (n * j + i + 1)).to_bytes(8, "big")
+            blocks[i] = b[8:]
+    return a + b"".join(blocks)
+
+
+def aesEncrypt(key, data):
+    '''AES-256-CBC with a zero IV and PKCS#7 padding, how backups store encrypted files'''
+    pad = 16 - len(data) % 16
+    return AES.new(key, AES.MODE_CBC, b"\x00" * 16).encrypt(data + bytes([pad]) * pad)
+
+
+def _tlv(tag, value):
+    if isinstance(value, int):
+        value = struct.pack(">L", value)
+    return tag + struct.pack(">L", len(value)) + value
+
+
+def makeKeybag(password, r, iterations=DEFAULT_ITERATIONS):
+    '''Backup keybag with every class key wrapped by the password. Returns (keybag bytes, {class: key})'''
+    salt = randomBytes(r, 20)
+    dpsl = randomBytes(r, 20)
+    round1 = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), dpsl, iterations, 32)
+    passcodeKey = hashlib.pbkdf2_hmac("sha1", round1, salt, 1, 32)
+    classKeys = {c: randomBytes(r, 32) for c in _KEYBAG_CLASSES}
+
+    keybag = (_tlv(b"VERS", 3) + _tlv(b"TYPE", 1) + _tlv(b"UUID", randomBytes(r, 16))
+              + _tlv(b"HMCK", randomBytes(r, 40)) + _tlv(b"WRAP", 0) + _tlv(b"SALT", salt) + _tlv(b"ITER", 1)
+              + _tlv(b"DPWT", 1) + _tlv(b"DPIC", iterations) + _tlv(b"DPSL", dpsl))
+    for protectionClass, key in classKeys.items():
+        keybag += (_tlv(b"UUID", randomBytes(r, 16)) + _tlv(b"CLAS", protectionClass) + _tlv(b"WRAP", 2)
+                   + _tlv(b"KTYP", 0) + _tlv(b"WPKY", aesWrap(passcodeKey, key)))
+    return keybag, classKeys
+
+
+def mbFile(relativePath, size, mode, protectionClass=3, inode=0, modified=1600000000, encryptionKey=None,
+           extendedAttributes=None):
+    '''MBFile blob as the "file" column of Manifest.db holds it, an NSKeyedArchiver binary plist'''
+    objects = ["$null", None, relativePath, {"$classname": "MBFile", "$classes": ["MBFile", "NSObject"]}]
+    root = {"$class": Uid(3), "RelativePath": Uid(2), "Size": size, "Mode": mode, "ProtectionClass": protectionClass,
+            "InodeNumber": inode, "UserID": 501, "GroupID": 501, "Flags": 0, "Birth": modified - 86400,
+            "LastModified": modified, "LastStatusChange": modified + 1}
+    objects[1] = root
+    for field, data in (("EncryptionKey", encryptionKey), ("ExtendedAttributes", extendedAttributes)):
+        if data is not None:
+            if len(objects) == 4:
+                objects.append({"$classname": "NSMutableData", "$classes": ["NSMutableData", "NSData", "NSObject"]})
+            objects.append({"$class": Uid(4), "NS.data": biplist.Data(data)})
+            root[field] = Uid(len(objects) - 1)
+    return biplist.writePlistToString({"$version": 100000, "$archiver": "NSKeyedArchiver", "$top": {"root": Uid(1)},
+                                       "$objects": objects})
+
+
+def sinfBlob(name):
+    '''Enough of an ApplicationSINF for sinfHelper to find the purchaser's name'''
+    return b"\x00\x00\x04\x00sinf\x00\x00\x00\x10frma" + b"\x00" * 24 + b"name" + name.encode("utf-8") + b"\x00" * 16
+
+
+def frpdBlob(user, computer):
+    '''iTunesPrefs FRPD blob with one user and computer where frpdHelper looks for them'''
+    return (b"frpd\x00\x00\x00\x01" + b"\x01\x01\x80\x00\x00" + b"\x00" * 87 + user.encode("utf-8") + b"\x00"
+            + b"\x00" * (64 - len(user) - 1) + computer.encode("utf-8") + b"\x00" * 8)
+
+
+def _applications(domains):
+    '''Info.plist and Manifest.plist application entries for the app domains in the backup'''
+    detailed = {}
+    listed = {}
+    for domain in domains:
+        if not domain.startswith("AppDomain-"):
+            continue
+        bundle = domain[len("AppDomain-"):]
+        metadata = {"itemName": bundle.rsplit(".", 1)[-1], "bundleVersion": "1.0", "artistName": "Benchmark",
+                    "softwareVersionBundleId": bundle, "is-purchased-redownload": False,
+                    "is-auto-download": False,
+                    "com.apple.iTunesStore.downloadInfo": {"accountInfo": {"AppleID": "bench@example.com"},
+                                                           "purchaseDate": "2020-01-01T00:00:00Z"}}
+        detailed[bundle] = {"iTunesMetadata": biplist.Data(biplist.writePlistToString(metadata)),
+                            "ApplicationSINF": biplist.Data(sinfBlob("Bench Mark"))}
+        listed[bundle] = {"CFBundleIdentifier": bundle, "CFBundleVersion": "1.0"}
+    listed["com.example.notinfo"] = {"CFBundleIdentifier": "com.example.notinfo", "CFBundleVersion": "1.0"}
+    return detailed, listed
+
+
+def writePlists(backupDir, serial, version, encrypted=False, keybag=None, manifestKey=None):
+    '''Writes Info.plist, Manifest.plist and Status.plist for a backup of the given iOS version'''
+    detailed, listed = _applications(d for d, _ in DOMAINS)
+    now = datetime.datetime(2020, 9, 13, 12, 26, 40)
+    biplist.writePlist({"Device Name": "Benchmark iPhone", "Display Name": "Benchmark iPhone",
+                        "Product Name": "iPhone 11", "Product Type": "iPhone12,1", "Product Version": version,
+                        "Build Version": "18A373", "Serial Number": serial, "IMEI": "350000000000000",
+                        "ICCID": "8900000000000000000", "Phone Number": "+1 555 0100", "GUID": "0" * 32,
+                        "Unique Identifier": serial.lower(), "Target Identifier": serial.lower(),
+                        "Last Backup Date": now, "iTunes Version": "12.10.8.5",
+                        "iTunes Files": {"iTunesPrefs": biplist.Data(frpdBlob("bench", "BENCH-PC"))},
+                        "Applications": detailed}, os.path.join(backupDir, "Info.plist"))
+
+    manifest = {"Version": "10.0" if float(version.split(".")[0]) >= 10 else "9.1", "IsEncrypted": encrypted,
+                "WasPasscodeSet": encrypted, "Date": now, "SystemDomainsVersion": "24.0",
+                "Lockdown": {"ProductVersion": version, "ProductType": "iPhone12,1", "BuildVersion": "18A373",
+                             "SerialNumber": serial, "DeviceName": "Benchmark iPhone"},
+                "Applications": listed}
+    if encrypted:
+        manifest["BackupKeyBag"] = biplist.Data(keybag)
+        manifest["ManifestKey"] = biplist.Data(manifestKey)
+    biplist.writePlist(manifest, os.path.join(backupDir, "Manifest.plist"))
+
+    biplist.writePlist({"BackupState": "new", "Date": now, "IsFullBackup": False, "SnapshotState": "finished",
+                        "UUID": serial, "Version": "3.3"}, os.path.join(backupDir, "Status.plist"))
+
+
+class _Layout:
+    '''Seeded stream of (domain, relativePath, content) for the files of a backup'''
+
+    def __init__(self, r, meanSize, maxSize):
+        self.r = r
+        self.maxSize = maxSize
+        self.meanSize = meanSize
+        self.counts = {}
+
+    def folder(self, domain):
+        r = self.r
+        template = r.choice(FOLDERS)
+        key = (domain, template)
+        count = self.counts.get(key, 0)
+        self.counts[key] = count + 1
+        return template.format(n=count // FILES_PER_FOLDER)
+
+    def content(self, header):
+        '''Header bytes plus random filler, sizes roughly log normal around meanSize'''
+        size = int(self.r.lognormvariate(0, 1.2) * self.meanSize / 2.05)
+        size = max(len(header), min(size, self.maxSize))
+        return header + randomBytes(self.r, size - len(header))
+
+    def files(self, count):
+        for i in range(count):
+            domain, _ = _weighted(self.r, DOMAINS)
+            extension, header, _ = _weighted(self.r, FILE_TYPES)
+            relativePath = self.folder(domain) + "/IMG_%05d%s" % (i, extension)
+            yield domain, relativePath, self.content(header)
+
+
+def _parents(relativePath):
+    parts = relativePath.split("/")
+    return ["/".join(parts[:i]) for i in range(1, len(parts))]
+
+
+def _writeBlob(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def generateManifestDb(backupDir, files, r, meanSize, maxSize, encrypted=False, password=DEFAULT_PASSWORD,
+                       iterations=DEFAULT_ITERATIONS):
+    '''iOS 10+ backup, returns the number of bytes of file content'''
+    classKeys = None
+    keybag = manifestKey = None
+    if encrypted:
+        keybag, classKeys = makeKeybag(password, r, iterations)
+
+    dbPath = os.path.join(backupDir, "Manifest.db")
+    conn = sqlite3.connect(dbPath + ".tmp" if encrypted else dbPath)
+    conn.execute("CREATE TABLE Files (fileID TEXT PRIMARY KEY, domain TEXT, relativePath TEXT, flags INTEGER, "
+                 "file BLOB)")
+    conn.execute("CREATE INDEX FilesDomainIdx ON Files(domain)")
+    conn.execute("CREATE INDEX FilesRelativePathIdx ON Files(relativePath)")
+    conn.execute("CREATE TABLE Properties (key TEXT PRIMARY KEY, value BLOB)")
+
+    rows = []
+    fanOuts = set()
+    folders = set()
+    total = 0
+    layout = _Layout(r, meanSize, maxSize)
+    for inode, (domain, relativePath, data) in enumerate(layout.files(files), 1000):
+        fileId = hashlib.sha1((domain + "-" + relativePath).encode("utf-8")).hexdigest()
+        fanOut = os.path.join(backupDir, fileId[:2])
+        if fileId[:2] not in fanOuts:
+            os.makedirs(fanOut, exist_ok=True)
+            fanOuts.add(fileId[:2])
+
+        protectionClass = r.choice((1, 2, 3, 3, 3, 4))
+        encryptionKey = None
+        if encrypted:
+            fileKey = randomBytes(r, 32)
+            encryptionKey = struct.pack("<L", protectionClass) + aesWrap(classKeys[protectionClass], fileKey)
+            _writeBlob(os.path.join(fanOut, fileId), aesEncrypt(fileKey, data))
+        else:
+            _writeBlob(os.path.join(fanOut, fileId), data)
+        total += len(data)
+
+        extendedAttributes = None
+        if inode % 7 == 0:
+            extendedAttributes = biplist.writePlistToString({"com.apple.metadata:kMDItemWhereFroms": ["bench"]})
+        rows.append((fileId, domain, relativePath, 1, mbFile(relativePath, len(data), 0o100644, protectionClass, inode,
+                                                            encryptionKey=encryptionKey,
+                                                            extendedAttributes=extendedAttributes)))
+        for parent in _parents(relativePath):
+            if (domain, parent) not in folders:
+                folders.add((domain, parent))
+                parentId = hashlib.sha1((domain + "-" + parent).encode("utf-8")).hexdigest()
+                rows.append((parentId, domain, parent, 2, mbFile(parent, 0, 0o40755, 4, inode)))
+        if len(rows) >= INSERT_EVERY:
+            conn.executemany("INSERT OR IGNORE INTO Files VALUES (?, ?, ?, ?, ?)", rows)
+            rows = []
+    conn.executemany("INSERT OR IGNORE INTO Files VALUES (?, ?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+
+    if encrypted:
+        '''Manifest.db itself is encrypted with a class 3 key wrapped in Manifest.plist'''
+        manifestDbKey = randomBytes(r, 32)
+        manifestKey = struct.pack("<L", 3) + aesWrap(classKeys[3], manifestDbKey)
+        with open(dbPath + ".tmp", "rb") as f:
+            _writeBlob(dbPath, aesEncrypt(manifestDbKey, f.read()))
+        os.remove(dbPath + ".tmp")
+
+    writePlists(backupDir, "BENCH" + ("ENC" if encrypted else "DB") + str(files), "14.0", encrypted, keybag,
+                manifestKey)
+    return total
+
+
+def _mbdbString(value):
+    if value is None:
+        return b"\xff\xff"
+    return struct.pack(">H", len(value)) + value
+
+
+def generateMbdb(backupDir, files, r, meanSize, maxSize):
+    '''Legacy (iOS 9 and under) backup, returns the number of bytes of file content'''
+    records = [b"mbdb\x05\x00"]
+    total = 0
+    folders = set()
+    layout = _Layout(r, meanSize, maxSize)
+    for inode, (domain, relativePath, data) in enumerate(layout.files(files), 1000):
+        for parent in _parents(relativePath):
+            if (domain, parent) not in folders:
+                folders.add((domain, parent))
+                records.append(_mbdbString(domain.encode("utf-8")) + _mbdbString(parent.encode("utf-8"))
+                               + _mbdbString(None) + _mbdbString(None) + _mbdbString(None)
+                               + struct.pack(">HQIIIIIQBB", 0o40755, inode, 501, 501, 1600000000, 1600000000,
+                                             1599913600, 0, 4, 0))
+
+        properties = []
+        if inode % 7 == 0:
+            properties.append((b"com.apple.assetsd.UUID", randomBytes(r, 16)))
+        records.append(_mbdbString(domain.encode("utf-8")) + _mbdbString(relativePath.encode("utf-8"))
+                       + _mbdbString(None) + _mbdbString(hashlib.sha1(data).digest()) + _mbdbString(None)
+                       + struct.pack(">HQIIIIIQBB", 0o100644, inode, 501, 501, 1600000000, 1600000000, 1599913600,
+                                     len(data), r.choice((1, 2, 3, 4)), len(properties))
+                       + b"".join(_mbdbString(name) + _mbdbString(value) for name, value in properties))
+
+        fileId = hashlib.sha1((domain + "-" + relativePath).encode("utf-8")).hexdigest()
+        _writeBlob(os.path.join(backupDir, fileId), data)
+        total += len(data)
+
+    _writeBlob(os.path.join(backupDir, "Manifest.mbdb"), b"".join(records))
+    writePlists(backupDir, "BENCHMBDB" + str(files), "9.3.5")
+    return total
+
+
+def generateBackup(backupDir, files=10000, kind="manifestdb", encrypted=False, password=DEFAULT_PASSWORD, seed=0,
+                   meanSize=16384, maxSize=8 * 1024 * 1024, iterations=DEFAULT_ITERATIONS):
+    '''Builds a backup in backupDir (which must not exist yet or be empty) and returns a summary dictionary,
+       also written next to it as <backupDir>.json for the benchmark runner'''
+    if kind not in KINDS:
+        raise ValueError("kind must be one of " + ", ".join(KINDS))
+    if encrypted and kind != "manifestdb":
+        raise ValueError("Only Manifest.db backups can be encrypted")
+
+    os.makedirs(backupDir, exist_ok=True)
+    r = random.Random(seed)
+    if kind == "mbdb":
+        total = generateMbdb(backupDir, files, r, meanSize, maxSize)
+    else:
+        total = generateManifestDb(backupDir, files, r, meanSize, maxSize, encrypted, password, iterations)
+
+    summary = {"path": os.path.abspath(backupDir), "kind": kind, "encrypted": encrypted, "files": files,
+               "bytes": total, "seed": seed, "mean_size": meanSize, "max_size": maxSize,
+               "password": password if encrypted else None}
+    with open(os.path.normpath(backupDir) + ".json", "w") as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Builds a synthetic iTunes backup for benchmarking")
+    parser.add_argument("-o", "--output", help="Folder to create the backup in", required=True, dest='output')
+    parser.add_argument("-n", "--files", help="Number of files. Default is 10000", default=10000, type=int,
+                        dest='files')
+    parser.add_argument("--kind", help="manifestdb (iOS 10+) or mbdb (iOS 9 and under). Default is manifestdb",
+                        choices=KINDS, default="manifestdb", dest='kind')
+    parser.add_argument("--encrypted", help="Encrypt the backup with a real keybag", action="store_true",
+                        dest='encrypted')
+    parser.add_argument("--password", help="Password of an encrypted backup. Default is " + DEFAULT_PASSWORD,
+                        default=DEFAULT_PASSWORD, dest='password')
+    parser.add_argument("--iterations", help="DPIC rounds of the keybag. Default is " + str(DEFAULT_ITERATIONS),
+                        default=DEFAULT_ITERATIONS, type=int, dest='iterations')
+    parser.add_argument("--mean-size", help="Typical file size in bytes. Default is 16384", default=16384, type=int,
+                        dest='mean_size')
+    parser.add_argument("--max-size", help="Largest file size in bytes. Default is 8 MiB", default=8 * 1024 * 1024,
+                        type=int, dest='max_size')
+    parser.add_argument("--seed", help="Random seed. Default is 0", default=0, type=int, dest='seed')
+    args = parser.parse_args()
+
+    if os.path.isdir(args.output) and os.listdir(args.output):
+        print("Output folder " + args.output + " is not empty", file=sys.stderr)
+        sys.exit(1)
+    summary = generateBackup(args.output, args.files, args.kind, args.encrypted, args.password, args.seed,
+                             args.mean_size, args.max_size, args.iterations)
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+'''
+   Copyright (c) 2019 Jack Farley
+   This file is part of iTunes_Backup_Reader
+   Usage or distribution of this software/code is subject to the
+   terms of the GNU GENERAL PUBLIC LICENSE.
+   backupFS.py
+   ------------
+
+   Random access to single files inside a backup without recreating it.
+   Files are looked up by domain and relative path through Manifest.db's indexes
+   (or an in-memory index for Manifest.mbdb), their metadata is only decoded when asked for
+   and decoded entries are kept in an LRU cache.
+
+       with Backup(backup_dir, password) as backup:
+           with backup.open("HomeDomain", "Library/SMS/sms.db") as f:
+               data = f.read()
+'''
+
+import errno
+import fnmatch
+import functools
+import hashlib
+import io
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import urllib.parse
+
+import Crypto.Cipher.AES
+from biplist import readPlist
+
+from helpers.manifestDbParser import getFileInfo
+from helpers.mbdbReader import readMbdb
+from helpers.iphone_backup_decrypt import EncryptedBackup, KeyCache
+
+
+'''Decoded entries kept by each Backup'''
+CACHE_SIZE = 4096
+
+'''Manifest.db flags values'''
+FLAG_FILE = 1
+FLAG_DIRECTORY = 2
+FLAG_SYMLINK = 4
+
+'''Buffer size of the file objects open() returns for encrypted files, a multiple of the AES block size'''
+READ_SIZE = 64 * 1024
+
+_BLOCK = 16
+
+
+def fileIdFor(domain, relativePath):
+    '''The fileID iTunes names each blob by'''
+    return hashlib.sha1((domain + "-" + relativePath).encode("utf-8")).hexdigest()
+
+
+def _globEscape(text):
+    '''Escapes text so SQLite's GLOB matches it literally'''
+    return "".join("[" + c + "]" if c in "*?[" else c for c in text)
+
+
+def _mbdbFlags(mode):
+    kind = (mode or 0) & 0xF000
+    if kind == 0x4000:
+        return FLAG_DIRECTORY
+    if kind == 0xA000:
+        return FLAG_SYMLINK
+    return FLAG_FILE
+
+
+class BackupEntry:
+    '''One file, directory or symlink in a backup. info is the decoded MBFile metadata,
+       with the same keys getFileInfo returns'''
+    __slots__ = ("fileID", "domain", "relativePath", "flags", "info")
+
+    def __init__(self, fileID, domain, relativePath, flags, info):
+        self.fileID = fileID
+        self.domain = domain
+        self.relativePath = relativePath
+        self.flags = flags
+        self.info = info
+
+    @property
+    def isFile(self):
+        return self.flags == FLAG_FILE
+
+    @property
+    def isDir(self):
+        return self.flags == FLAG_DIRECTORY
+
+    @property
+    def size(self):
+        return self.info.get('Size', None)
+
+    def __repr__(self):
+        return "BackupEntry(" + self.domain + ", " + self.relativePath + ")"
+
+
+class DecryptedFile(io.RawIOBase):
+    '''Seekable read only view of one encrypted backup file.
+       Files are AES-256-CBC with a zero IV, so any block can be decrypted using the ciphertext
+       block before it as its IV and only the blocks covering each read are touched.
+       The plaintext is cut to size, or to the padding when the size is not known'''
+
+    def __init__(self, path, key, size=None):
+        super().__init__()
+        self._f = open(path, 'rb')
+        self._key = key
+        self._pos = 0
+        stored = os.fstat(self._f.fileno()).st_size
+        self._stored = stored - stored % _BLOCK
+        if size is None:
+            size = self._stored - self._paddingLength()
+        self._size = min(size, self._stored)
+
+    def _decrypt(self, start, end):
+        '''Plaintext of the block aligned ciphertext range [start, end)'''
+        if start == 0:
+            iv = b"\x00" * _BLOCK
+            self._f.seek(0)
+        else:
+            self._f.seek(start - _BLOCK)
+            iv = self._f.read(_BLOCK)
+        data = self._f.read(end - start)
+        data = data[:len(data) - len(data) % _BLOCK]
+        return Crypto.Cipher.AES.new(self._key, Crypto.Cipher.AES.MODE_CBC, iv).decrypt(data)
+
+    def _paddingLength(self):
+        if self._stored == 0:
+            return 0
+        pad = self._decrypt(self._stored - _BLOCK, self._stored)[-1]
+        return pad if 0 < pad <= _BLOCK else 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError("negative seek position " + str(offset))
+        self._pos = offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def readinto(self, b):
+        end = min(self._pos + len(b), self._size)
+        if self._pos >= end:
+            return 0
+        start = self._pos - self._pos % _BLOCK
+        alignedEnd = min(-(-end // _BLOCK) * _BLOCK, self._stored)
+        data = self._decrypt(start, alignedEnd)[self._pos - start:end - start]
+        b[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._f.close()
+        super().close()
+
+
+class Backup:
+    '''A backup opened for random access, built around Manifest.db or Manifest.mbdb.
+       Nothing is copied, open() reads straight from the backup and decrypts as it goes.
+       For an encrypted backup Manifest.db is decrypted once to a temporary folder, which close() removes again.
+       Given an output_dir it is decrypted to Decrypted_Manifest.db there instead and kept, like the reader's own
+       copy in its output folder'''
+
+    def __init__(self, backup_dir, password=None, logger=None, output_dir=None, key_cache=None,
+                 cache_size=CACHE_SIZE):
+        self.backup_dir = backup_dir
+        self.logger = logger or logging.getLogger(__name__)
+        self._encrypted = None
+        self._conn = None
+        self._index = None
+        self._children = None
+        self._tempDir = None
+
+        manifest_plist = readPlist(os.path.join(backup_dir, "Manifest.plist"))
+        encrypted = manifest_plist.get("IsEncrypted", False)
+        manifest_mbdb_path = os.path.join(backup_dir, "Manifest.mbdb")
+        manifest_db_path = os.path.join(backup_dir, "Manifest.db")
+
+        if os.path.isfile(manifest_mbdb_path):
+            if encrypted:
+                raise ValueError("Encrypted Manifest.mbdb backups are not supported")
+            self._loadMbdb(manifest_mbdb_path)
+        else:
+            if encrypted:
+                if password is None:
+                    raise ValueError("A password is needed for an encrypted backup")
+                if output_dir is None:
+                    self._tempDir = tempfile.mkdtemp(prefix="backupFS-")
+                    output_dir = self._tempDir
+                cache = KeyCache(key_cache) if key_cache else None
+                self._encrypted = EncryptedBackup(backup_directory=backup_dir, passphrase=password,
+                                                  outputdir=output_dir, log=self.logger, key_cache=cache)
+                manifest_db_path = self._encrypted._decrypted_manifest_db_path
+            '''Read only, so a backup on write protected media can be opened too'''
+            uri = "file:" + urllib.parse.quote(os.path.abspath(manifest_db_path)) + "?mode=ro"
+            self._conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+        self._lookup = functools.lru_cache(maxsize=cache_size)(self._lookupUncached)
+
+    def _loadMbdb(self, path):
+        '''Manifest.mbdb has no index of its own, so one is built in memory from a single pass over the file'''
+        self._index = {}
+        for record in readMbdb(path):
+            self._index[(record.Domain, record.Path)] = record
+
+    def _lookupUncached(self, domain, relativePath):
+        if self._index is not None:
+            record = self._index.get((domain, relativePath))
+            if record is None:
+                return None
+            info = {'LastModified': record.LastModifiedTime, 'LastStatusChange': record.LastAccessedTime,
+                    'Birth': record.CreatedTime, 'Size': record.Size, 'InodeNumber': record.InodeNumber,
+                    'UserID': record.UserID, 'GroupID': record.GroupID, 'Mode': record.Mode,
+                    'ProtectionClass': record.ProtectionClass, 'LinkTarget': record.LinkTarget}
+            return BackupEntry(fileIdFor(domain, relativePath), domain, relativePath, _mbdbFlags(record.Mode), info)
+
+        '''The fileID is derived from the path so the primary key finds it, the domain/relativePath
+           lookup is only a fallback for backups that name their blobs differently'''
+        fileId = fileIdFor(domain, relativePath)
+        row = self._conn.execute("SELECT fileID, flags, file FROM Files WHERE fileID = ?", (fileId,)).fetchone()
+        if row is None:
+            row = self._conn.execute("SELECT fileID, flags, file FROM Files WHERE domain = ? AND relativePath = ?",
+                                     (domain, relativePath)).fetchone()
+        if row is None:
+            return None
+        return BackupEntry(row[0], domain, relativePath, row[1], getFileInfo(row[2]))
+
+    def stat(self, domain, relative_path=""):
+        '''Returns the BackupEntry for a path, raises FileNotFoundError if the backup doesn't have it'''
+        entry = self._lookup(domain, relative_path)
+        if entry is None:
+            raise FileNotFoundError(domain + "/" + relative_path)
+        return entry
+
+    def exists(self, domain, relative_path=""):
+        return self._lookup(domain, relative_path) is not None
+
+    def blobPath(self, entry):
+        '''Where an entry's content is stored inside the backup folder'''
+        if self._index is not None:
+            return os.path.join(self.backup_dir, entry.fileID)
+        return os.path.join(self.backup_dir, entry.fileID[0:2], entry.fileID)
+
+    def open(self, domain, relative_path):
+        '''Opens a file for reading as a seekable binary file object, decrypting on the fly when encrypted'''
+        entry = self.stat(domain, relative_path)
+        if not entry.isFile:
+            raise IsADirectoryError(domain + "/" + relative_path)
+        path = self.blobPath(entry)
+        key = entry.info.get('EncryptionKey')
+        if self._encrypted is None or not key:
+            return open(path, 'rb')
+        key = self._encrypted.unwrap_file_key(entry.info['ProtectionClass'], key)
+        if key is None:
+            raise OSError(errno.EIO, "Could not unwrap the file's key, it failed the integrity check",
+                          domain + "/" + relative_path)
+        return io.BufferedReader(DecryptedFile(path, key, entry.size), buffer_size=READ_SIZE)
+
+    def read(self, domain, relative_path):
+        with self.open(domain, relative_path) as f:
+            return f.read()
+
+    def domains(self):
+        if self._index is not None:
+            return sorted({domain for domain, path in self._index})
+        return [row[0] for row in self._conn.execute("SELECT DISTINCT domain FROM Files ORDER BY domain")]
+
+    def listdir(self, domain=None, relative_path=""):
+        '''Names directly inside a directory, or every domain when no domain is given'''
+        if domain is None:
+            return self.domains()
+        prefix = relative_path.rstrip("/") + "/" if relative_path else ""
+
+        if self._index is not None:
+            if self._children is None:
+                self._children = {}
+                for recordDomain, path in self._index:
+                    '''Directories don't always have records of their own, so every ancestor is added'''
+                    while path:
+                        parent, _, name = path.rpartition("/")
+                        self._children.setdefault((recordDomain, parent), set()).add(name)
+                        path = parent
+            return sorted(self._children.get((domain, relative_path.rstrip("/")), ()))
+
+        rows = self._conn.execute("SELECT relativePath FROM Files WHERE domain = ? AND relativePath GLOB ?",
+                                  (domain, _globEscape(prefix) + "?*"))
+        return sorted({path[len(prefix):].split("/", 1)[0] for (path,) in rows})
+
+    def glob(self, domain_pattern, path_pattern="*"):
+        '''Yields the BackupEntry of every path matching two shell style patterns, one for the domain
+           and one for the relative path. As with SQLite GLOB, * also matches "/"'''
+        if self._index is not None:
+            for domain, path in sorted(self._index):
+                if fnmatch.fnmatchcase(domain, domain_pattern) and fnmatch.fnmatchcase(path, path_pattern):
+                    yield self._lookup(domain, path)
+            return
+
+        rows = self._conn.execute("SELECT domain, relativePath FROM Files WHERE domain GLOB ? AND relativePath GLOB ? "
+                                  "ORDER BY domain, relativePath", (domain_pattern, path_pattern)).fetchall()
+        for domain, path in rows:
+            yield self._lookup(domain, path)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        if self._encrypted is not None and self._encrypted._temp_manifest_db_conn is not None:
+            self._encrypted._temp_manifest_db_conn.close()
+        if self._tempDir is not None:
+            shutil.rmtree(self._tempDir, ignore_errors=True)
+            self._tempDir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,179 @@
+'''
+   Copyright (c) 2019 Jack Farley
+   This file is part of iTunes_Backup_Reader
+   Usage or distribution of this software/code is subject to the
+   terms of the GNU GENERAL PUBLIC LICENSE.
+   backupMount.py
+   ------------
+
+   Read only filesystem view of a backup, /<domain>/<relativePath>, served straight from the
+   blobs in the backup folder and decrypted on the fly. BackupVFS is the filesystem itself and
+   works without FUSE, mountBackup() serves it through fusepy (pip install fusepy) when available.
+'''
+
+import errno
+import stat
+import threading
+
+from helpers.backupFS import Backup, FLAG_SYMLINK
+
+try:
+    from fuse import FUSE, Operations
+except (ImportError, OSError):
+    '''fusepy raises OSError when it is installed but libfuse is missing'''
+    FUSE = None
+    Operations = object
+
+
+'''Permission bits of everything in the mount, nothing is writable'''
+FILE_PERMISSIONS = 0o444
+DIR_PERMISSIONS = 0o555
+
+
+class BackupVFS:
+    '''Path based read only view of a Backup. Paths are "/" for the list of domains, then
+       "/<domain>/<relativePath>". Errors are OSErrors carrying the errno a filesystem would return.
+       Directories that only exist as the parent of other paths are shown too'''
+
+    def __init__(self, backup):
+        self.backup = backup
+        self._handles = {}
+        self._nextHandle = 1
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def split(path):
+        '''Splits a mount path into (domain, relativePath), domain is None for the root'''
+        path = path.strip("/")
+        if not path:
+            return None, ""
+        domain, _, relativePath = path.partition("/")
+        return domain, relativePath
+
+    def _entry(self, path):
+        domain, relativePath = self.split(path)
+        if domain is None:
+            return None, True
+        try:
+            entry = self.backup.stat(domain, relativePath)
+            return entry, entry.isDir
+        except FileNotFoundError:
+            pass
+        if self.backup.listdir(domain, relativePath):
+            return None, True
+        raise OSError(errno.ENOENT, "No such file or directory", path)
+
+    def getattr(self, path, fh=None):
+        '''os.stat style attributes of a path, as a dict of st_* fields'''
+        entry, isDir = self._entry(path)
+        attrs = {'st_nlink': 2 if isDir else 1, 'st_size': 0, 'st_uid': 0, 'st_gid': 0,
+                 'st_mtime': 0, 'st_atime': 0, 'st_ctime': 0}
+        if entry is not None:
+            info = entry.info
+            attrs['st_size'] = 0 if isDir else info.get('Size') or 0
+            attrs['st_uid'] = info.get('UserID') or 0
+            attrs['st_gid'] = info.get('GroupID') or 0
+            attrs['st_mtime'] = attrs['st_atime'] = info.get('LastModified') or 0
+            attrs['st_ctime'] = info.get('LastStatusChange') or 0
+            attrs['st_ino'] = info.get('InodeNumber') or 0
+
+        if isDir:
+            attrs['st_mode'] = stat.S_IFDIR | DIR_PERMISSIONS
+        elif entry.flags == FLAG_SYMLINK and entry.info.get('LinkTarget'):
+            attrs['st_mode'] = stat.S_IFLNK | 0o777
+            attrs['st_size'] = len(entry.info['LinkTarget'])
+        else:
+            '''Keep the owner/group/other read bits the device had, but never any write bits'''
+            attrs['st_mode'] = stat.S_IFREG | ((entry.info.get('Mode') or FILE_PERMISSIONS) & FILE_PERMISSIONS)
+        return attrs
+
+    def readdir(self, path, fh=None):
+        domain, relativePath = self.split(path)
+        entry, isDir = self._entry(path)
+        if not isDir:
+            raise OSError(errno.ENOTDIR, "Not a directory", path)
+        return [".", ".."] + self.backup.listdir(domain, relativePath)
+
+    def readlink(self, path):
+        entry, isDir = self._entry(path)
+        if entry is None or entry.flags != FLAG_SYMLINK or not entry.info.get('LinkTarget'):
+            raise OSError(errno.EINVAL, "Not a symbolic link", path)
+        return entry.info['LinkTarget'].decode("utf-8", "surrogateescape")
+
+    def open(self, path, flags=0):
+        '''Opens a file for reading and returns its handle number'''
+        if flags & 3:
+            raise OSError(errno.EROFS, "Read-only file system", path)
+        entry, isDir = self._entry(path)
+        if isDir:
+            raise OSError(errno.EISDIR, "Is a directory", path)
+        domain, relativePath = self.split(path)
+        f = self.backup.open(domain, relativePath)
+        with self._lock:
+            fh = self._nextHandle
+            self._nextHandle += 1
+            self._handles[fh] = (f, threading.Lock())
+        return fh
+
+    def read(self, path, size, offset, fh):
+        try:
+            f, lock = self._handles[fh]
+        except KeyError:
+            raise OSError(errno.EBADF, "Bad file descriptor", path)
+        with lock:
+            f.seek(offset)
+            return f.read(size)
+
+    def release(self, path, fh):
+        with self._lock:
+            f, lock = self._handles.pop(fh, (None, None))
+        if f is not None:
+            f.close()
+        return 0
+
+    def close(self):
+        for fh in list(self._handles):
+            self.release(None, fh)
+
+
+class FuseOperations(Operations):
+    '''fusepy operations forwarding to a BackupVFS. fusepy turns the OSErrors it raises into -errno'''
+
+    def __init__(self, vfs):
+        self.vfs = vfs
+
+    def getattr(self, path, fh=None):
+        return self.vfs.getattr(path, fh)
+
+    def readdir(self, path, fh):
+        return self.vfs.readdir(path, fh)
+
+    def readlink(self, path):
+        return self.vfs.readlink(path)
+
+    def open(self, path, flags):
+        return self.vfs.open(path, flags)
+
+    def read(self, path, size, offset, fh):
+        return self.vfs.read(path, size, offset, fh)
+
+    def release(self, path, fh):
+        return self.vfs.release(path, fh)
+
+
+def mountBackup(input_dir, mountpoint, password, logger, key_cache=None, foreground=True):
+    '''Mounts a backup read only at mountpoint until it is unmounted (fusermount -u / umount) or interrupted'''
+    if FUSE is None:
+        logger.error("Mounting needs fusepy and libfuse, install them with: pip install fusepy")
+        return False
+
+    backup = Backup(input_dir, password, logger, key_cache=key_cache)
+    vfs = BackupVFS(backup)
+    logger.info("Mounting " + input_dir + " read only at " + mountpoint)
+    try:
+        FUSE(FuseOperations(vfs), mountpoint, foreground=foreground, ro=True, nothreads=True)
+    finally:
+        vfs.close()
+        backup.close()
+    logger.info("Unmounted " + mountpoint)
+    return True
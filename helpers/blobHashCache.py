@@ -0,0 +1,90 @@
+'''
+   Copyright (c) 2019 Jack Farley
+   This file is part of iTunes_Backup_Reader
+   Usage or distribution of this software/code is subject to the
+   terms of the GNU GENERAL PUBLIC LICENSE.
+   blobHashCache.py
+   ------------
+
+   Sidecar SQLite cache of the digests and sniffed type of each backup blob, so running the tool
+   again over the same evidence only reads the blobs that are new or have changed since.
+   A blob is identified by its path, inode, size and mtime in nanoseconds, any change to one of
+   those and the cached entry is ignored and replaced.
+'''
+
+import os
+import sqlite3
+import threading
+
+
+HASH_CACHE_NAME = "Blob_Hash_Cache.db"
+
+'''New entries are committed in batches of this size'''
+COMMIT_EVERY = 1000
+
+
+def statKey(path):
+    '''(inode, size, mtime_ns) of a blob, or None if it can't be stat'ed'''
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class BlobHashCache:
+    '''Maps blob path -> (inode, size, mtime_ns, MD5, SHA-1, SHA-256, file type) of its recreated content.
+       Lookups happen on the thread queueing copies and stores on the threads finishing them, so every
+       access goes through one lock. Several processes can share the file, it is kept in WAL mode'''
+
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+        self.hits = 0
+        self.misses = 0
+        self._pending = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS Blobs (Path TEXT PRIMARY KEY, Inode INTEGER, Size INTEGER, "
+                           "MTimeNs INTEGER, MD5 TEXT, SHA1 TEXT, SHA256 TEXT, FileType TEXT)")
+        self._conn.commit()
+        logger.info("Using the blob hash cache at: " + path)
+
+    def lookup(self, sourceFile):
+        '''Returns (key, digests) for a blob. digests is the cached {algorithm: hex digest, "type": type}
+           when the blob hasn't changed since it was cached, None otherwise. key is handed back to store()'''
+        key = statKey(sourceFile)
+        if key is None:
+            return None, None
+        with self._lock:
+            row = self._conn.execute("SELECT Inode, Size, MTimeNs, MD5, SHA1, SHA256, FileType FROM Blobs "
+                                     "WHERE Path = ?", (os.path.abspath(sourceFile),)).fetchone()
+            if row is None or tuple(row[0:3]) != key:
+                self.misses += 1
+                return key, None
+            self.hits += 1
+        return key, {'md5': row[3], 'sha1': row[4], 'sha256': row[5], 'type': row[6]}
+
+    def store(self, sourceFile, key, digests):
+        '''Caches the digests of a blob read while it had the stat key from lookup()'''
+        if key is None:
+            return
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO Blobs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                               (os.path.abspath(sourceFile),) + tuple(key) +
+                               (digests['md5'], digests['sha1'], digests['sha256'], digests.get('type')))
+            self._pending += 1
+            if self._pending >= COMMIT_EVERY:
+                self._conn.commit()
+                self._pending = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+        self.logger.info("Blob hash cache: " + str(self.hits) + " blobs answered from the cache, "
+                         + str(self.misses) + " read")
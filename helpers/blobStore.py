@@ -0,0 +1,75 @@
+'''
+   Copyright (c) 2019 Jack Farley
+   This file is part of iTunes_Backup_Reader
+   Usage or distribution of this software/code is subject to the
+   terms of the GNU GENERAL PUBLIC LICENSE.
+   blobStore.py
+   ------------
+
+   Content addressed output store. Every unique blob is kept once under Blob_Store/<sha256[0:2]>/<sha256>
+   and the recreated tree is made of hardlinks into it, so duplicates within a backup, and across
+   several backups written to the same output folder, cost no extra space or copy time.
+'''
+
+import os
+import threading
+from helpers.fastCopy import placeFile
+from helpers.iphone_backup_decrypt import decrypt_file_to
+from helpers import evidenceHash
+
+
+STORE_NAME = "Blob_Store"
+
+'''Naming a blob only takes its SHA-256, the other evidence digests are only computed with hash_files'''
+STORE_ALGORITHMS = ("sha256",)
+
+
+def blobPath(storeDir, digest):
+    return os.path.join(storeDir, digest[0:2], digest)
+
+
+def _tempPath(storeDir):
+    return os.path.join(storeDir, ".tmp-" + str(os.getpid()) + "-" + str(threading.get_ident()))
+
+
+def storeBlob(storeDir, sourceFile, key=None, size=None, hash_files=False, known=None):
+    '''Makes sure the content of sourceFile (decrypted with key when given) is in the store.
+       Returns (digest, path of the blob in the store, True if it was not stored before, evidence digests).
+       With hash_files the MD5/SHA-1/SHA-256 evidence digests come from the same read as the store digest,
+       otherwise they are None. known are digests of the content from the blob hash cache, when the store
+       already has that content the source isn't read at all'''
+    if known is not None:
+        stored = blobPath(storeDir, known['sha256'])
+        if os.path.exists(stored):
+            return known['sha256'], stored, False, known
+
+    '''The content hash is only known once the blob has been read, so it is copied (or decrypted) next to the
+       store while being hashed, then renamed into place or dropped when the store already has it'''
+    algorithms = evidenceHash.HASH_ALGORITHMS if hash_files else STORE_ALGORITHMS
+    temp = _tempPath(storeDir)
+    if key is None:
+        evidence = evidenceHash.copyHashed(sourceFile, temp, algorithms=algorithms)[1]
+    else:
+        hasher = evidenceHash.Digests(algorithms)
+        decrypt_file_to(sourceFile, temp, key, size, hasher=hasher)
+        evidence = hasher.hexdigests()
+    digest = evidence['sha256']
+    if not hash_files:
+        evidence = None
+    stored = blobPath(storeDir, digest)
+    if os.path.exists(stored):
+        os.remove(temp)
+        return digest, stored, False, evidence
+
+    os.makedirs(os.path.dirname(stored), exist_ok=True)
+    '''Two workers storing the same content at once both end up with identical bytes under this name'''
+    os.replace(temp, stored)
+    return digest, stored, True, evidence
+
+
+def recreateFromStore(storeDir, sourceFile, destFile, key=None, size=None, hash_files=False, known=None):
+    '''Stores the blob and hardlinks destFile to it, or copies it out of the store where links are not possible.
+       Returns (size of the recreated file, evidence digests or None)'''
+    digest, stored, new, evidence = storeBlob(storeDir, sourceFile, key, size, hash_files, known)
+    placeFile(stored, destFile, "hardlink")
+    return os.path.getsize(destFile), evidence
@@ -17,19 +17,21 @@
 from kaitaistruct import  KaitaiStruct, KaitaiStream, BytesIO
 
 
-from helpers.iphone_backup_decrypt import EncryptedBackup
+from helpers.iphone_backup_decrypt import EncryptedBackup, KeyCache
 
 
 
 
 
 class Decryptor:
-    def __init__(self, input_dir, output_dir, password, logger):
+    def __init__(self, input_dir, output_dir, password, logger, key_cache=None):
         self.input_dir = input_dir
         self.output_dir = output_dir
         self.logger = logger
         self.password = password
+        self.key_cache = key_cache
         self.decrypted_manifest_db = None
+        self.backup = None
         self.start_decryption()
 
     def start_decryption(self):
@@ -37,9 +39,19 @@ class Decryptor:
 
 
         backup_path = self.input_dir
-        decrypt = EncryptedBackup(backup_directory=backup_path, passphrase=self.password, outputdir=self.output_dir, log= self.logger)
+
+        '''key_cache is the path of the opt-in key cache, or None to always derive the keys'''
+        key_cache = None
+        if self.key_cache:
+            key_cache = KeyCache(self.key_cache)
+
+        decrypt = EncryptedBackup(backup_directory=backup_path, passphrase=self.password, outputdir=self.output_dir,
+                                  log= self.logger, key_cache=key_cache)
         self.decrypted_manifest_db = decrypt._decrypted_manifest_db_path
 
+        '''Kept so the recreator can unwrap each file's key while copying'''
+        self.backup = decrypt
+
 
 
 
@@ -0,0 +1,72 @@
+'''
+   Copyright (c) 2019 Jack Farley
+   This file is part of iTunes_Backup_Reader
+   Usage or distribution of this software/code is subject to the
+   terms of the GNU GENERAL PUBLIC LICENSE.
+   dirCache.py
+   ------------
+
+   Process wide cache of the output directories known to exist. Each unique directory costs
+   a single mkdir the first time it is needed and nothing after that, instead of an exists
+   check plus makedirs for every file, which adds up on network shares.
+'''
+
+import os
+import threading
+from helpers.fastCopy import longPath
+from helpers.runMetrics import METRICS
+
+
+class DirCache:
+    '''Set of directories that exist. Creating one only touches the missing part of its path,
+       an existing directory answers its first mkdir with an error and is remembered from then on'''
+
+    def __init__(self):
+        self._known = set()
+        self._lock = threading.Lock()
+        self.created = 0
+
+    def ensure(self, path):
+        '''Makes sure path is a directory, raises OSError like os.makedirs if it can't be created'''
+        path = os.path.normpath(path)
+        if path in self._known:
+            return
+        with self._lock, METRICS.stage("directory_creation"):
+            missing = []
+            while path not in self._known:
+                missing.append(path)
+                parent = os.path.dirname(path)
+                if parent == path or not parent:
+                    break
+                path = parent
+            for directory in reversed(missing):
+                try:
+                    os.mkdir(longPath(directory))
+                    self.created += 1
+                except OSError:
+                    '''Already there, which mkdir may also report as EACCES or EROFS for the root of a share or a
+                       read only mount point above the output folder. Anything else is a real failure'''
+                    if not os.path.isdir(longPath(directory)):
+                        raise
+                self._known.add(directory)
+
+    def plan(self, paths):
+        '''Creates every directory in paths up front, parents first'''
+        for path in sorted(set(paths)):
+            self.ensure(path)
+
+    def forget(self):
+        with self._lock:
+            self._known.clear()
+
+
+'''Shared by everything in this process that writes to the output folder'''
+DIR_CACHE = DirCache()
+
+
+def ensureDir(path):
+    DIR_CACHE.ensure(path)
+
+
+def planDirs(paths):
+    DIR_CACHE.plan(paths)
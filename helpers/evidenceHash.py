@@ -0,0 +1,169 @@
+'''
+   Copyright (c) 2019 Jack Farley
+   This file is part of iTunes_Backup_Reader
+   Usage or distribution of this software/code is subject to the
+   terms of the GNU GENERAL PUBLIC LICENSE.
+   evidenceHash.py
+   ------------
+
+   MD5, SHA-1 and SHA-256 of every recreated file, computed from the bytes as they are copied so
+   nothing is read twice, and the Hash_Manifest.txt written from them at the end of a run.
+'''
+
+import datetime
+import hashlib
+import os
+import sqlite3
+
+
+HASH_ALGORITHMS = ("md5", "sha1", "sha256")
+
+'''Bytes read per step of a hashed copy'''
+HASH_CHUNK = 1024 * 1024
+
+HASH_MANIFEST_NAME = "Hash_Manifest.txt"
+
+'''Leading bytes kept to sniff the file type from'''
+SNIFF_BYTES = 64
+
+'''(offset, magic, type) checked in order, the first match wins'''
+MAGIC = (
+    (0, b"SQLite format 3\x00", "sqlite"),
+    (0, b"bplist", "bplist"),
+    (0, b"\xff\xd8\xff", "jpeg"),
+    (0, b"\x89PNG\r\n\x1a\n", "png"),
+    (0, b"GIF87a", "gif"),
+    (0, b"GIF89a", "gif"),
+    (4, b"ftypheic", "heic"),
+    (4, b"ftypheix", "heic"),
+    (4, b"ftypmif1", "heic"),
+    (4, b"ftypqt  ", "mov"),
+    (4, b"ftyp", "mp4"),
+    (0, b"%PDF", "pdf"),
+    (0, b"PK\x03\x04", "zip"),
+    (0, b"\x1f\x8b", "gzip"),
+    (0, b"ID3", "mp3"),
+    (0, b"#!AMR", "amr"),
+    (0, b"caff", "caf"),
+    (0, b"OggS", "ogg"),
+    (0, b"RIFF", "riff"),
+    (0, b"<?xml", "xml"),
+)
+
+
+def sniffType(head):
+    '''Guesses a file's type from its first bytes'''
+    if not head:
+        return "empty"
+    for offset, magic, fileType in MAGIC:
+        if head[offset:offset + len(magic)] == magic:
+            if fileType == "xml" and b"<plist" in head:
+                return "plist"
+            return fileType
+    try:
+        head.decode("utf-8")
+        return "text"
+    except UnicodeDecodeError:
+        '''A multi byte character may be cut off at the end of the sniffed bytes'''
+        try:
+            head[:-3].decode("utf-8")
+            return "text"
+        except UnicodeDecodeError:
+            return "data"
+
+
+class Digests:
+    '''All of algorithms (HASH_ALGORITHMS by default) over one stream of bytes, plus the type sniffed from its
+       first bytes'''
+
+    def __init__(self, algorithms=HASH_ALGORITHMS):
+        self._algorithms = algorithms
+        self._hashes = [hashlib.new(name) for name in algorithms]
+        self._head = b""
+
+    def update(self, data):
+        if len(self._head) < SNIFF_BYTES:
+            self._head += bytes(data[:SNIFF_BYTES - len(self._head)])
+        for h in self._hashes:
+            h.update(data)
+
+    def hexdigests(self):
+        '''{algorithm: hex digest} with the sniffed type under "type"'''
+        digests = {name: h.hexdigest() for name, h in zip(self._algorithms, self._hashes)}
+        digests['type'] = sniffType(self._head)
+        return digests
+
+
+def copyHashed(sourceFile, destFile, chunk_size=HASH_CHUNK, algorithms=HASH_ALGORITHMS):
+    '''Copies sourceFile to destFile in userspace, hashing each chunk on its way through.
+       Returns (bytes written, hex digests)'''
+    digests = Digests(algorithms)
+    written = 0
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    with open(sourceFile, 'rb') as fsrc, open(destFile, 'wb') as fdst:
+        while True:
+            n = fsrc.readinto(buf)
+            if not n:
+                break
+            chunk = view[:n]
+            digests.update(chunk)
+            fdst.write(chunk)
+            written += n
+    return written, digests.hexdigests()
+
+
+def hashFile(path, chunk_size=HASH_CHUNK, algorithms=HASH_ALGORITHMS):
+    '''Returns (size, hex digests) of a file already in place'''
+    digests = Digests(algorithms)
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digests.update(chunk)
+            size += len(chunk)
+    return size, digests.hexdigests()
+
+
+def recordDigests(pool, sink, outputDir):
+    '''Moves the digests of the copies the pool has finished into File_Metadata.db.
+       Copies finish on worker threads, but the sink's connection belongs to the caller's thread'''
+    for relativePath, destFile, size, digests, expected, verified in pool.takeDigests():
+        sink.addDigest([relativePath, os.path.relpath(destFile, outputDir), size, digests['md5'], digests['sha1'],
+                        digests['sha256'], digests.get('type'), expected, verified])
+
+
+def writeHashManifest(outputDir, logger):
+    '''Writes Hash_Manifest.txt from the Digests table, one tab separated line per file ordered by path.
+       The last line is the SHA-256 of every line above it except the Generated timestamp, so any later edit of the
+       manifest shows while two runs over the same evidence still get the same seal'''
+    db_path = os.path.join(outputDir, "File_Metadata.db")
+    manifest_path = os.path.join(outputDir, HASH_MANIFEST_NAME)
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute("SELECT MD5, SHA1, SHA256, Size, RelativePath, RecreatedPath FROM Digests "
+                            "ORDER BY RelativePath, RecreatedPath")
+        seal = hashlib.sha256()
+        count = 0
+        with open(manifest_path, 'w', encoding="utf-8", newline="\n") as f:
+            def line(text):
+                seal.update((text + "\n").encode("utf-8"))
+                f.write(text + "\n")
+
+            line("# iTunes_Backup_Reader hash manifest")
+            f.write("# Generated: " + datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
+                    + "\n")
+            line("# MD5\tSHA1\tSHA256\tSize\tRelativePath\tRecreatedPath")
+            for row in rows:
+                line("\t".join("" if value is None else str(value) for value in row))
+                count += 1
+            line("# Files: " + str(count))
+            f.write("# Manifest SHA-256: " + seal.hexdigest() + "\n")
+    except sqlite3.Error as ex:
+        logger.exception("Could not write the hash manifest " + manifest_path + " Exception was: " + str(ex))
+        return None
+    finally:
+        conn.close()
+
+    logger.info("Wrote hashes of " + str(count) + " files to " + manifest_path + ", manifest SHA-256: "
+                + seal.hexdigest())
+    return manifest_path
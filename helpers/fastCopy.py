@@ -0,0 +1,129 @@
+'''
+   Copyright (c) 2019 Jack Farley
+   This file is part of iTunes_Backup_Reader
+   Usage or distribution of this software/code is subject to the
+   terms of the GNU GENERAL PUBLIC LICENSE.
+   fastCopy.py
+   ------------
+
+   Places a backup blob at its recreated path as cheaply as the filesystem allows:
+   a hardlink, reflink or symlink when asked for, otherwise a copy done in the kernel
+'''
+
+import errno
+import os
+import shutil
+import sys
+import threading
+
+
+LINK_MODES = ("copy", "hardlink", "reflink", "symlink")
+
+'''Modes where the recreated file shares its inode with the evidence, so its timestamps must not be touched'''
+SHARED_INODE_MODES = ("hardlink", "symlink")
+
+'''Linux ioctl that clones a file's extents (btrfs, XFS, ...)'''
+FICLONE = 0x40049409
+
+'''Bytes handed to the kernel per copy_file_range/sendfile call'''
+KERNEL_CHUNK = 64 * 1024 * 1024
+
+'''Errors that mean "this mechanism is not available here", as opposed to a real I/O failure'''
+_UNSUPPORTED = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP}
+
+_LINUX = sys.platform.startswith("linux")
+
+'''Per thread count of placeFile calls that fell back to a copy. Jobs may run in worker processes, so the pool
+   takes the count after each job and hands it back to the process that keeps the run metrics'''
+_fallbacks = threading.local()
+_WINDOWS = sys.platform.startswith("win")
+
+
+def longPath(path):
+    '''On Windows the extended length form of path, so paths longer than MAX_PATH still work. Unchanged elsewhere'''
+    if not _WINDOWS:
+        return path
+    path = os.path.abspath(path)
+    if path.startswith("\\\\?\\"):
+        return path
+    if path.startswith("\\\\"):
+        return "\\\\?\\UNC\\" + path[2:]
+    return "\\\\?\\" + path
+
+
+def _kernelCopy(sourceFile, destFile):
+    '''Copies with copy_file_range, or sendfile on older kernels. Returns False if neither works here'''
+    with open(sourceFile, 'rb') as fsrc, open(destFile, 'wb') as fdst:
+        infd = fsrc.fileno()
+        outfd = fdst.fileno()
+        calls = []
+        if hasattr(os, "copy_file_range"):
+            calls.append(lambda: os.copy_file_range(infd, outfd, KERNEL_CHUNK))
+        calls.append(lambda: os.sendfile(outfd, infd, None, KERNEL_CHUNK))
+
+        for call in calls:
+            copied = 0
+            try:
+                while True:
+                    n = call()
+                    if n == 0:
+                        return True
+                    copied += n
+            except OSError as ex:
+                '''Only fall back if nothing has been written yet, a failure part way through is a real error'''
+                if copied or ex.errno not in _UNSUPPORTED:
+                    raise
+    return False
+
+
+def copyData(sourceFile, destFile):
+    '''A real byte copy, in the kernel on Linux and with shutil (long path safe on Windows) everywhere else'''
+    if _LINUX and _kernelCopy(sourceFile, destFile):
+        return
+    shutil.copyfile(longPath(sourceFile), longPath(destFile))
+
+
+def reflink(sourceFile, destFile):
+    '''Copy-on-write clone of sourceFile, raises OSError where the filesystem can't do it'''
+    if not _LINUX:
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are only supported on Linux")
+    import fcntl
+    with open(sourceFile, 'rb') as fsrc, open(destFile, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(destFile)
+            raise
+
+
+def takeFallbacks():
+    '''Returns how many placeFile calls on this thread fell back to a copy since the last call, and resets it'''
+    count = getattr(_fallbacks, "count", 0)
+    _fallbacks.count = 0
+    return count
+
+
+def placeFile(sourceFile, destFile, link_mode="copy"):
+    '''Puts sourceFile at destFile using link_mode, falling back to a copy for this file if that mode fails.
+       Returns the mode actually used'''
+
+    '''Never write through an old hardlink/symlink left at the destination, that would modify the evidence'''
+    if os.path.lexists(longPath(destFile)):
+        os.remove(longPath(destFile))
+
+    try:
+        if link_mode == "hardlink":
+            os.link(longPath(sourceFile), longPath(destFile))
+            return link_mode
+        if link_mode == "symlink":
+            os.symlink(os.path.abspath(sourceFile), destFile)
+            return link_mode
+        if link_mode == "reflink":
+            reflink(sourceFile, destFile)
+            return link_mode
+    except (OSError, NotImplementedError):
+        _fallbacks.count = getattr(_fallbacks, "count", 0) + 1
+
+    copyData(sourceFile, destFile)
+    return "copy"
@@ -0,0 +1,96 @@
+'''
+   Copyright (c) 2019 Jack Farley
+   This file is part of iTunes_Backup_Reader
+   Usage or distribution of this software/code is subject to the
+   terms of the GNU GENERAL PUBLIC LICENSE.
+   fileFilter.py
+   ------------
+
+   Selects which backup files are recreated. Patterns are domain[:pathglob], with shell style
+   globs matched case sensitively like SQLite's GLOB, where * also matches "/"
+   ex. HomeDomain, AppDomain-*:*.sqlite, CameraRollDomain:Media/DCIM/*
+'''
+
+import fnmatch
+import re
+
+
+def parsePattern(pattern):
+    '''Splits domain[:pathglob] into (domain glob, path glob), a missing path glob matches everything'''
+    domain, sep, path = pattern.partition(":")
+    return domain or "*", path if sep else "*"
+
+
+class FileFilter:
+    '''include and exclude are lists of domain[:pathglob] patterns, a file is kept when it matches any
+       include (or there are none) and no exclude. extensions and the size range only apply to files.
+       sqlWhere() pushes everything but the size into the Manifest.db query, since the size is only known
+       once the MBFile blob is decoded, match() and matchSize() do the same checks for Manifest.mbdb records'''
+
+    def __init__(self, include=None, exclude=None, extensions=None, min_size=None, max_size=None):
+        self.include = [parsePattern(p) for p in include or []]
+        self.exclude = [parsePattern(p) for p in exclude or []]
+        self.extensions = sorted({"." + e.strip().lstrip(".").lower() for e in extensions or [] if e.strip()})
+        self.min_size = min_size
+        self.max_size = max_size
+        self._include = [self._compile(p) for p in self.include]
+        self._exclude = [self._compile(p) for p in self.exclude]
+
+    @staticmethod
+    def _compile(pattern):
+        return re.compile(fnmatch.translate(pattern[0])), re.compile(fnmatch.translate(pattern[1]))
+
+    @property
+    def active(self):
+        return bool(self.include or self.exclude or self.extensions or self.min_size is not None
+                    or self.max_size is not None)
+
+    @property
+    def sizeRange(self):
+        '''True when files are also selected by size, which only matchSize() can check'''
+        return self.min_size is not None or self.max_size is not None
+
+    def sqlWhere(self):
+        '''Returns (WHERE clause without the keyword, parameters) for the Files table, or ("", []) to keep every row'''
+        clauses = []
+        params = []
+
+        def patterns(pairs):
+            parts = []
+            for domain, path in pairs:
+                parts.append("(domain GLOB ? AND relativePath GLOB ?)")
+                params.extend((domain, path))
+            return " OR ".join(parts)
+
+        if self.include:
+            clauses.append("(" + patterns(self.include) + ")")
+        if self.exclude:
+            clauses.append("NOT (" + patterns(self.exclude) + ")")
+        if self.extensions:
+            '''Only files (flags 1) have an extension to match, folders and links are always kept'''
+            clauses.append("(flags != 1 OR " + " OR ".join("lower(relativePath) GLOB ?" for e in self.extensions) + ")")
+            params.extend("*" + e for e in self.extensions)
+        return " AND ".join(clauses), params
+
+    def match(self, domain, relativePath, isFile=True):
+        '''The same test as sqlWhere(), for records read outside SQLite. isFile is False for folders and links'''
+        if self._include and not any(d.match(domain) and p.match(relativePath) for d, p in self._include):
+            return False
+        if any(d.match(domain) and p.match(relativePath) for d, p in self._exclude):
+            return False
+        if isFile and self.extensions and not relativePath.lower().endswith(tuple(self.extensions)):
+            return False
+        return True
+
+    def matchSize(self, size):
+        if size is None:
+            return self.min_size is None and self.max_size is None
+        if self.min_size is not None and size < self.min_size:
+            return False
+        if self.max_size is not None and size > self.max_size:
+            return False
+        return True
+
+    def __repr__(self):
+        return ("FileFilter(include=" + str(self.include) + ", exclude=" + str(self.exclude) + ", extensions="
+                + str(self.extensions) + ", size=" + str(self.min_size) + "-" + str(self.max_size) + ")")
@@ -1,3 +1,4 @@
-from .iphone_backup import EncryptedBackup
+from .iphone_backup import EncryptedBackup, decrypt_file_to
+from .key_cache import KeyCache, DEFAULT_KEY_CACHE_PATH
 
-__all__ = ["EncryptedBackup"]
+__all__ = ["EncryptedBackup", "decrypt_file_to", "KeyCache", "DEFAULT_KEY_CACHE_PATH"]
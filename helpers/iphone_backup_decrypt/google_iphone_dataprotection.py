@@ -17,7 +17,7 @@ except ImportError:
     from hashlib import pbkdf2_hmac  # but settle for a standard library one if necessary!
 
 
-__all__ = ["Keybag", "AESdecryptCBC"]
+__all__ = ["Keybag", "AESdecryptCBC", "AESdecryptCBCStream"]
 
 
 _CLASSKEY_TAGS = [b"CLAS", b"WRAP", b"WPKY", b"KTYP", b"PBKY"]  # UUID
@@ -49,6 +49,8 @@ class Keybag:
         self.attrs = {}
         self.classKeys = {}
         self.KeyBagKeys = None  # DATASIGN blob
+        self._classCiphers = {}  # One AES-ECB object per unlocked class key
+        self._unwrapCache = {}  # (class, wrapped key) -> unwrapped key
         self.parseBinaryBlob(data)
 
     def parseBinaryBlob(self, data):
@@ -90,10 +92,33 @@ class Keybag:
         return True
 
     def unwrapKeyForClass(self, protection_class, persistent_key):
-        ck = self.classKeys[protection_class][b"KEY"]
-        if len(persistent_key) != 0x28:
-            raise Exception("Invalid key length")
-        return _AESUnwrap(ck, persistent_key)
+        return self.unwrapKeysForClass(protection_class, [persistent_key])[0]
+
+    def unwrapKeysForClass(self, protection_class, persistent_keys):
+        """Unwrap many keys of one protection class in a single pass, returning them in order.
+
+        Keys already seen are answered from a cache, the rest go through one batched AES unwrap."""
+        cache = self._unwrapCache
+        missing = []
+        for persistent_key in persistent_keys:
+            if len(persistent_key) != 0x28:
+                raise Exception("Invalid key length")
+            persistent_key = bytes(persistent_key)
+            if (protection_class, persistent_key) not in cache:
+                missing.append(persistent_key)
+        if missing:
+            missing = list(dict.fromkeys(missing))
+            for persistent_key, key in zip(missing, _AESUnwrapBatch(self._cipherForClass(protection_class), missing)):
+                cache[(protection_class, persistent_key)] = key
+        return [cache[(protection_class, bytes(persistent_key))] for persistent_key in persistent_keys]
+
+    def _cipherForClass(self, protection_class):
+        cipher = self._classCiphers.get(protection_class)
+        if cipher is None:
+            ck = self.classKeys[protection_class][b"KEY"]
+            cipher = Crypto.Cipher.AES.new(ck, Crypto.Cipher.AES.MODE_ECB)
+            self._classCiphers[protection_class] = cipher
+        return cipher
 
     def printClassKeys(self):
         print("== Keybag")
@@ -132,49 +157,78 @@ def _loopTLVBlocks(blob):
         i += 8 + length
 
 
-def _unpack64bit(s):
-    return struct.unpack(">Q", s)[0]
-
-
-def _pack64bit(s):
-    return struct.pack(">Q", s)
+def _AESUnwrap(kek, wrapped):
+    return _AESUnwrapBatch(Crypto.Cipher.AES.new(kek, Crypto.Cipher.AES.MODE_ECB), [wrapped])[0]
 
 
-def _AESUnwrap(kek, wrapped):
-    C = []
-    for i in range(len(wrapped)//8):
-        C.append(_unpack64bit(wrapped[i * 8:i * 8 + 8]))
-    n = len(C) - 1
-    R = [0] * (n+1)
-    A = C[0]
+def _AESUnwrapBatch(cipher, wrapped_keys):
+    """RFC 3394 unwrap of many equal-length keys with one AES-ECB object.
 
-    for i in range(1, n+1):
-        R[i] = C[i]
+    Each of the 6*n steps decrypts the matching block of every key in a single ECB call.
+    Returns the unwrapped keys in order, with None for any key that fails the integrity check."""
+    if not wrapped_keys:
+        return []
+    n = len(wrapped_keys[0]) // 8 - 1
+    if any(len(wrapped) != (n + 1) * 8 for wrapped in wrapped_keys):
+        raise Exception("Wrapped keys in a batch must all be the same length")
+    A = [int.from_bytes(wrapped[:8], "big") for wrapped in wrapped_keys]
+    R = [[wrapped[i * 8:i * 8 + 8] for i in range(n + 1)] for wrapped in wrapped_keys]
+    keys = range(len(wrapped_keys))
 
     for j in reversed(range(0, 6)):
         for i in reversed(range(1, n+1)):
-            todec = _pack64bit(A ^ (n * j + i))
-            todec += _pack64bit(R[i])
-            B = Crypto.Cipher.AES.new(kek, Crypto.Cipher.AES.MODE_ECB).decrypt(todec)
-            A = _unpack64bit(B[:8])
-            R[i] = _unpack64bit(B[8:])
+            t = n * j + i
+            B = cipher.decrypt(b"".join([(A[k] ^ t).to_bytes(8, "big") + R[k][i] for k in keys]))
+            for k in keys:
+                A[k] = int.from_bytes(B[k * 16:k * 16 + 8], "big")
+                R[k][i] = B[k * 16 + 8:k * 16 + 16]
 
-    if A != 0xa6a6a6a6a6a6a6a6:
-        return None
-    res = b"".join(map(_pack64bit, R[1:]))
-    return res
+    return [b"".join(R[k][1:]) if A[k] == 0xa6a6a6a6a6a6a6a6 else None for k in keys]
 
 
 def AESdecryptCBC(data, key, iv=b"\x00" * 16):
     if len(data) % 16:
         print("WARN: AESdecryptCBC: data length not /16, truncating")
-        data = data[0:(len(data)/16) * 16]
+        data = data[0:(len(data)//16) * 16]
     data = Crypto.Cipher.AES.new(key, Crypto.Cipher.AES.MODE_CBC, iv).decrypt(data)
     return data
 
 
+def AESdecryptCBCStream(infile, outfile, key, iv=b"\x00" * 16, chunk_size=1024 * 1024, remove_padding=True, size=None):
+    """Decrypt infile into outfile chunk_size bytes at a time, returning the number of bytes written.
+
+    The last ciphertext block of each chunk is carried over as the IV of the next one, and padding
+    is only stripped from the final chunk. When the plaintext size is known, the output is cut to it.
+    """
+    chunk_size = max(16, chunk_size - chunk_size % 16)
+    written = 0
+    pending = b""
+    while True:
+        data = infile.read(chunk_size)
+        if not data:
+            break
+        if len(data) % 16:
+            print("WARN: AESdecryptCBCStream: data length not /16, truncating")
+            data = data[0:(len(data)//16) * 16]
+            if not data:
+                break
+        # Hold back the latest chunk until we know whether it is the last one:
+        if pending:
+            outfile.write(pending)
+            written += len(pending)
+        pending = Crypto.Cipher.AES.new(key, Crypto.Cipher.AES.MODE_CBC, iv).decrypt(data)
+        iv = data[-16:]
+    if pending and remove_padding:
+        pending = removePadding(pending)
+    if size is not None:
+        pending = pending[:max(0, size - written)]
+    outfile.write(pending)
+    written += len(pending)
+    return written
+
+
 def removePadding(data, blocksize=16):
     n = int(data[-1])  # RFC 1423: last byte contains number of padding bytes.
     if n > blocksize or n > len(data):
-        raise Exception('Invalid CBC padding')
+        raise ValueError('Invalid CBC padding')
     return data[:-n]
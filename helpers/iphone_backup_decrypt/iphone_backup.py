@@ -9,11 +9,46 @@ import biplist
 from . import google_iphone_dataprotection
 
 
+# Files are decrypted this many bytes at a time, so memory use does not depend on file size:
+DECRYPT_CHUNK_SIZE = 1024 * 1024
+
+
+class _HashingWriter:
+    # Passes writes through to a file while feeding the same bytes to a hash object:
+    def __init__(self, outfile, hasher):
+        self._outfile = outfile
+        self._hasher = hasher
+
+    def write(self, data):
+        self._hasher.update(data)
+        return self._outfile.write(data)
+
+
+def decrypt_file_to(source_path, dest_path, key, size=None, chunk_size=DECRYPT_CHUNK_SIZE, hasher=None):
+    """
+    Decrypt one file from an encrypted backup to dest_path, reading and writing chunk_size bytes at a time.
+
+    Backup files are AES-256-CBC with a zero IV and PKCS#7 padding.
+    This is a plain module-level function so it can be run in a worker process.
+
+    :param key: the unwrapped per-file key, see EncryptedBackup.unwrap_file_key()
+    :param size: the plaintext size from the file's metadata. If known the output is cut to it,
+        otherwise the padding is stripped.
+    :param hasher: optional object with an update() method, fed the plaintext as it is written.
+    :return: the number of bytes written.
+    """
+    with open(source_path, 'rb') as infile, open(dest_path, 'wb') as outfile:
+        if hasher is not None:
+            outfile = _HashingWriter(outfile, hasher)
+        return google_iphone_dataprotection.AESdecryptCBCStream(infile, outfile, key, chunk_size=chunk_size,
+                                                               remove_padding=size is None, size=size)
+
+
 # Based on https://stackoverflow.com/questions/1498342/how-to-decrypt-an-encrypted-apple-itunes-iphone-backup
 # and code sample provided by @andrewdotn in this answer: https://stackoverflow.com/a/13793043
 class EncryptedBackup:
 
-    def __init__(self, backup_directory, passphrase, outputdir, log):
+    def __init__(self, backup_directory, passphrase, outputdir, log, key_cache=None):
         """
         Decrypt an iOS 13 encrypted backup using the passphrase chosen in iTunes.
 
@@ -34,6 +69,9 @@ class EncryptedBackup:
         :param passphrase:
             The passphrase chosen in iTunes when first choosing to encrypt backups.
             If it requires an encoding other than ASCII or UTF-8, a bytes object must be provided.
+        :param key_cache:
+            An optional KeyCache. Unlocked class keys are read from it when present, skipping the
+            passphrase key derivation, and written to it after a successful unlock otherwise.
         """
         # Public state:
         self.decrypted = False
@@ -46,6 +84,7 @@ class EncryptedBackup:
         self._manifest_db_path = os.path.join(self._backup_directory, 'Manifest.db')
         self._keybag = None
         self._unlocked = False
+        self._key_cache = key_cache
         self.log = log
 
         self._output = outputdir
@@ -67,14 +106,52 @@ class EncryptedBackup:
         with open(self._manifest_plist_path, 'rb') as infile:
             self._manifest_plist = biplist.readPlist(infile)
         self._keybag = google_iphone_dataprotection.Keybag(self._manifest_plist['BackupKeyBag'])
-        # Attempt to unlock the Keybag:
-        self._unlocked = self._keybag.unlockWithPassphrase(self._passphrase)
-        if not self._unlocked:
-            raise ValueError("Failed to decrypt keys: incorrect passphrase?")
+        # Try the key cache before the expensive passphrase derivation:
+        if self._key_cache is not None and self._key_cache.load(self._keybag, self._passphrase):
+            self.log.info("Unlocked keybag from the key cache at: " + self._key_cache.path)
+            self._unlocked = True
+        else:
+            # Attempt to unlock the Keybag:
+            self._unlocked = self._keybag.unlockWithPassphrase(self._passphrase)
+            if not self._unlocked:
+                raise ValueError("Failed to decrypt keys: incorrect passphrase?")
+            if self._key_cache is not None:
+                self._key_cache.store(self._keybag, self._passphrase)
+                self.log.info("Saved unlocked keys to the key cache at: " + self._key_cache.path)
         # No need to keep the passphrase any more:
         self._passphrase = None
         return True
 
+    def unwrap_file_key(self, protection_class, encryption_key):
+        """
+        Return the AES key for a single file in the backup.
+
+        :param protection_class: the 'ProtectionClass' from the file's MBFile metadata.
+        :param encryption_key: the raw 'EncryptionKey' NSData from the file's MBFile metadata,
+            which is a 4 byte little-endian class followed by the wrapped key.
+        """
+        self._read_and_unlock_keybag()
+        return self._keybag.unwrapKeyForClass(protection_class, encryption_key[4:])
+
+    def unwrap_file_keys(self, files):
+        """
+        Return the AES keys for many files at once, in the same order.
+
+        :param files: an iterable of (protection_class, encryption_key) pairs, as for unwrap_file_key().
+            Keys are grouped by protection class and each group is unwrapped in one batch.
+        """
+        self._read_and_unlock_keybag()
+        files = list(files)
+        by_class = {}
+        for index, (protection_class, encryption_key) in enumerate(files):
+            by_class.setdefault(protection_class, []).append(index)
+        keys = [None] * len(files)
+        for protection_class, indexes in by_class.items():
+            unwrapped = self._keybag.unwrapKeysForClass(protection_class, [files[i][1][4:] for i in indexes])
+            for i, key in zip(indexes, unwrapped):
+                keys[i] = key
+        return keys
+
     def _open_temp_database(self):
         # Check that we have successfully decrypted the file:
         if not os.path.exists(self._decrypted_manifest_db_path):
@@ -102,16 +179,18 @@ class EncryptedBackup:
         # Decrypt the Manifest.db index database:
         manifest_key = self._manifest_plist['ManifestKey'][4:]
 
-        self.log.debug("Opening encrypted Manifest.db")
-        with open(self._manifest_db_path, 'rb') as encrypted_db_filehandle:
-            encrypted_db = encrypted_db_filehandle.read()
         manifest_class = struct.unpack('<l', self._manifest_plist['ManifestKey'][:4])[0]
-
         key = self._keybag.unwrapKeyForClass(manifest_class, manifest_key)
-        decrypted_data = google_iphone_dataprotection.AESdecryptCBC(encrypted_db, key)
-        # Write the decrypted Manifest.db temporarily to disk:
-        with open(self._decrypted_manifest_db_path, 'wb') as decrypted_db_filehandle:
-            decrypted_db_filehandle.write(decrypted_data)
+
+        # Stream the decrypted Manifest.db to disk a chunk at a time rather than holding it in memory:
+        self.log.debug("Opening encrypted Manifest.db")
+        try:
+            with open(self._manifest_db_path, 'rb') as encrypted_db_filehandle, \
+                    open(self._decrypted_manifest_db_path, 'wb') as decrypted_db_filehandle:
+                google_iphone_dataprotection.AESdecryptCBCStream(encrypted_db_filehandle, decrypted_db_filehandle,
+                                                                 key, chunk_size=DECRYPT_CHUNK_SIZE)
+        except ValueError:
+            raise ConnectionError("Manifest.db could not be decrypted. Do you have the right password?")
         # Open the temporary database to verify decryption success:
         if not self._open_temp_database():
             raise ConnectionError("Manifest.db could not be decrypted. Do you have the right password?")
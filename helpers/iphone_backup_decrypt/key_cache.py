@@ -0,0 +1,126 @@
+import os.path
+import sqlite3
+import struct
+import time
+from hashlib import sha256
+
+import Crypto.Cipher.AES
+
+try:
+    from fastpbkdf2 import pbkdf2_hmac  # Prefer a fast, C++ implementation;
+except ImportError:
+    from hashlib import pbkdf2_hmac  # but settle for a standard library one if necessary!
+
+
+__all__ = ["KeyCache", "DEFAULT_KEY_CACHE_PATH"]
+
+
+DEFAULT_KEY_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".iTunes_Backup_Reader", "key_cache.db")
+
+# Deriving the cache key is meant to be cheap compared with the keybag's own 10 million rounds,
+# but it still has to be brute forced per passphrase guess:
+_CACHE_KDF_ITERATIONS = 200000
+_CLASS_KEY = struct.Struct(">LH")
+
+
+class KeyCache:
+
+    def __init__(self, path=DEFAULT_KEY_CACHE_PATH):
+        """
+        Opt-in on-disk cache of unlocked keybag class keys, so repeat runs against the same encrypted
+        backup skip the PBKDF2 rounds in Keybag.unlockWithPassphrase().
+
+        Entries are looked up by the keybag's UUID and salts and are sealed with AES-GCM under a key
+        derived from the backup passphrase, so the passphrase is still needed to use them. Anyone holding
+        the cache file can test passphrase guesses much faster than against the backup itself, which is
+        why it is only used when asked for and can be removed with purge().
+
+        :param path:
+            Where the SQLite cache lives, created on first store.
+        """
+        self.path = path
+
+    @staticmethod
+    def _entry_id(keybag):
+        return sha256(keybag.uuid + keybag.attrs[b"SALT"] + keybag.attrs.get(b"DPSL", b"")).hexdigest()
+
+    @staticmethod
+    def _sealing_key(passphrase, keybag, salt):
+        return pbkdf2_hmac('sha256', passphrase, salt + keybag.uuid, _CACHE_KDF_ITERATIONS, 32)
+
+    def _connect(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        new = not os.path.exists(self.path)
+        conn = sqlite3.connect(self.path)
+        if new:
+            try:
+                os.chmod(self.path, 0o600)
+            except OSError:
+                pass
+        conn.execute("CREATE TABLE IF NOT EXISTS ClassKeys (Id TEXT PRIMARY KEY, Salt BLOB, Nonce BLOB, "
+                     "Tag BLOB, Sealed BLOB, Created INTEGER)")
+        return conn
+
+    def load(self, keybag, passphrase):
+        """
+        Fill in the class keys of keybag from the cache.
+
+        :return: True if a matching entry was found and opened with this passphrase, False otherwise.
+        """
+        if not os.path.exists(self.path):
+            return False
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT Salt, Nonce, Tag, Sealed FROM ClassKeys WHERE Id = ?",
+                               (self._entry_id(keybag),)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return False
+        salt, nonce, tag, sealed = row
+        cipher = Crypto.Cipher.AES.new(self._sealing_key(passphrase, keybag, salt), Crypto.Cipher.AES.MODE_GCM,
+                                       nonce=nonce)
+        try:
+            blob = cipher.decrypt_and_verify(sealed, tag)
+        except ValueError:
+            # Wrong passphrase, or the entry has been tampered with:
+            return False
+
+        class_keys = {}
+        i = 0
+        while i < len(blob):
+            protection_class, length = _CLASS_KEY.unpack_from(blob, i)
+            i += _CLASS_KEY.size
+            class_keys[protection_class] = blob[i:i + length]
+            i += length
+        if any(protection_class not in keybag.classKeys for protection_class in class_keys):
+            return False
+        for protection_class, key in class_keys.items():
+            keybag.classKeys[protection_class][b"KEY"] = key
+        return True
+
+    def store(self, keybag, passphrase):
+        """Seal the unlocked class keys of keybag into the cache, replacing any older entry."""
+        blob = b"".join(_CLASS_KEY.pack(protection_class, len(classkey[b"KEY"])) + classkey[b"KEY"]
+                        for protection_class, classkey in keybag.classKeys.items() if b"KEY" in classkey)
+        salt = os.urandom(16)
+        cipher = Crypto.Cipher.AES.new(self._sealing_key(passphrase, keybag, salt), Crypto.Cipher.AES.MODE_GCM)
+        sealed, tag = cipher.encrypt_and_digest(blob)
+        conn = self._connect()
+        try:
+            conn.execute("INSERT OR REPLACE INTO ClassKeys VALUES (?, ?, ?, ?, ?, ?)",
+                         (self._entry_id(keybag), salt, cipher.nonce, tag, sealed, int(time.time())))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def purge(self):
+        """Delete the cache file. Returns True if there was one to delete."""
+        removed = False
+        for path in (self.path, self.path + "-journal"):
+            if os.path.exists(path):
+                os.remove(path)
+                removed = True
+        return removed
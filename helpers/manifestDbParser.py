@@ -9,16 +9,21 @@
 from __future__ import unicode_literals
 from __future__ import print_function
 import helpers.deserializer as deserializer
+from helpers.mbfileDecoder import decodeMBFile
 from biplist import *
 import logging
 import plistlib
 import datetime
 import io
 import os
-import re
-import errno
 import sqlite3
-from pathlib_revised import Path2
+from helpers.recreatePool import RecreatePool
+from helpers.recreationJournal import RecreationJournal
+from helpers.metadataSink import MetadataSink
+from helpers.dirCache import ensureDir, planDirs
+from helpers.pathMapper import recreatedPath
+from helpers.evidenceHash import recordDigests, writeHashManifest
+from helpers.runMetrics import METRICS
 
 
 def ReadUnixTime(unix_time): # Unix timestamp is time epoch beginning 1970/1/1
@@ -34,14 +39,11 @@ def ReadUnixTime(unix_time): # Unix timestamp is time epoch beginning 1970/1/1
 
 def createFolder(folderPath, logger):
 
-    if not os.path.exists(folderPath):
-
-        try:
-            fixedFolderPath = Path2(folderPath)
-
-            Path2(fixedFolderPath).makedirs()
-        except Exception as ex:
-            logger.exception("Could not make root directory: " + folderPath + "\nError was: " + str(ex))
+    '''Goes through the directory cache, so a folder is only ever created (or found to exist) once per run'''
+    try:
+        ensureDir(folderPath)
+    except Exception as ex:
+        logger.exception("Could not make root directory: " + folderPath + "\nError was: " + str(ex))
 
 def OpenDb(inputPath, logger):
     try:
@@ -53,8 +55,10 @@ def OpenDb(inputPath, logger):
     return None
 
 
-'''Ingests all files/folders/plists'''
-def recreate(fileId, domain, relativePath, fType, root, sourceDir, logger, a_time, m_time):
+'''Ingests all files/folders/plists. Returns True when a file was handed to the pool along with its Metadata row,
+   which then comes back through pool.takeRows() once the copy is done'''
+def recreate(fileId, domain, relativePath, fType, root, sourceDir, logger, a_time, m_time, pool=None, key=None,
+             size=None, row=None):
 
     '''Fields with types of 4 have not been found in backups to my knowledge'''
     if fType == 4:
@@ -68,45 +72,38 @@ def recreate(fileId, domain, relativePath, fType, root, sourceDir, logger, a_tim
 
     '''Fields with types of 2 are Folders'''
     if fType == 2:
-        logger.debug("Trying to recreate directory: " + domain + "\\" + relativePath + " from source file: " + fileId)
+        logger.debug("Trying to recreate directory: " + domain + "/" + relativePath + " from source file: " + fileId)
         try:
             recreateFolder(domain, relativePath, root, logger)
-            logger.debug("Successfully recreated directory: " + domain + "\\" + relativePath + " from source file: " + fileId)
+            logger.debug("Successfully recreated directory: " + domain + "/" + relativePath + " from source file: " + fileId)
         except Exception as ex:
             logger.exception("Failed to recreate directory: " + relativePath + " from source file: "
                               + fileId + " Exception was: " + str(ex))
 
     '''Fields with types of 1 are Files'''
     if fType == 1:
-        logger.debug("Trying to recreate file: " + domain + "\\"  + relativePath + " from source file: " + fileId)
+        logger.debug("Trying to recreate file: " + domain + "/" + relativePath + " from source file: " + fileId)
         try:
-            recreateFile(fileId, domain, relativePath, root, sourceDir, logger, a_time, m_time)
-            logger.debug(
-                "Successfully recreated file: " + domain + "\\" + relativePath + " from source file: " + fileId)
+            recreateFile(fileId, domain, relativePath, root, sourceDir, logger, a_time, m_time, pool, key, size, row)
+            return True
         except Exception as ex:
+            METRICS.count("errors")
             logger.exception("Failed to recreate file: " + relativePath + " from source file: "
                               + fileId + " Exception was: " + str(ex))
+    return False
 
 
 '''Recreates the folder structures in the output directory based on type = 2'''
 def recreateFolder(domain, relativePath, root, logger):
 
     '''If the relative path is empty, then the domain is the root folder'''
-    domain = re.sub('[<>:"|?*]', '_', domain)
-    relativePath = re.sub('[<>:"|?*]', '_', relativePath)
-    relativePath = relativePath.replace("/", "\\")
-    if not relativePath:
-        newFolder = os.path.join(root, domain)
-        createFolder(newFolder, logger)
-
-    else:
-        newFolder = os.path.join(root, domain, relativePath)
-        createFolder(newFolder, logger)
+    createFolder(recreatedPath(root, domain, relativePath), logger)
 
 
 
 '''Recreates the file structures in the output directory based on type = 3'''
-def recreateFile(fileId, domain, relativePath, root, sourceDir, logger, a_time, m_time):
+def recreateFile(fileId, domain, relativePath, root, sourceDir, logger, a_time, m_time, pool, key=None, size=None,
+                 row=None):
 
 
     '''Source file created from taking first two characters of fileID,
@@ -114,108 +111,238 @@ def recreateFile(fileId, domain, relativePath, root, sourceDir, logger, a_time,
     subFolder = fileId[0:2]
     sourceFile = os.path.join(sourceDir, subFolder, fileId)
 
-    '''Gets rid of folder slashes and replaces with backslashes, offending characters with underscores'''
-    sanitizedRelPath = relativePath.replace("/", "\\")
-    sanitizedRelPath = re.sub('[<>:"|?*]', '_', sanitizedRelPath)
-    destFile = os.path.join(root, domain, sanitizedRelPath)
+    destFile = recreatedPath(root, domain, relativePath)
 
+    '''The worker pool copies it, decrypting when given the file's key, and reports failures itself'''
+    pool.submit(sourceFile, destFile, a_time, m_time, key, size, fileId, domain + "/" + relativePath, row=row)
 
-    if not os.path.exists(os.path.dirname(destFile)):
-        try:
-            os.makedirs(os.path.dirname(destFile))
-        except OSError as exc:  # Guard against race condition
-            if exc.errno != errno.EEXIST:
-                raise
+'''Folder in the device folder the file structure is recreated in'''
+ROOT_NAME = "Recreated_File_Structure"
 
-    '''Tries to copy all the files to their recreated directory'''
-    try:
-        logger.debug("Trying to copy " + sourceFile + " to " + destFile)
-        Path2(sourceFile).copyfile(Path2(destFile))
-        logger.debug("Successfully copied " + sourceFile + " to " + destFile)
-        try:
-            os.utime(destFile, (a_time, m_time))
-        except:
-            pass # silently fail
-    except Exception as ex:
-        logger.exception("Could not complete copy " + sourceFile + " to " + destFile + " Exception was: " + str(ex))
+'''Rows fetched from Manifest.db per batch, each batch goes through every stage before the next is fetched'''
+FETCH_BATCH = 1000
 
-''' Main function for parsing Manifest.db
-    Needs a connection to database, executes SQL, and calls on other functions to recreate folder structure'''
-def readManiDb(manifestPath, sourceDir, outputDir, logger):
 
-    '''Creates Root folder for recreated file structure'''
-    root = os.path.join(outputDir, "Recreated_File_Structure")
-    createFolder(root, logger)
+'''Stage 1, fetches the selected Files rows in batches ordered by path. Ordering by (domain, relativePath)
+   keeps directory creation and writes sequential and the fetchmany batches keep memory bounded'''
+def fetchRows(conn, manifestPath, logger, file_filter=None, batch_size=FETCH_BATCH):
+    where, params = filterWhere(file_filter)
+    query = '''SELECT fileId, domain, relativePath, flags, file FROM files''' + where + " ORDER BY domain, relativePath"
 
-    conn = OpenDb(manifestPath, logger)
     c = conn.cursor()
-    query = '''SELECT fileId, domain, relativePath, flags, file FROM files'''
     try:
         logger.debug("Trying to execute query: " + query + " against database " + manifestPath)
-        c.execute(query)
+        c.execute(query, params)
         logger.debug("Successfully executed query: " + query + " against database " + manifestPath)
-
     except Exception as ex:
         logger.exception("Could not execute query: " + query + " against database " + manifestPath
                           + " Exception was: " + str(ex))
-    file_meta_list = []
-    for fileListing in c:
-        fileId = fileListing[0]
-        domain = fileListing[1]
-        relativePath = fileListing[2]
-        fType = fileListing[3]
-        info = getFileInfo(fileListing[4])
-        ea = info.get('ExtendedAttributes', None)
-        if ea:
-            ea = bytes(ea)
-
-        file_meta_list.append([ (domain + "/" + relativePath) if relativePath else domain, 
-                                ReadUnixTime(info.get('LastModified', None)), 
-                                ReadUnixTime(info.get('LastStatusChange', None)), ReadUnixTime(info.get('Birth', None)),
-                                info.get('Size', None), info.get('InodeNumber', None), info.get('Flags', None), 
-                                info.get('UserID', None), info.get('UserID', None),
-                                info.get('Mode', None), info.get('ProtectionClass', None), ea
-                                ])
-        if len(file_meta_list) > 50000:
-            WriteMetaDataToDb(file_meta_list, outputDir, logger)
-            file_meta_list = []
-        try:
-            recreate(fileId, domain, relativePath, fType, root, sourceDir, logger, info.get('LastStatusChange', 0), info.get('LastModified', 0))
-        except Exception as ex:
-            logger.exception("Recreation failed for file {}/{}".format(domain, relativePath))
+        return
 
-    if len(file_meta_list):
-        WriteMetaDataToDb(file_meta_list, outputDir, logger)
+    while True:
+        with METRICS.stage("manifest_scan"):
+            rows = c.fetchmany(batch_size)
+        if not rows:
+            break
+        yield rows
+    c.close()
 
-def WriteMetaDataToDb(file_meta_list, outputDir, logger):
-    outputFileInfoDb = os.path.join(outputDir, "File_Metadata.db")
-    conn2 = OpenDb(outputFileInfoDb, logger)
 
-    createMetaQuery = "CREATE TABLE IF NOT EXISTS Metadata (RelativePath TEXT, LastModified DATE, " \
-                    "LastStatusChange DATE, Birth DATE, " \
-                    "Size INTEGER, InodeNumber INTEGER, Flags INTEGER, UserID INTEGER, GroupID INTEGER, " \
-                    "Mode INTEGER, ProtectionClass INTEGER, ExtendedAttributes BLOB)"
+'''The WHERE clause, with its leading " WHERE ", and parameters that select the rows file_filter accepts'''
+def filterWhere(file_filter):
+    if file_filter is not None and file_filter.active:
+        where, params = file_filter.sqlWhere()
+        if where:
+            return " WHERE " + where, params
+    return "", []
 
-    try:
-        conn2.execute(createMetaQuery)
-    except sqlite3.Error:
-        logger.exception("Failed to execute query: " + createMetaQuery)
 
+'''Number of rows the run will go through, for the progress line's ETA'''
+def countRows(conn, logger, file_filter=None):
+    where, params = filterWhere(file_filter)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM files" + where, params).fetchone()[0]
+    except Exception as ex:
+        logger.debug("Could not count the rows of the manifest Exception was: " + str(ex))
+        return None
+
+
+'''Plans the recreated directory tree in one pass over the paths only, before any blob is read, and creates
+   each unique directory once. The copies that follow then never have to create a directory themselves.
+   A size range is only known once the MBFile blobs are decoded, planning would create the parent directories of
+   files it later rejects, so with one the directories are left to be created on demand instead'''
+def planDirectories(conn, root, logger, file_filter=None):
+    if file_filter is not None and file_filter.sizeRange:
+        logger.debug("Not planning the recreated directories, the size range is only checked while copying")
+        return
+    where, params = filterWhere(file_filter)
+    query = '''SELECT domain, relativePath, flags FROM files''' + where
+
+    directories = set()
     try:
-        conn2.executemany('''INSERT INTO Metadata(RelativePath, LastModified, LastStatusChange, Birth, 
-                        Size, InodeNumber, Flags, UserID, GroupID, 
-                        Mode, ProtectionClass, ExtendedAttributes) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)''',
-                        file_meta_list)
+        for domain, relativePath, fType in conn.execute(query, params):
+            if fType == 2:
+                directories.add(recreatedPath(root, domain, relativePath))
+            elif fType == 1:
+                directories.add(os.path.dirname(recreatedPath(root, domain, relativePath)))
+        planDirs(directories)
+    except Exception as ex:
+        '''Not fatal, whatever wasn't created here is created on demand while copying'''
+        logger.exception("Could not plan the recreated directories Exception was: " + str(ex))
+    logger.debug("Planned " + str(len(directories)) + " recreated directories")
+
+
+'''Stage 2, decodes each row's MBFile blob and drops files outside the size range, the one filter SQLite can't
+   apply since the size is inside the blob. Yields batches of [fileId, domain, relativePath, flags, info, key]'''
+def decodeRows(batches, file_filter=None):
+    for rows in batches:
+        decoded = []
+        with METRICS.stage("blob_decode"):
+            for fileId, domain, relativePath, fType, blob in rows:
+                info = getFileInfo(blob)
+                if file_filter is not None and fType == 1 and not file_filter.matchSize(info.get('Size', None)):
+                    continue
+                decoded.append([fileId, domain, relativePath, fType, info, None])
+        yield decoded
+
+
+'''Stage 3 for encrypted backups, unwraps the keys of a whole batch of files at once.
+   A file whose key can't be unwrapped is logged and counted as an error here and keeps a key of None'''
+def unwrapKeys(batches, backup, logger):
+    for files in batches:
+        encrypted = [f for f in files if f[3] == 1 and f[4].get('EncryptionKey')]
+        with METRICS.stage("key_unwrap"):
+            try:
+                keys = backup.unwrap_file_keys([(f[4]['ProtectionClass'], f[4]['EncryptionKey']) for f in encrypted])
+                for f, key in zip(encrypted, keys):
+                    setKey(f, key, logger)
+            except Exception:
+                '''One bad key shouldn't fail the batch, retry file by file so only that file is lost'''
+                METRICS.count("retries", len(encrypted))
+                for f in encrypted:
+                    try:
+                        key = backup.unwrap_file_key(f[4]['ProtectionClass'], f[4]['EncryptionKey'])
+                    except Exception:
+                        METRICS.count("errors")
+                        logger.exception("Could not unwrap the key of file {}/{}".format(f[1], f[2]))
+                        continue
+                    setKey(f, key, logger)
+        yield files
+
+
+def setKey(f, key, logger):
+    '''A key of None failed the RFC 3394 integrity check, the wrapped key doesn't belong to its protection class'''
+    f[5] = key
+    if key is None:
+        METRICS.count("errors")
+        logger.error("Could not unwrap the key of file {}/{}, it failed the integrity check".format(f[1], f[2]))
+
+
+'''A Metadata row for File_Metadata.db from a decoded MBFile.
+   recreated is where the file was recreated, relative to the device folder, or None when it wasn't'''
+def metadataRow(domain, relativePath, info, recreated=None):
+    ea = info.get('ExtendedAttributes', None)
+    if ea:
+        ea = bytes(ea)
+    return [(domain + "/" + relativePath) if relativePath else domain,
+            ReadUnixTime(info.get('LastModified', None)),
+            ReadUnixTime(info.get('LastStatusChange', None)), ReadUnixTime(info.get('Birth', None)),
+            info.get('Size', None), info.get('InodeNumber', None), info.get('Flags', None),
+            info.get('UserID', None), info.get('GroupID', None),
+            info.get('Mode', None), info.get('ProtectionClass', None), ea, recreated]
 
-    except sqlite3.Error:
-        logger.exception("Error filling Metadata table.")
 
-    conn2.commit()
-    conn2.close()
+''' Main function for parsing Manifest.db
+    Runs a generator pipeline over the Files table: fetch -> decode/filter -> unwrap keys -> copy -> metadata sink.
+    Every stage pulls one batch at a time from the one before it and the pool only queues a few copies per worker,
+    so a slow disk holds the whole pipeline back instead of letting rows pile up in memory.
+    backup is the EncryptedBackup for encrypted backups, every file is then decrypted as it is copied.
+    Every finished copy is recorded in the recreation journal, with resume the files an earlier run finished
+    are skipped.
+    link_mode is one of fastCopy.LINK_MODES, encrypted files are always decrypted to a real copy.
+    store_dir is the content addressed blob store to recreate files from, or None.
+    With metadata_only nothing is copied, only File_Metadata.db is written.
+    file_filter is a FileFilter, only the rows it selects are decoded, copied and written to File_Metadata.db.
+    With hash_files every recreated file is hashed as it is copied, into File_Metadata.db and Hash_Manifest.txt.
+    hash_cache is a BlobHashCache answering the digests of blobs an earlier run already hashed, or None'''
+def readManiDb(manifestPath, sourceDir, outputDir, logger, workers=1, backup=None, resume=False, link_mode="copy",
+               store_dir=None, metadata_only=False, file_filter=None, hash_files=False, hash_cache=None):
+
+    '''Creates Root folder for recreated file structure'''
+    root = os.path.join(outputDir, ROOT_NAME)
+    if not metadata_only:
+        createFolder(root, logger)
 
+    conn = OpenDb(manifestPath, logger)
+    journal = None
+    pool = None
+    if not metadata_only:
+        journal = RecreationJournal(outputDir, logger, resume)
+        '''Decryption is CPU bound so it gets worker processes instead of threads'''
+        pool = RecreatePool(workers, logger, processes=backup is not None, journal=journal, link_mode=link_mode,
+                            store_dir=store_dir, hash_files=hash_files, hash_cache=hash_cache)
+    hash_files = hash_files and not metadata_only
+    sink = MetadataSink(outputDir, logger, digests=hash_files)
+
+    if not metadata_only:
+        planDirectories(conn, root, logger, file_filter)
+    METRICS.startProgress(countRows(conn, logger, file_filter) if METRICS.progress is not None else None)
+
+    batches = decodeRows(fetchRows(conn, manifestPath, logger, file_filter), file_filter)
+    if backup is not None and not metadata_only:
+        batches = unwrapKeys(batches, backup, logger)
+
+    for files in batches:
+        for fileId, domain, relativePath, fType, info, key in files:
+            row = metadataRow(domain, relativePath, info)
+            if metadata_only:
+                pass
+            elif key is None and backup is not None and fType == 1 and info.get('EncryptionKey'):
+                '''Its key could not be unwrapped, copying it would only give ciphertext. unwrapKeys logged it'''
+                pass
+            else:
+                '''A file's row waits in the pool until its copy is done, RecreatedPath is cleared if it fails'''
+                try:
+                    if fType in (1, 2):
+                        row[-1] = recreatedPath(ROOT_NAME, domain, relativePath)
+                    if recreate(fileId, domain, relativePath, fType, root, sourceDir, logger,
+                                info.get('LastStatusChange', 0), info.get('LastModified', 0), pool, key,
+                                info.get('Size', None), row):
+                        continue
+                except Exception as ex:
+                    METRICS.count("errors")
+                    logger.exception("Recreation failed for file {}/{}".format(domain, relativePath))
+                    row[-1] = None
+                if fType == 1:
+                    row[-1] = None
+            sink.add(row)
+        METRICS.count("rows", len(files))
+        if pool is not None:
+            sink.addAll(pool.takeRows())
+        if hash_files:
+            recordDigests(pool, sink, outputDir)
+
+    if pool is not None:
+        pool.close()
+        sink.addAll(pool.takeRows())
+        if hash_files:
+            recordDigests(pool, sink, outputDir)
+    if journal is not None:
+        journal.close()
+    conn.close()
+
+    sink.close()
+    if hash_files:
+        writeHashManifest(outputDir, logger)
+    METRICS.finishProgress()
 
 def getFileInfo(plist_blob):
     '''Read the NSKeyedArchive plist, deserialize it and return file metadata as a dictionary'''
+    try:
+        return decodeMBFile(plist_blob)
+    except Exception as ex:
+        logging.debug("Fast MBFile decode failed, falling back to full deserializer: " + str(ex))
+
     info = {}
     try:
         f = io.BytesIO(plist_blob)
@@ -228,6 +355,9 @@ def getFileInfo(plist_blob):
             else:
                 ea = ea['NS.data']
                 info['ExtendedAttributes'] = ea #str(biplist.readPlistFromString(ea))
+        target = info.get('Target', None)
+        if isinstance(target, str) and 'LinkTarget' not in info:
+            info['LinkTarget'] = target.encode("utf-8", "surrogateescape")
     except Exception as ex:
         logging.exception("Failed to parse file metadata from db, exception was: " + str(ex))
 
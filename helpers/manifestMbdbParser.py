@@ -13,63 +13,120 @@
 
 
 
-from helpers.structs import MBDB_HEADER
+from helpers.mbdbReader import readMbdb, MbdbError
+from helpers.recreatePool import RecreatePool
+from helpers.recreationJournal import RecreationJournal
+from helpers.metadataSink import MetadataSink
+from helpers.dirCache import ensureDir
+from helpers.pathMapper import recreatedPath
+from helpers.evidenceHash import recordDigests, writeHashManifest
+from helpers.runMetrics import METRICS, timedIter
+from helpers.manifestDbParser import ReadUnixTime
+import biplist
 import hashlib
-from shutil import copyfile
 import os
 
-'''Recreate mbdb paths'''
-def mbdbParser(manifest_mbdb_path, input_dir, output_dir, logger):
-    manifest_mbdb_handle = open(manifest_mbdb_path, "rb")
-    manifest_mbdb = manifest_mbdb_handle.read()
 
-    '''Parse entire structure using struct MBDB_HEADER in structs.py'''
-    data = MBDB_HEADER.parse(manifest_mbdb)
-
-    '''Create custom output based on device Serial Number'''
-
-
-    '''Check header of file'''
-    if data.Header != "mbdb":
-        logger.error("Manifest.mbdb does not have a valid header of 0xmbdb, is it corrupted?")
-        return
-
-    '''Go through each record, recreating the file structure'''
-    for record in data.Records:
-
-        '''Create domain path if it doesnt exist'''
-        domain = (record.Domain.String).decode("utf-8")
-        domain_path = os.path.join(output_dir + "\\" + str(domain))
-        if os.path.isdir(domain_path):
-            pass
-        else:
+'''Records read between each move of finished digests into File_Metadata.db'''
+DIGESTS_EVERY = 1000
+
+
+'''Builds a Metadata row for an MBDB record, in the same shape readManiDb writes for Manifest.db.
+   recreated is where the record was recreated, relative to the device folder, or None when it wasn't.
+   The three MBDB timestamps are the same three Manifest.db keeps: modified, status change and birth'''
+def recordMetadata(record, recreated=None):
+    relativePath = (record.Domain + "/" + record.Path) if record.Path else record.Domain
+
+    '''MBDB properties are the file's extended attributes, stored as a plist like ExtendedAttributes in Manifest.db'''
+    ea = None
+    if record.Properties:
+        ea = biplist.writePlistToString(dict(record.Properties))
+
+    return [relativePath,
+            ReadUnixTime(record.LastModifiedTime),
+            ReadUnixTime(record.LastAccessedTime), ReadUnixTime(record.CreatedTime),
+            record.Size, record.InodeNumber, None,
+            record.UserID, record.GroupID,
+            record.Mode, record.ProtectionClass, ea, recreated]
+
+
+'''Recreate mbdb paths, writing every record to File_Metadata.db on the way.
+   With metadata_only nothing is copied. file_filter is a FileFilter, records it rejects are skipped entirely.
+   With hash_files every copied file is hashed on the way and its SHA-1 checked against the record's DataHash.
+   hash_cache is a BlobHashCache of the digests earlier runs already computed, or None'''
+def mbdbParser(manifest_mbdb_path, input_dir, output_dir, logger, workers=1, resume=False, link_mode="copy",
+               store_dir=None, metadata_only=False, file_filter=None, hash_files=False, hash_cache=None):
+
+    journal = None
+    pool = None
+    if not metadata_only:
+        journal = RecreationJournal(output_dir, logger, resume)
+        pool = RecreatePool(workers, logger, journal=journal, link_mode=link_mode, store_dir=store_dir,
+                            hash_files=hash_files, hash_cache=hash_cache)
+    hash_files = hash_files and not metadata_only
+    sink = MetadataSink(output_dir, logger, digests=hash_files)
+
+    '''Go through each record as it is read from the memory mapped file, recreating the file structure.
+       The record count isn't known without reading the whole file, so the progress line has no ETA'''
+    METRICS.startProgress()
+    try:
+        for count, record in enumerate(timedIter(readMbdb(manifest_mbdb_path), "manifest_scan"), 1):
+            METRICS.count("rows")
+
+            if file_filter is not None:
+                '''Like Manifest.db the extensions and size range only apply to regular files'''
+                isFile = (record.Mode or 0) & 0xF000 == 0x8000
+                if not file_filter.match(record.Domain, record.Path, isFile):
+                    continue
+                if isFile and not file_filter.matchSize(record.Size):
+                    continue
+
+            if metadata_only:
+                sink.add(recordMetadata(record))
+                continue
+
+            '''Create domain path if it doesnt exist, the directory cache only touches the disk once per domain'''
+            domain = record.Domain
+            path = record.Path
+            domain_path = recreatedPath(output_dir, domain, "")
             try:
-                logger.debug("Trying to create directory: " + domain_path)
-                os.makedirs(domain_path)
-                logger.debug("Successfully created path")
+                ensureDir(domain_path)
             except Exception as ex:
+                METRICS.count("errors")
                 logger.exception("Could not create directory: " + domain_path + " Exception was: " + str(ex))
 
-        path = (record.Path.String).decode("utf-8")
-        domain_hash = domain.encode()
-        path_hash = path.encode()
-        if record.Size != 0:
-
-            fileid = hashlib.sha1( domain_hash + b'-' + path_hash)
-            fileid_hash = fileid.hexdigest()
-            file_path = os.path.join(input_dir, fileid_hash)
-            if os.path.isfile(file_path):
-
-                '''Do some fun reversing strings to get the directory of the path so that we can copy the file properly'''
-                dest_path = os.path.join(output_dir, domain, path)
-                dest_path = dest_path.replace("/", "\\")
-                reversed_dest_path = dest_path[::-1]
-                dest_path_root_reversed = reversed_dest_path.split('\\', 1)[-1]
-                dest_path_root = dest_path_root_reversed[::-1]
-                if os.path.isdir(dest_path_root):
-                    copyfile(file_path, dest_path)
-                else:
-                    os.makedirs(dest_path_root)
-                    copyfile(file_path, dest_path)
-
-
+            recreated = None
+            if record.Size != 0:
+
+                fileid_hash = hashlib.sha1(domain.encode() + b'-' + path.encode()).hexdigest()
+                file_path = os.path.join(input_dir, fileid_hash)
+                if os.path.isfile(file_path):
+                    recreated = recreatedPath("", domain, path)
+                    '''DataHash is the SHA-1 of the file's content'''
+                    expected = record.DataHash.hex() if record.DataHash and len(record.DataHash) == 20 else None
+                    '''The row comes back through takeRows() when the copy is done, without RecreatedPath on failure'''
+                    pool.submit(file_path, os.path.join(output_dir, recreated), record.LastAccessedTime,
+                                record.LastModifiedTime, fileId=fileid_hash, relativePath=domain + "/" + path,
+                                expected_sha1=expected, row=recordMetadata(record, recreated))
+            if recreated is None:
+                sink.add(recordMetadata(record))
+            if count % DIGESTS_EVERY == 0:
+                sink.addAll(pool.takeRows())
+                if hash_files:
+                    recordDigests(pool, sink, output_dir)
+
+    except MbdbError as ex:
+        METRICS.count("errors")
+        logger.error(str(ex))
+    finally:
+        if pool is not None:
+            pool.close()
+            sink.addAll(pool.takeRows())
+            if hash_files:
+                recordDigests(pool, sink, output_dir)
+        if journal is not None:
+            journal.close()
+        sink.close()
+        if hash_files:
+            writeHashManifest(output_dir, logger)
+        METRICS.finishProgress()
@@ -0,0 +1,115 @@
+'''
+   Copyright (c) 2019 Jack Farley
+   This file is part of iTunes_Backup_Reader
+   Usage or distribution of this software/code is subject to the
+   terms of the GNU GENERAL PUBLIC LICENSE.
+   mbdbReader.py
+   ------------
+
+   Streams records out of a memory mapped Manifest.mbdb one at a time,
+   so nothing but the current record is ever held in memory.
+
+   Parsing MBDB made possible by:
+   https://www.securitylearn.net/2012/05/05/iphone-backup-mbdb-file-structure/
+'''
+
+import mmap
+import struct
+
+
+MBDB_MAGIC = b"mbdb"
+
+'''Magic plus the two version bytes'''
+MBDB_HEADER_SIZE = 6
+
+'''Length value used by MBDB for an empty/absent string'''
+MBDB_EMPTY_STRING = 0xFFFF
+
+_U16 = struct.Struct(">H")
+
+'''Mode, inode, UserID, GroupID, LastModified, LastAccessed, Created, Size, ProtectionClass, PropertyCount'''
+_FIXED = struct.Struct(">HQIIIIIQBB")
+
+
+class MbdbError(Exception):
+    pass
+
+
+class MbdbRecord:
+    '''One file/folder entry from Manifest.mbdb. Domain and Path are str, the other strings raw bytes or None'''
+
+    __slots__ = ("Domain", "Path", "LinkTarget", "DataHash", "EncryptionKey", "Mode", "InodeNumber",
+                 "UserID", "GroupID", "LastModifiedTime", "LastAccessedTime", "CreatedTime", "Size",
+                 "ProtectionClass", "Properties")
+
+    def __repr__(self):
+        return "MbdbRecord(" + str(self.Domain) + ", " + str(self.Path) + ")"
+
+
+def _readString(buf, pos):
+    '''MBDB strings are a big endian 16 bit length followed by that many bytes, 0xFFFF means empty'''
+    if pos + 2 > len(buf):
+        raise MbdbError("String length at offset " + str(pos) + " runs past the end of the file")
+    length = _U16.unpack_from(buf, pos)[0]
+    pos += 2
+    if length == MBDB_EMPTY_STRING:
+        return None, pos
+    end = pos + length
+    if end > len(buf):
+        raise MbdbError("String at offset " + str(pos - 2) + " runs past the end of the file")
+    return buf[pos:end], end
+
+
+def _decode(value):
+    if value is None:
+        return ""
+    return value.decode("utf-8", "replace")
+
+
+def iterRecords(buf):
+    '''Yields an MbdbRecord for each entry in a buffer holding a whole Manifest.mbdb'''
+    if buf[:4] != MBDB_MAGIC:
+        raise MbdbError("Manifest.mbdb does not have a valid header of 0xmbdb, is it corrupted?")
+
+    pos = MBDB_HEADER_SIZE
+    end = len(buf)
+    while pos < end:
+        record = MbdbRecord()
+        domain, pos = _readString(buf, pos)
+        path, pos = _readString(buf, pos)
+        record.LinkTarget, pos = _readString(buf, pos)
+        record.DataHash, pos = _readString(buf, pos)
+        record.EncryptionKey, pos = _readString(buf, pos)
+        record.Domain = _decode(domain)
+        record.Path = _decode(path)
+
+        if pos + _FIXED.size > end:
+            raise MbdbError("Record at offset " + str(pos) + " is truncated")
+        (record.Mode, record.InodeNumber, record.UserID, record.GroupID, record.LastModifiedTime,
+         record.LastAccessedTime, record.CreatedTime, record.Size, record.ProtectionClass,
+         propertyCount) = _FIXED.unpack_from(buf, pos)
+        pos += _FIXED.size
+
+        properties = None
+        if propertyCount:
+            properties = []
+            for _ in range(propertyCount):
+                name, pos = _readString(buf, pos)
+                value, pos = _readString(buf, pos)
+                properties.append((_decode(name), value))
+        record.Properties = properties
+        yield record
+
+
+def readMbdb(manifest_mbdb_path):
+    '''Memory maps Manifest.mbdb and yields its records, the file is unmapped once iteration finishes'''
+    with open(manifest_mbdb_path, "rb") as handle:
+        try:
+            buf = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise MbdbError("Manifest.mbdb is empty")
+        try:
+            for record in iterRecords(buf):
+                yield record
+        finally:
+            buf.close()
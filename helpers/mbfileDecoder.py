@@ -0,0 +1,165 @@
+'''
+   Copyright (c) 2019 Jack Farley
+   This file is part of iTunes_Backup_Reader
+   Usage or distribution of this software/code is subject to the
+   terms of the GNU GENERAL PUBLIC LICENSE.
+   mbfileDecoder.py
+   ------------
+
+   Decodes the NSKeyedArchiver MBFile blob stored in the "file" column of Manifest.db.
+   The generic deserializer parses every blob twice and rebuilds the whole object graph,
+   this reads the bplist once and only pulls out the fields the recreator uses.
+'''
+
+import struct
+
+
+'''Scalar fields copied straight out of the MBFile object'''
+SCALAR_FIELDS = frozenset(("LastModified", "LastStatusChange", "Birth", "Size", "InodeNumber", "Flags",
+                           "UserID", "GroupID", "Mode", "ProtectionClass"))
+
+'''Fields that point at an NSData object, returned as raw bytes'''
+DATA_FIELDS = frozenset(("EncryptionKey", "ExtendedAttributes"))
+
+'''Fields that point at an NSString object, returned as UTF-8 bytes under the name Manifest.mbdb records use'''
+STRING_FIELDS = {"Target": "LinkTarget"}
+
+_TRAILER = struct.Struct(">6xBBQQQ")
+_FLOAT = struct.Struct(">f")
+_DOUBLE = struct.Struct(">d")
+
+
+class MBFileError(Exception):
+    pass
+
+
+class _UID(int):
+    '''Object reference (CF$UID) inside an NSKeyedArchiver plist'''
+    pass
+
+
+def _readInt(blob, pos, size):
+    return int.from_bytes(blob[pos:pos + size], "big")
+
+
+def _readLength(blob, pos, low):
+    '''Returns the length of a string/data/collection object and the offset of its first byte'''
+    if low != 0xF:
+        return low, pos + 1
+    marker = blob[pos + 1]
+    if marker >> 4 != 0x1:
+        raise MBFileError("Bad length marker at offset " + str(pos))
+    size = 1 << (marker & 0xF)
+    return _readInt(blob, pos + 2, size), pos + 2 + size
+
+
+class _Bplist:
+    '''Just enough of a bplist00 reader to walk an NSKeyedArchiver object table'''
+
+    __slots__ = ("blob", "offsetSize", "refSize", "count", "top", "tableOffset")
+
+    def __init__(self, blob):
+        if blob[:8] != b"bplist00":
+            raise MBFileError("Bad file header")
+        self.blob = blob
+        self.offsetSize, self.refSize, self.count, self.top, self.tableOffset = _TRAILER.unpack_from(blob, len(blob) - 32)
+
+    def offsetOf(self, index):
+        if index >= self.count:
+            raise MBFileError("Object reference " + str(index) + " out of range")
+        pos = self.tableOffset + index * self.offsetSize
+        return _readInt(self.blob, pos, self.offsetSize)
+
+    def refs(self, index):
+        '''Returns (refs, None) for an array or (key refs, value refs) for a dictionary'''
+        blob = self.blob
+        pos = self.offsetOf(index)
+        marker = blob[pos]
+        kind = marker >> 4
+        count, pos = _readLength(blob, pos, marker & 0xF)
+        size = self.refSize
+        if kind == 0xA:
+            return [_readInt(blob, pos + i * size, size) for i in range(count)], None
+        if kind == 0xD:
+            keys = [_readInt(blob, pos + i * size, size) for i in range(count)]
+            pos += count * size
+            values = [_readInt(blob, pos + i * size, size) for i in range(count)]
+            return keys, values
+        raise MBFileError("Object " + str(index) + " is not a collection")
+
+    def dictionary(self, index):
+        '''Returns {key string: value ref} for a dictionary object'''
+        keys, values = self.refs(index)
+        if values is None:
+            raise MBFileError("Object " + str(index) + " is not a dictionary")
+        return dict(zip([self.scalar(k) for k in keys], values))
+
+    def scalar(self, index):
+        '''Decodes any non-collection object'''
+        blob = self.blob
+        pos = self.offsetOf(index)
+        marker = blob[pos]
+        kind = marker >> 4
+        low = marker & 0xF
+        if kind == 0x1:
+            size = 1 << low
+            return int.from_bytes(blob[pos + 1:pos + 1 + size], "big", signed=size >= 8)
+        if kind == 0x8:
+            return _UID(_readInt(blob, pos + 1, low + 1))
+        if kind == 0x5:
+            length, pos = _readLength(blob, pos, low)
+            return blob[pos:pos + length].decode("ascii")
+        if kind == 0x6:
+            length, pos = _readLength(blob, pos, low)
+            return blob[pos:pos + length * 2].decode("utf-16-be")
+        if kind == 0x4:
+            length, pos = _readLength(blob, pos, low)
+            return bytes(blob[pos:pos + length])
+        if kind == 0x2 or kind == 0x3:
+            if low == 2:
+                return _FLOAT.unpack_from(blob, pos + 1)[0]
+            return _DOUBLE.unpack_from(blob, pos + 1)[0]
+        if marker == 0x08:
+            return False
+        if marker == 0x09:
+            return True
+        if marker == 0x00:
+            return None
+        if kind == 0xA or kind == 0xD:
+            raise MBFileError("Object " + str(index) + " is a collection")
+        raise MBFileError("Unsupported object type " + hex(marker))
+
+
+def decodeMBFile(blob):
+    '''Returns the metadata dictionary for one Manifest.db "file" blob.
+       Keys match the ones process_nsa_plist produces, EncryptionKey and ExtendedAttributes are raw bytes.
+       A symlink's Target is returned as LinkTarget bytes, like MbdbRecord.LinkTarget'''
+    plist = _Bplist(blob)
+    top = plist.dictionary(plist.top)
+    objects, _ = plist.refs(top["$objects"])
+    root = plist.scalar(plist.dictionary(top["$top"])["root"])
+    mbfile = plist.dictionary(objects[root])
+
+    info = {}
+    for key, ref in mbfile.items():
+        if key in SCALAR_FIELDS:
+            info[key] = plist.scalar(ref)
+        elif key in DATA_FIELDS:
+            value = plist.scalar(ref)
+            if isinstance(value, _UID):
+                target = objects[value]
+                try:
+                    value = plist.scalar(target)
+                except MBFileError:
+                    '''NSData/NSMutableData archived as a dictionary holding NS.data'''
+                    value = plist.scalar(plist.dictionary(target)["NS.data"])
+                if value == "$null":
+                    value = None
+            info[key] = value
+        elif key in STRING_FIELDS:
+            value = plist.scalar(ref)
+            if isinstance(value, _UID):
+                value = plist.scalar(objects[value])
+            if isinstance(value, str) and value != "$null":
+                info[STRING_FIELDS[key]] = value.encode("utf-8", "surrogateescape")
+    return info
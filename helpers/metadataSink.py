@@ -0,0 +1,157 @@
+'''
+   Copyright (c) 2019 Jack Farley
+   This file is part of iTunes_Backup_Reader
+   Usage or distribution of this software/code is subject to the
+   terms of the GNU GENERAL PUBLIC LICENSE.
+   metadataSink.py
+   ------------
+
+   Batched writer for the Metadata table in File_Metadata.db
+'''
+
+import os
+import sqlite3
+from helpers.runMetrics import METRICS
+
+
+METADATA_DB_NAME = "File_Metadata.db"
+
+'''Rows buffered before each insert transaction'''
+BATCH_SIZE = 50000
+
+CREATE_METADATA_QUERY = "CREATE TABLE IF NOT EXISTS Metadata (RelativePath TEXT, LastModified DATE, " \
+                        "LastStatusChange DATE, Birth DATE, " \
+                        "Size INTEGER, InodeNumber INTEGER, Flags INTEGER, UserID INTEGER, GroupID INTEGER, " \
+                        "Mode INTEGER, ProtectionClass INTEGER, ExtendedAttributes BLOB, RecreatedPath TEXT)"
+
+INSERT_METADATA_QUERY = '''INSERT INTO Metadata(RelativePath, LastModified, LastStatusChange, Birth,
+                        Size, InodeNumber, Flags, UserID, GroupID,
+                        Mode, ProtectionClass, ExtendedAttributes, RecreatedPath) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)'''
+
+CREATE_DIGESTS_QUERY = "CREATE TABLE IF NOT EXISTS Digests (RelativePath TEXT, RecreatedPath TEXT, Size INTEGER, " \
+                       "MD5 TEXT, SHA1 TEXT, SHA256 TEXT, FileType TEXT, ExpectedSHA1 TEXT, Verified INTEGER)"
+
+INSERT_DIGESTS_QUERY = '''INSERT INTO Digests(RelativePath, RecreatedPath, Size, MD5, SHA1, SHA256,
+                       FileType, ExpectedSHA1, Verified) VALUES (?,?,?,?,?,?,?,?,?)'''
+
+'''Built once after the bulk load, building them row by row would slow every insert down'''
+METADATA_INDEXES = ("RelativePath", "Size", "LastModified", "ProtectionClass")
+DIGESTS_INDEXES = ("RelativePath", "SHA256")
+
+
+class MetadataSink:
+    '''Keeps one connection to File_Metadata.db open for the whole run.
+       Rows are buffered and inserted BATCH_SIZE at a time in a single transaction, with WAL and
+       synchronous=NORMAL while loading. close() builds the indexes and switches the database back
+       to a normal rollback journal, so it can be opened on its own from read-only media later.
+       With digests a Digests table holds the hashes of every recreated file, filled through addDigest()'''
+
+    def __init__(self, outputDir, logger, batch_size=BATCH_SIZE, digests=False):
+        self.path = os.path.join(outputDir, METADATA_DB_NAME)
+        self.logger = logger
+        self.batch_size = batch_size
+        self.rows = 0
+        self._buffer = []
+        self._digests = [] if digests else None
+        self._conn = sqlite3.connect(self.path)
+        logger.debug("Opened database: " + self.path + " successfully")
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        try:
+            self._conn.execute(CREATE_METADATA_QUERY)
+        except sqlite3.Error:
+            logger.exception("Failed to execute query: " + CREATE_METADATA_QUERY)
+        if digests:
+            try:
+                self._conn.execute(CREATE_DIGESTS_QUERY)
+            except sqlite3.Error:
+                logger.exception("Failed to execute query: " + CREATE_DIGESTS_QUERY)
+
+    def add(self, row):
+        '''Queues one Metadata row, in the column order of INSERT_METADATA_QUERY'''
+        self._buffer.append(row)
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def addAll(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def addDigest(self, row):
+        '''Queues one Digests row, in the column order of INSERT_DIGESTS_QUERY'''
+        self._digests.append(row)
+        if len(self._digests) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        with METRICS.stage("db_writes"):
+            self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            try:
+                with self._conn:
+                    self._conn.executemany(INSERT_METADATA_QUERY, self._buffer)
+                self.rows += len(self._buffer)
+            except sqlite3.Error:
+                self.logger.exception("Error filling Metadata table.")
+            self._buffer = []
+        if self._digests:
+            try:
+                with self._conn:
+                    self._conn.executemany(INSERT_DIGESTS_QUERY, self._digests)
+            except sqlite3.Error:
+                self.logger.exception("Error filling Digests table.")
+            self._digests = []
+
+    def close(self):
+        '''Writes what is left, builds the indexes and closes the connection'''
+        with METRICS.stage("db_writes"):
+            self._close()
+
+    def _close(self):
+        self._flush()
+        indexes = [("Metadata", column) for column in METADATA_INDEXES]
+        if self._digests is not None:
+            indexes += [("Digests", column) for column in DIGESTS_INDEXES]
+        for table, column in indexes:
+            query = "CREATE INDEX IF NOT EXISTS " + table + "_" + column + " ON " + table + "(" + column + ")"
+            try:
+                self._conn.execute(query)
+            except sqlite3.Error:
+                self.logger.exception("Failed to execute query: " + query)
+        self._conn.commit()
+        self._conn.execute("PRAGMA journal_mode=DELETE")
+        self._conn.close()
+        self.logger.info("Wrote " + str(self.rows) + " rows to " + self.path)
+
+
+def metadataDbFiles(outputDir):
+    '''File_Metadata.db and the WAL files an interrupted run may leave next to it'''
+    path = os.path.join(outputDir, METADATA_DB_NAME)
+    return (path, path + "-wal", path + "-shm")
+
+
+def removeMetadataDb(outputDir):
+    '''Deletes File_Metadata.db along with any WAL files left behind by an interrupted run'''
+    for leftover in metadataDbFiles(outputDir):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+
+
+def resetMetadataDb(outputDir, keep_digests=True):
+    '''Gets File_Metadata.db ready for a resumed run to refill. The Metadata table is always rebuilt, since every
+       row is cheap to redo. The Digests table holds hashes of files the resumed run won't read again, so it is
+       kept unless keep_digests is False. Returns True when a Digests table was kept'''
+    path = os.path.join(outputDir, METADATA_DB_NAME)
+    if not keep_digests or not os.path.exists(path):
+        removeMetadataDb(outputDir)
+        return False
+    conn = sqlite3.connect(path)
+    try:
+        with conn:
+            conn.execute("DROP TABLE IF EXISTS Metadata")
+        return conn.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'Digests'"
+                            ).fetchone()[0] > 0
+    finally:
+        conn.close()
@@ -0,0 +1,69 @@
+'''
+   Copyright (c) 2019 Jack Farley
+   This file is part of iTunes_Backup_Reader
+   Usage or distribution of this software/code is subject to the
+   terms of the GNU GENERAL PUBLIC LICENSE.
+   pathMapper.py
+   ------------
+
+   Maps backup paths (domain + "/" separated relativePath) to where they are recreated on disk.
+   Characters Windows can't store, <>:"|?*, become underscores through one precompiled translation
+   table, "." and ".." components are neutralised so nothing is written outside the output folder,
+   and the platform's own separator is used, real subfolders on Linux and macOS rather than names
+   full of backslashes. Domains and parent directories repeat across many files so they are memoised.
+   The mapping of each file is recorded in File_Metadata.db's RecreatedPath column.
+'''
+
+import functools
+import os
+
+
+'''Characters replaced in every path component, plus the backslash where it is the separator'''
+ILLEGAL_CHARACTERS = '<>:"|?*'
+REPLACEMENT = "_"
+
+_TABLE = str.maketrans(dict.fromkeys(ILLEGAL_CHARACTERS + ("\\" if os.sep == "\\" else ""), REPLACEMENT))
+
+'''A domain is a single folder, so a "/" in one must not start a subfolder'''
+_DOMAIN_TABLE = str.maketrans(dict.fromkeys(ILLEGAL_CHARACTERS + "/\\", REPLACEMENT))
+
+'''Parent directories remembered, a backup has far fewer unique directories than files'''
+DIRECTORY_CACHE_SIZE = 65536
+
+
+def mapComponent(name):
+    '''One path component, never "." or ".." so it can't point anywhere but into its own folder'''
+    if name == "." or name == "..":
+        return REPLACEMENT * len(name)
+    return name.translate(_TABLE)
+
+
+@functools.lru_cache(maxsize=None)
+def mapDomain(domain):
+    return mapComponent(domain.translate(_DOMAIN_TABLE))
+
+
+@functools.lru_cache(maxsize=DIRECTORY_CACHE_SIZE)
+def mapDirectory(relativeDir):
+    '''A "/" separated directory, empty components (leading, trailing or doubled slashes) are dropped'''
+    return os.sep.join(mapComponent(c) for c in relativeDir.split("/") if c)
+
+
+def mapRelativePath(relativePath):
+    '''A relativePath with the platform separator, only the file name is translated for each file'''
+    parent, _, name = relativePath.rpartition("/")
+    name = mapComponent(name) if name else ""
+    parent = mapDirectory(parent) if parent else ""
+    if not parent:
+        return name
+    if not name:
+        return parent
+    return parent + os.sep + name
+
+
+def recreatedPath(root, domain, relativePath):
+    '''Where domain/relativePath is recreated under root, the domain folder itself for an empty relativePath'''
+    mapped = mapRelativePath(relativePath) if relativePath else ""
+    if not mapped:
+        return os.path.join(root, mapDomain(domain))
+    return os.path.join(root, mapDomain(domain), mapped)
@@ -0,0 +1,282 @@
+'''
+   Copyright (c) 2019 Jack Farley
+   This file is part of iTunes_Backup_Reader
+   Usage or distribution of this software/code is subject to the
+   terms of the GNU GENERAL PUBLIC LICENSE.
+   recreatePool.py
+   ------------
+
+   Bounded worker pool used to copy files out of a backup while the
+   manifest is still being read
+'''
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from helpers.iphone_backup_decrypt import decrypt_file_to
+from helpers.fastCopy import placeFile, takeFallbacks, SHARED_INODE_MODES
+from helpers.blobStore import recreateFromStore
+from helpers.dirCache import ensureDir
+from helpers.evidenceHash import Digests, copyHashed, hashFile
+from helpers.runMetrics import METRICS
+
+
+'''How many finished copies between each progress message'''
+PROGRESS_EVERY = 5000
+
+
+'''Copies or links a single blob to its recreated path and restores its timestamps.
+   Hardlinks and symlinks share the evidence file's inode, so their timestamps are left alone'''
+def copyFile(sourceFile, destFile, a_time, m_time, link_mode="copy"):
+    used = placeFile(sourceFile, destFile, link_mode)
+    if used in SHARED_INODE_MODES:
+        return
+    _restoreTimes(destFile, a_time, m_time)
+
+
+def _restoreTimes(destFile, a_time, m_time):
+    try:
+        os.utime(destFile, (a_time, m_time))
+    except:
+        pass  # silently fail
+
+
+'''One copy job, decrypting on the way when given a file key. Runs in worker threads or processes and
+   returns (bytes written, evidence digests), the digests are None unless hash_files is set.
+   With a store_dir the file is recreated as a hardlink into the content addressed store, which many
+   recreated files may share, so timestamps are left to File_Metadata.db.
+   Hashing turns a plain copy into a userspace loop that hashes each chunk as it is written, and a linked
+   file is hashed through its link, so either way the content is only read once.
+   known are the digests the blob hash cache already has for the source, nothing is hashed then'''
+def runJob(sourceFile, destFile, a_time, m_time, key=None, size=None, link_mode="copy", store_dir=None,
+           hash_files=False, known=None):
+    if store_dir is not None:
+        return recreateFromStore(store_dir, sourceFile, destFile, key, size, hash_files, known)
+
+    if known is not None:
+        hash_files = False
+
+    if key is None:
+        if hash_files and link_mode == "copy":
+            written, digests = copyHashed(sourceFile, destFile)
+            _restoreTimes(destFile, a_time, m_time)
+            return written, digests
+        copyFile(sourceFile, destFile, a_time, m_time, link_mode)
+        if hash_files:
+            return hashFile(destFile)
+        return os.path.getsize(destFile), known
+
+    hasher = Digests() if hash_files else None
+    written = decrypt_file_to(sourceFile, destFile, key, size, hasher=hasher)
+    _restoreTimes(destFile, a_time, m_time)
+    return written, hasher.hexdigests() if hasher is not None else known
+
+
+'''Hashes a file an earlier run already recreated, so a resumed run still has digests for every file'''
+def hashJob(destFile, known=None):
+    if known is not None:
+        return os.path.getsize(destFile), known
+    return hashFile(destFile)
+
+
+'''Runs a job and returns (seconds it took, link modes that fell back to a copy, result). Jobs may run in worker
+   processes, so both are handed back to the pool rather than recorded where the job ran'''
+def timedJob(fn, *args):
+    takeFallbacks()
+    started = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - started, takeFallbacks(), result
+
+
+class RecreatePool:
+    '''Runs copy jobs on a bounded pool of threads, or processes when decrypting.
+       The caller keeps reading the manifest and decoding metadata on its own thread,
+       with workers <= 1 every job runs inline so the output matches the serial path exactly.
+       With hash_files every job also returns the file's digests, which the caller collects with takeDigests().
+       A BlobHashCache answers digests of blobs an earlier run already read, and learns the new ones.
+       A job may carry the file's File_Metadata.db row, which comes back through takeRows() once the job is done,
+       with its RecreatedPath cleared when the copy failed'''
+
+    def __init__(self, workers, logger, processes=False, journal=None, link_mode="copy", store_dir=None,
+                 hash_files=False, hash_cache=None):
+        self.workers = max(1, int(workers or 1))
+        self.logger = logger
+        self.journal = journal
+        self.link_mode = link_mode
+        self.store_dir = store_dir
+        self.hash_files = hash_files
+        self.hash_cache = hash_cache
+        '''The blob store hashes every blob anyway, with a cache it may as well keep all the digests'''
+        self._computeDigests = hash_files or (hash_cache is not None and store_dir is not None)
+        self.copied = 0
+        self.failed = 0
+        self.bytes = 0
+        self.mismatches = 0
+        self._digests = []
+        self._rows = []
+        self._lock = threading.Lock()
+        self._executor = None
+        if self.workers > 1:
+            if processes:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                logger.info("Recreating files with " + str(self.workers) + " worker processes")
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers)
+                logger.info("Recreating files with " + str(self.workers) + " workers")
+            '''Only allow a few jobs per worker to be queued so memory stays bounded'''
+            self._slots = threading.BoundedSemaphore(self.workers * 4)
+
+    def submit(self, sourceFile, destFile, a_time, m_time, key=None, size=None, fileId=None, relativePath=None,
+               expected_sha1=None, row=None):
+        '''Queues a copy. Directories are created here, on the caller's thread, so workers never race on them.
+           Passing the file's unwrapped key decrypts it while copying.
+           With a journal, finished copies are recorded by fileId and, when resuming, files an earlier run already
+           finished are skipped.
+           relativePath names the file in its digests, expected_sha1 is a known SHA-1 of the content to check.
+           row is the file's Metadata row, handed back through takeRows() when the job is done'''
+        job = _Job(sourceFile, destFile, fileId, relativePath, expected_sha1, row)
+        known = None
+        if self.hash_cache is not None and self._computeDigests:
+            job.cacheKey, known = self.hash_cache.lookup(sourceFile)
+            job.cached = known is not None
+        if self.journal is not None and fileId is not None and self.journal.isDone(fileId, destFile):
+            self.logger.debug("Already recreated " + destFile + ", skipping")
+            job.hashOnly = True
+            if self.hash_files:
+                job.stage = "hashing"
+                self._run(job, hashJob, destFile, known)
+            else:
+                self._addRow(job, True)
+            return
+        try:
+            ensureDir(os.path.dirname(destFile))
+        except Exception as ex:
+            self._failed(job, ex)
+            return
+        self.logger.debug("Trying to copy " + sourceFile + " to " + destFile)
+        if key is not None:
+            job.stage = "decryption"
+        self._run(job, runJob, sourceFile, destFile, a_time, m_time, key, size, self.link_mode, self.store_dir,
+                  self._computeDigests, known)
+
+    def _run(self, job, fn, *args):
+        if self._executor is None:
+            try:
+                result = timedJob(fn, *args)
+            except Exception as ex:
+                self._failed(job, ex)
+                return
+            self._finished(job, result)
+            return
+
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(timedJob, fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._done(f, job))
+
+    def _done(self, future, job):
+        self._slots.release()
+        ex = future.exception()
+        if ex is not None:
+            self._failed(job, ex)
+        else:
+            self._finished(job, future.result())
+
+    def _failed(self, job, ex):
+        self.logger.error("Could not complete copy " + job.sourceFile + " to " + job.destFile + " Exception was: "
+                          + str(ex), exc_info=ex)
+        with self._lock:
+            self.failed += 1
+        METRICS.count("errors")
+        '''A file that was only being hashed again is still there from the earlier run'''
+        self._addRow(job, job.hashOnly)
+
+    def _finished(self, job, result):
+        seconds, fallbacks, (written, digests) = result
+        METRICS.addTime(job.stage, seconds)
+        if fallbacks:
+            METRICS.count("retries", fallbacks)
+        if digests is not None and self.hash_cache is not None and not job.cached:
+            self.hash_cache.store(job.sourceFile, job.cacheKey, digests)
+        if digests is not None and self.hash_files:
+            self._addDigests(job, written, digests)
+        self._addRow(job, True)
+        if job.hashOnly:
+            return
+        self.logger.debug("Successfully copied " + job.sourceFile + " to " + job.destFile)
+        if self.journal is not None and job.fileId is not None:
+            self.journal.markDone(job.fileId, job.destFile)
+        with self._lock:
+            self.copied += 1
+            self.bytes += written
+            if self.copied % PROGRESS_EVERY == 0:
+                self.logger.info("Recreated " + str(self.copied) + " files (" + str(self.bytes // (1024 * 1024)) + " MB)")
+        METRICS.count("bytes", written)
+        METRICS.count("files")
+
+    def _addDigests(self, job, written, digests):
+        '''Verified is 1 or 0 when there was a SHA-1 to check against, None otherwise'''
+        verified = None
+        if job.expected_sha1:
+            verified = int(digests['sha1'] == job.expected_sha1)
+            if not verified:
+                self.logger.warning("SHA-1 mismatch for " + (job.relativePath or job.sourceFile) + ": manifest has "
+                                    + job.expected_sha1 + ", recreated file is " + digests['sha1'])
+        with self._lock:
+            if verified == 0:
+                self.mismatches += 1
+            self._digests.append((job.relativePath, job.destFile, written, digests, job.expected_sha1, verified))
+
+    def _addRow(self, job, recreated):
+        if job.row is None:
+            return
+        if not recreated:
+            job.row[-1] = None
+        with self._lock:
+            self._rows.append(job.row)
+
+    def takeRows(self):
+        '''Returns and forgets the Metadata rows of the jobs finished so far'''
+        with self._lock:
+            rows, self._rows = self._rows, []
+        return rows
+
+    def takeDigests(self):
+        '''Returns and forgets the digests of the jobs finished so far, as
+           (relativePath, destFile, size, {algorithm: hex digest}, expected SHA-1, verified) tuples'''
+        with self._lock:
+            digests, self._digests = self._digests, []
+        return digests
+
+    def close(self):
+        '''Waits for every queued copy to finish'''
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self.logger.info("Finished recreating " + str(self.copied) + " files (" + str(self.bytes // (1024 * 1024))
+                         + " MB), " + str(self.failed) + " failed")
+        if self.mismatches:
+            self.logger.warning(str(self.mismatches) + " recreated files did not match the SHA-1 in the manifest")
+
+
+class _Job:
+    '''What the pool needs to remember about a queued job until it finishes'''
+    __slots__ = ("sourceFile", "destFile", "fileId", "relativePath", "expected_sha1", "row", "hashOnly", "cacheKey",
+                 "cached", "stage")
+
+    def __init__(self, sourceFile, destFile, fileId, relativePath, expected_sha1, row=None):
+        self.sourceFile = sourceFile
+        self.destFile = destFile
+        self.fileId = fileId
+        self.relativePath = relativePath
+        self.expected_sha1 = expected_sha1
+        self.row = row
+        self.hashOnly = False
+        self.cacheKey = None
+        self.cached = False
+        '''The runMetrics stage the job's time counts towards'''
+        self.stage = "copy"
@@ -0,0 +1,82 @@
+'''
+   Copyright (c) 2019 Jack Farley
+   This file is part of iTunes_Backup_Reader
+   Usage or distribution of this software/code is subject to the
+   terms of the GNU GENERAL PUBLIC LICENSE.
+   recreationJournal.py
+   ------------
+
+   Checkpoint journal of recreated files, lets an interrupted recreation pick up where it stopped
+'''
+
+import os
+import sqlite3
+import threading
+
+
+JOURNAL_NAME = "Recreation_Journal.db"
+
+'''Completed files are committed to the journal in batches of this size'''
+CHECKPOINT_EVERY = 1000
+
+
+class RecreationJournal:
+    '''Records each fileID once its copy has finished, along with the size and mtime of the recreated file.
+       Every recreation keeps one, so an interrupted run can always be resumed. Only with resume does isDone()
+       report the files an earlier run finished, otherwise the journal starts out empty.
+       Copies finish on worker threads, so every access goes through one lock'''
+
+    def __init__(self, outputDir, logger, resume=False):
+        self.path = os.path.join(outputDir, JOURNAL_NAME)
+        self.logger = logger
+        self.resume = resume
+        self.skipped = 0
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS Completed (FileID TEXT PRIMARY KEY, DestPath TEXT, "
+                           "Size INTEGER, MTime REAL)")
+        if not resume:
+            self._conn.execute("DELETE FROM Completed")
+        self._conn.commit()
+        count = self._conn.execute("SELECT count(*) FROM Completed").fetchone()[0]
+        if count:
+            logger.info("Resuming recreation, " + str(count) + " files already recorded in " + self.path)
+
+    def isDone(self, fileId, destFile):
+        '''True when fileId was copied by an earlier run and the recreated file still has the same size and mtime'''
+        if not self.resume:
+            return False
+        with self._lock:
+            row = self._conn.execute("SELECT DestPath, Size, MTime FROM Completed WHERE FileID = ?", (fileId,)).fetchone()
+        if row is None or row[0] != destFile:
+            return False
+        try:
+            stat = os.stat(destFile)
+        except OSError:
+            return False
+        if stat.st_size != row[1] or abs(stat.st_mtime - row[2]) > 0.001:
+            return False
+        self.skipped += 1
+        return True
+
+    def markDone(self, fileId, destFile):
+        '''Records a finished copy, committing every CHECKPOINT_EVERY files'''
+        try:
+            stat = os.stat(destFile)
+        except OSError:
+            return
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO Completed VALUES (?, ?, ?, ?)",
+                               (fileId, destFile, stat.st_size, stat.st_mtime))
+            self._pending += 1
+            if self._pending >= CHECKPOINT_EVERY:
+                self._conn.commit()
+                self._pending = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+        if self.skipped:
+            self.logger.info("Skipped " + str(self.skipped) + " files already recreated by an earlier run")
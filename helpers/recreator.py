@@ -15,10 +15,15 @@ import os
 from helpers import manifestDbParser, manifestMbdbParser
 import sys
 from helpers import decryptor
+from helpers.blobStore import STORE_NAME
+from helpers.blobHashCache import BlobHashCache, HASH_CACHE_NAME
+from helpers.metadataSink import metadataDbFiles, removeMetadataDb, resetMetadataDb
+from helpers.runMetrics import METRICS
 
 
 
-def startRecreate(input_dir, output_dir, password, logger):
+def startRecreate(input_dir, output_dir, password, logger, workers=1, key_cache=None, resume=False, link_mode="copy",
+                  dedup=False, metadata_only=False, file_filter=None, hash_files=False, hash_cache=None):
 
 
     '''Check encryption'''
@@ -28,45 +33,97 @@ def startRecreate(input_dir, output_dir, password, logger):
     version = float(manifest_plist.get("Version", {}))
 
     manifest_db_path = os.path.join(input_dir, "Manifest.db")
-
+    backup = None
 
 
     if encrypted:
         if password is None:
             logger.error("You did not specify a password for your encrypted backup")
+            return
 
         if version >= 10:
-            decrypt = decryptor.Decryptor(input_dir, output_dir, password, logger)
+            with METRICS.stage("manifest_decryption"):
+                decrypt = decryptor.Decryptor(input_dir, output_dir, password, logger, key_cache)
             manifest_db_path = decrypt.decrypted_manifest_db
+            backup = decrypt.backup
         else:
             logger.error("Support for decrypting iOS 9 and under backups not currently implemented")
             return
+    else:
+        logger.info("Backup is not encrypted")
 
-    logger.info("Backup is not encrypted")
+    if file_filter is not None and file_filter.active:
+        logger.info("Only recreating files selected by " + repr(file_filter))
 
     '''Create output directpry based on device serial number'''
     info_plist_path = os.path.join(input_dir, "Info.plist")
     info_plist = readPlist(info_plist_path)
     serial_number = info_plist.get('Serial Number', '')
+
+    '''The blob store sits at the top of the output folder so every backup written there shares it'''
+    store_dir = None
+    if dedup and not metadata_only:
+        store_dir = os.path.join(output_dir, STORE_NAME)
+        os.makedirs(store_dir, exist_ok=True)
+        logger.info("Recreating files as hardlinks into the blob store at: " + store_dir)
+        if link_mode != "copy":
+            logger.warning("Link mode " + link_mode + " is ignored when deduplicating into the blob store")
+
+    '''The blob hash cache defaults to the top of the output folder too, it only helps when something hashes blobs'''
+    hash_cache_path = None
+    if hash_cache is not None and not metadata_only:
+        if not hash_files and store_dir is None:
+            logger.warning("The blob hash cache is only used with --hash or --dedup, ignoring it")
+        else:
+            hash_cache_path = hash_cache or os.path.join(output_dir, HASH_CACHE_NAME)
+
     output_dir = os.path.join(output_dir, "Device_" + serial_number + "_Folders")
-    try:
-        logger.debug("Trying to create directory: " + output_dir)
-        os.makedirs(output_dir)
-        logger.debug("Successfully created directory: " + output_dir)
-    except Exception as ex:
-        logger.exception("Could not create directory: " + output_dir + " Exception was: " + str(ex))
-        sys.exit()
+
+    '''A metadata only scan may only replace the File_Metadata.db of an earlier scan, never that of a recreation,
+       whose RecreatedPath and Digests still describe the files on disk'''
+    if metadata_only and os.path.isdir(output_dir):
+        scanned = set(os.path.basename(path) for path in metadataDbFiles(output_dir))
+        if not set(os.listdir(output_dir)) <= scanned:
+            logger.error("Not writing a metadata only scan into " + output_dir + ", it holds a recreation whose "
+                         "File_Metadata.db would be replaced. Choose another output folder")
+            return
+        logger.info("Reusing existing directory: " + output_dir)
+        removeMetadataDb(output_dir)
+    elif resume and os.path.isdir(output_dir):
+        '''When resuming, reuse the existing folder. The Metadata table is rebuilt from scratch since it is cheap to
+           redo. With --hash the skipped files are hashed again, so the digests are rebuilt too, otherwise they are
+           kept'''
+        logger.info("Reusing existing directory: " + output_dir)
+        if resetMetadataDb(output_dir, keep_digests=not hash_files):
+            logger.warning("Resuming without --hash, the Digests table in File_Metadata.db and Hash_Manifest.txt "
+                           "only cover the files hashed by earlier runs")
+    else:
+        try:
+            logger.debug("Trying to create directory: " + output_dir)
+            os.makedirs(output_dir)
+            logger.debug("Successfully created directory: " + output_dir)
+        except Exception as ex:
+            logger.exception("Could not create directory: " + output_dir + " Exception was: " + str(ex))
+            sys.exit()
 
 
     '''Check if database is db or mbdb'''
 
     manifest_mbdb_path = os.path.join(input_dir, "Manifest.mbdb")
-    if os.path.isfile(manifest_mbdb_path):
-        logger.debug("Older Manifest.mbdb found")
-        manifestMbdbParser.mbdbParser(manifest_mbdb_path, input_dir, output_dir, logger)
-    if os.path.isfile(manifest_db_path):
-        logger.debug("Modern Manifest.db found")
-        manifestDbParser.readManiDb(manifest_db_path, input_dir, output_dir, logger)
+    '''Only opened once the output folder is settled, so the returns and exit above cannot leave it open'''
+    blob_hashes = BlobHashCache(hash_cache_path, logger) if hash_cache_path is not None else None
+    try:
+        if os.path.isfile(manifest_mbdb_path):
+            logger.debug("Older Manifest.mbdb found")
+            manifestMbdbParser.mbdbParser(manifest_mbdb_path, input_dir, output_dir, logger, workers, resume,
+                                          link_mode, store_dir, metadata_only, file_filter, hash_files, blob_hashes)
+        if os.path.isfile(manifest_db_path):
+            logger.debug("Modern Manifest.db found")
+            manifestDbParser.readManiDb(manifest_db_path, input_dir, output_dir, logger, workers, backup, resume,
+                                        link_mode, store_dir, metadata_only, file_filter, hash_files, blob_hashes)
+    finally:
+        if blob_hashes is not None:
+            blob_hashes.close()
 
 
 
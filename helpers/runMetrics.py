@@ -0,0 +1,236 @@
+'''
+   Copyright (c) 2019 Jack Farley
+   This file is part of iTunes_Backup_Reader
+   Usage or distribution of this software/code is subject to the
+   terms of the GNU GENERAL PUBLIC LICENSE.
+   runMetrics.py
+   ------------
+
+   Process wide stage timers and counters of a run, written to Run_Metrics.json at the end and
+   optionally to a Prometheus textfile (node_exporter's textfile collector) as the run goes.
+   Stages running on workers add up the time of every worker, so a stage can take longer than
+   the run itself when it runs in parallel. --progress shows a live progress line with
+   throughput and an ETA from the same counters.
+'''
+
+import contextlib
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+
+
+METRICS_NAME = "Run_Metrics.json"
+
+'''Stages in the order a run goes through them'''
+STAGES = ("plist_parse", "manifest_decryption", "manifest_scan", "blob_decode", "key_unwrap", "directory_creation",
+          "copy", "decryption", "hashing", "db_writes")
+
+COUNTERS = ("rows", "files", "bytes", "errors", "retries")
+
+PROMETHEUS_PREFIX = "itunes_backup_reader_"
+
+'''Seconds between progress line updates, and between Prometheus textfile rewrites'''
+PROGRESS_EVERY = 1.0
+PROMETHEUS_EVERY = 15.0
+
+
+def _duration(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+class RunMetrics:
+    '''Stage timers and counters, safe to update from any thread'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        '''Only one thread redraws the progress line or rewrites the textfile at a time, the others skip it'''
+        self._tickLock = threading.Lock()
+        self.reset()
+        self.progress = None
+        self.prometheus_path = None
+        self._nextProgress = 0.0
+        self._nextPrometheus = 0.0
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self._startedClock = time.perf_counter()
+            self.stages = {name: [0.0, 0] for name in STAGES}
+            self.counters = {name: 0 for name in COUNTERS}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''Times the block as one call of a stage'''
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.addTime(name, time.perf_counter() - started)
+
+    def addTime(self, name, seconds, calls=1):
+        with self._lock:
+            stage = self.stages.setdefault(name, [0.0, 0])
+            stage[0] += seconds
+            stage[1] += calls
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+        if name == "rows" or name == "files":
+            self._tick()
+
+    def snapshot(self):
+        '''The metrics as a JSON serialisable dictionary'''
+        with self._lock:
+            elapsed = time.perf_counter() - self._startedClock
+            counters = dict(self.counters)
+            stages = {name: {"seconds": round(seconds, 6), "calls": calls}
+                      for name, (seconds, calls) in self.stages.items()}
+        return {"started": datetime.datetime.fromtimestamp(self.started).isoformat(timespec="seconds"),
+                "elapsed_seconds": round(elapsed, 3), "stages": stages, "counters": counters,
+                "files_per_s": round(counters["files"] / elapsed, 2) if elapsed else None,
+                "mb_per_s": round(counters["bytes"] / elapsed / 1e6, 3) if elapsed else None}
+
+    def merge(self, snapshot):
+        '''Adds the stages and counters of a snapshot taken in another process'''
+        with self._lock:
+            for name, stage in snapshot.get("stages", {}).items():
+                total = self.stages.setdefault(name, [0.0, 0])
+                total[0] += stage["seconds"]
+                total[1] += stage["calls"]
+            for name, value in snapshot.get("counters", {}).items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def writeJson(self, path):
+        with open(path, "w") as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+    def writePrometheus(self, path=None):
+        '''Writes the metrics in the Prometheus text format. The file is replaced in one rename so the textfile
+           collector never reads half of it'''
+        path = path or self.prometheus_path
+        if not path:
+            return
+        snapshot = self.snapshot()
+        lines = ["# HELP " + PROMETHEUS_PREFIX + "stage_seconds_total Seconds spent in each stage, summed over "
+                 "workers",
+                 "# TYPE " + PROMETHEUS_PREFIX + "stage_seconds_total counter"]
+        for name, stage in snapshot["stages"].items():
+            lines.append(PROMETHEUS_PREFIX + 'stage_seconds_total{stage="' + name + '"} ' + repr(stage["seconds"]))
+        lines += ["# HELP " + PROMETHEUS_PREFIX + "stage_calls_total Times each stage ran",
+                  "# TYPE " + PROMETHEUS_PREFIX + "stage_calls_total counter"]
+        for name, stage in snapshot["stages"].items():
+            lines.append(PROMETHEUS_PREFIX + 'stage_calls_total{stage="' + name + '"} ' + str(stage["calls"]))
+        for name, value in snapshot["counters"].items():
+            lines += ["# TYPE " + PROMETHEUS_PREFIX + name + "_total counter",
+                      PROMETHEUS_PREFIX + name + "_total " + str(value)]
+        lines += ["# TYPE " + PROMETHEUS_PREFIX + "elapsed_seconds gauge",
+                  PROMETHEUS_PREFIX + "elapsed_seconds " + repr(snapshot["elapsed_seconds"])]
+        temp = path + ".tmp"
+        with open(temp, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp, path)
+
+    def startProgress(self, total=None):
+        '''Starts counting progress of the rows of one manifest, total is its row count when known'''
+        if self.progress is not None:
+            with self._lock:
+                self.progress.start(self.counters, total)
+
+    def _tick(self):
+        now = time.perf_counter()
+        if now < self._nextProgress or not self._tickLock.acquire(blocking=False):
+            return
+        try:
+            self._nextProgress = now + PROGRESS_EVERY
+            if self.progress is not None:
+                with self._lock:
+                    counters = dict(self.counters)
+                self.progress.render(counters)
+            if self.prometheus_path and now >= self._nextPrometheus:
+                self._nextPrometheus = now + PROMETHEUS_EVERY
+                try:
+                    self.writePrometheus()
+                except OSError:
+                    pass
+        finally:
+            self._tickLock.release()
+
+    def finishProgress(self):
+        if self.progress is not None:
+            with self._tickLock:
+                with self._lock:
+                    counters = dict(self.counters)
+                self.progress.render(counters)
+                self.progress.finish()
+
+
+class ProgressLine:
+    '''One line on stderr, redrawn in place: rows done out of the total, files/s and MB/s since the
+       current manifest started, and an ETA when the total is known'''
+
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stderr
+        self.total = None
+        self._start = None
+        self._started = time.perf_counter()
+        self._width = 0
+        self._line = ""
+
+    def start(self, counters, total=None):
+        self._start = dict(counters)
+        self._started = time.perf_counter()
+        self.total = total
+
+    def render(self, counters):
+        start = self._start or {}
+        elapsed = max(time.perf_counter() - self._started, 1e-6)
+        rows = counters.get("rows", 0) - start.get("rows", 0)
+        files = counters.get("files", 0) - start.get("files", 0)
+        mb = (counters.get("bytes", 0) - start.get("bytes", 0)) / 1e6
+
+        line = "{:,}".format(rows)
+        if self.total:
+            line += "/{:,} rows ({:.1f}%)".format(self.total, 100.0 * min(rows, self.total) / self.total)
+        else:
+            line += " rows"
+        line += "  {:,} files  {:,.0f} files/s  {:.1f} MB/s".format(files, files / elapsed, mb / elapsed)
+        if self.total and rows:
+            line += "  ETA " + _duration(max(self.total - rows, 0) * elapsed / rows)
+        errors = counters.get("errors", 0)
+        if errors:
+            line += "  {:,} errors".format(errors)
+
+        '''The cursor is left at the start of the line, so a log message printed meanwhile overwrites it
+           rather than being appended to it'''
+        self.stream.write("\r" + line.ljust(self._width) + "\r")
+        self.stream.flush()
+        self._width = len(line)
+        self._line = line
+
+    def finish(self):
+        if self._width:
+            self.stream.write(self._line + "\n")
+            self.stream.flush()
+            self._width = 0
+
+
+'''Shared by everything in this process'''
+METRICS = RunMetrics()
+
+
+def timedIter(iterable, name):
+    '''Yields from iterable, timing only the work of producing each item as the named stage'''
+    iterator = iter(iterable)
+    while True:
+        started = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            METRICS.addTime(name, time.perf_counter() - started, 0)
+            return
+        METRICS.addTime(name, time.perf_counter() - started)
+        yield item
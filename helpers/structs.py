@@ -90,10 +90,10 @@ def sinfHelper(data, logger):
 
 
 
+'''MBDB strings have a 16 bit big endian length, 0xFFFF marks an empty string'''
 CUST_STRING = Struct (
-    "unknown00" / Byte,
-    "Length" / Byte,
-    "String" / If(this.Length != 255, Bytes(this.Length))
+    "Length" / Int16ub,
+    "String" / If(this.Length != 0xFFFF, Bytes(this.Length))
 
 
 )
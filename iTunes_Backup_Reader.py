@@ -16,7 +16,12 @@ import sys
 import ctypes
 import glob
 from helpers import plist_parser, recreator
-from multiprocessing import Process
+from helpers.iphone_backup_decrypt import KeyCache, DEFAULT_KEY_CACHE_PATH
+from helpers.fastCopy import LINK_MODES
+from helpers.fileFilter import FileFilter
+from helpers.backupMount import mountBackup
+from helpers.runMetrics import METRICS, METRICS_NAME, ProgressLine
+from concurrent.futures import ProcessPoolExecutor
 
 
 ASCII_ART = '''
@@ -49,8 +54,147 @@ def createLogger(verbose, output_dir):
         return logger
 
 
+def createBackupLogger(backup_dir, output_dir, level):
+    '''Logger for one backup in bulk/IR mode, writing to its own log file so parallel jobs do not interleave'''
+    name = os.path.basename(os.path.normpath(backup_dir))
+    log_out = os.path.join(output_dir, "iTunes_Backup_Reader_" + name + ".log")
+
+    logger = logging.getLogger("backup." + name)
+    logger.setLevel(level)
+    logger.propagate = False
+    formatter = logging.Formatter('%(asctime)s ' + name[:12].ljust(12) + ' %(levelname)-8s %(message)s',
+                                  datefmt='%m-%d %H:%M')
+    for handler in (logging.StreamHandler(), logging.FileHandler(log_out)):
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+    return logger
+
+
+def closeBackupLogger(logger):
+    '''Removes and closes the handlers of a createBackupLogger logger, so a --jobs worker reused for the next backup
+       neither keeps the log file open nor writes the next backup's records into it'''
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+
+def processBackup(backup_dir, output_dir, out_type, recreate, password, recreate_options, logger=None, level=None):
+    '''Reads and optionally recreates one backup. Runs in a worker process for bulk/IR mode with --jobs,
+       where it gets its own logger. Returns (backup_dir, error), error is None on success'''
+    own_logger = logger is None
+    if own_logger:
+        logger = createBackupLogger(backup_dir, output_dir, level)
+
+    try:
+        logger.info("Starting to read backup at: " + backup_dir)
+        with METRICS.stage("plist_parse"):
+            plist_parser.parsePlists(backup_dir, output_dir, out_type, logger)
+
+        if recreate:
+            logger.info("User chose to recreate folders. Starting process now")
+            recreator.startRecreate(backup_dir, output_dir, password, logger, **recreate_options)
+    except SystemExit:
+        '''The parsers exit on fatal errors, which should only fail this backup'''
+        return backup_dir, "Stopped on a fatal error, see log for details"
+    except Exception as ex:
+        logger.exception("Failed to process backup at: " + backup_dir + " Exception was: " + str(ex))
+        return backup_dir, str(ex)
+    finally:
+        if own_logger:
+            closeBackupLogger(logger)
+
+    return backup_dir, None
+
+
+def processBackupInWorker(*args):
+    '''processBackup in a --jobs worker process, also returning that backup's metrics for the main process'''
+    METRICS.reset()
+    METRICS.progress = None
+    METRICS.prometheus_path = None
+    result = processBackup(*args)
+    return result, METRICS.snapshot()
+
+
+def processBackups(backup_dirs, output_dir, out_type, recreate, password, recreate_options, jobs, logger):
+    '''Processes every backup for bulk/IR mode, across a pool of jobs processes when jobs > 1, then logs a summary'''
+    results = []
+    if jobs > 1:
+        logger.info("Processing " + str(len(backup_dirs)) + " backups with " + str(jobs) + " jobs")
+        level = logging.getLogger().getEffectiveLevel()
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(processBackupInWorker, backup_dir, output_dir, out_type, recreate, password,
+                                       recreate_options, None, level) for backup_dir in backup_dirs]
+            for backup_dir, future in zip(backup_dirs, futures):
+                try:
+                    result, metrics = future.result()
+                    results.append(result)
+                    METRICS.merge(metrics)
+                except Exception as ex:
+                    results.append((backup_dir, str(ex)))
+                backup_dir, error = results[-1]
+                logger.info("Finished backup at: " + backup_dir + (" with errors" if error else ""))
+    else:
+        for backup_dir in backup_dirs:
+            results.append(processBackup(backup_dir, output_dir, out_type, recreate, password, recreate_options, logger))
+
+    failures = [(backup_dir, error) for backup_dir, error in results if error]
+    logger.info("Processed " + str(len(results)) + " backups: " + str(len(results) - len(failures)) + " succeeded, "
+                + str(len(failures)) + " failed")
+    for backup_dir, error in failures:
+        logger.error("Failed: " + backup_dir + " - " + error)
+
+
+def purgeKeyCache():
+    '''Purging the key cache needs no backup, so it is handled before the required arguments are checked'''
+    purge_parser = argparse.ArgumentParser(add_help=False)
+    purge_parser.add_argument("--purge-key-cache", nargs="?", const=DEFAULT_KEY_CACHE_PATH, default=None,
+                              dest='purge_key_cache')
+    purge_args, _ = purge_parser.parse_known_args()
+    if purge_args.purge_key_cache is None:
+        return
+
+    if KeyCache(purge_args.purge_key_cache).purge():
+        print("Purged key cache: " + purge_args.purge_key_cache)
+    else:
+        print("No key cache found at: " + purge_args.purge_key_cache)
+    sys.exit()
+
+
+def mount():
+    '''Mounting only needs the backup and a mountpoint, so like purging the key cache it is handled
+       before the required arguments are checked'''
+    mount_parser = argparse.ArgumentParser(add_help=False)
+    mount_parser.add_argument("--mount", default=None, type=str, dest='mount')
+    mount_parser.add_argument("-i", '--inputDir', default=None, type=str, dest='inputDir')
+    mount_parser.add_argument("-p", default=None, type=str, dest='password')
+    mount_parser.add_argument("--key-cache", nargs="?", const=DEFAULT_KEY_CACHE_PATH, default=None, dest='key_cache')
+    mount_parser.add_argument("-v", "--verbose", action="store_true")
+    mount_args, _ = mount_parser.parse_known_args()
+    if mount_args.mount is None:
+        return
+
+    logging.basicConfig(level=logging.DEBUG if mount_args.verbose else logging.INFO,
+                        format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s', datefmt='%m-%d %H:%M')
+    if mount_args.inputDir is None:
+        logging.error("--mount needs the backup to mount given with -i")
+        sys.exit(1)
+    if not os.path.isdir(mount_args.mount):
+        logging.error("Mountpoint " + mount_args.mount + " is not a directory")
+        sys.exit(1)
+    try:
+        mounted = mountBackup(mount_args.inputDir, mount_args.mount, mount_args.password, logging,
+                              mount_args.key_cache)
+    except Exception as ex:
+        logging.exception("Could not mount " + mount_args.inputDir + " Exception was: " + str(ex))
+        mounted = False
+    sys.exit(0 if mounted else 1)
+
+
 def parseArgs():
 
+    purgeKeyCache()
+    mount()
+
     parser = argparse.ArgumentParser(description='Utility to Read iTunes Backups')
 
     '''Gets paths to necessary folders'''
@@ -72,24 +216,107 @@ def parseArgs():
 
 
 
-    parser.add_argument("-r", "--recreate", help="Tries to recreate folder structure for unencrypted backups",
+    parser.add_argument("-r", "--recreate", help="Tries to recreate folder structure. Encrypted iOS 10+ backups are "
+                        "decrypted when -p is given",
                         action="store_true")
 
     parser.add_argument("-p",  help="Password for encrypted backups", default=None, type=str,
                         dest='password')
 
+    parser.add_argument("--workers", help="Number of worker threads used to copy files when recreating, encrypted "
+                        "backups are decrypted in worker processes. Default is 1",
+                        default=1, type=int, dest='workers')
+
+    parser.add_argument("--key-cache", help="Cache the unlocked keys of encrypted backups so later runs skip key "
+                        "derivation. Optionally give the cache path, default is " + DEFAULT_KEY_CACHE_PATH,
+                        nargs="?", const=DEFAULT_KEY_CACHE_PATH, default=None, dest='key_cache')
+
+    parser.add_argument("--purge-key-cache", help="Delete the key cache and exit. Optionally give the cache path",
+                        nargs="?", const=DEFAULT_KEY_CACHE_PATH, default=None, dest='purge_key_cache')
+
+    parser.add_argument("--resume", help="Resume an interrupted recreation, skipping files an earlier run already "
+                        "copied", action="store_true")
+
+    parser.add_argument("--link-mode", help="How recreated files are created. hardlink, reflink and symlink fall "
+                        "back to a copy for files where they fail. Default is copy", choices=LINK_MODES,
+                        default="copy", dest='link_mode')
+
+    parser.add_argument("--dedup", help="Store each unique file once in a content addressed Blob_Store in the output "
+                        "folder and recreate files as hardlinks into it. The store is shared by every backup written "
+                        "to the same output folder", action="store_true")
+
+    parser.add_argument("--metadata-only", help="Only write the file inventory to File_Metadata.db, without "
+                        "recreating any files", action="store_true", dest='metadata_only')
+
+    parser.add_argument("--include", help="Only recreate files matching domain[:pathglob], ex. HomeDomain or "
+                        "AppDomain-*:*.sqlite. Can be given more than once", action="append", default=None,
+                        dest='include')
+
+    parser.add_argument("--exclude", help="Skip files matching domain[:pathglob]. Can be given more than once",
+                        action="append", default=None, dest='exclude')
+
+    parser.add_argument("--ext", help="Only recreate files with these extensions, comma separated ex. db,sqlite,jpg",
+                        default=None, type=str, dest='ext')
+
+    parser.add_argument("--min-size", help="Only recreate files of at least this many bytes", default=None, type=int,
+                        dest='min_size')
+
+    parser.add_argument("--max-size", help="Only recreate files of at most this many bytes", default=None, type=int,
+                        dest='max_size')
+
+    parser.add_argument("--hash", help="Compute MD5, SHA-1 and SHA-256 of every recreated file while it is copied. "
+                        "Digests go to File_Metadata.db and a Hash_Manifest.txt, files from Manifest.mbdb backups are "
+                        "also checked against the SHA-1 in the manifest", action="store_true", dest='hash_files')
+
+    parser.add_argument("--hash-cache", help="Keep the digests and file type of every backup blob in a cache "
+                        "keyed by path, inode, size and mtime, so later runs with --hash or --dedup only read new or "
+                        "changed blobs. Default location is Blob_Hash_Cache.db in the output folder", nargs="?",
+                        const="", default=None, type=str, dest='hash_cache', metavar='PATH')
+
+    parser.add_argument("--progress", help="Show a live progress line with throughput and ETA while recreating",
+                        action="store_true", dest='progress')
+
+    parser.add_argument("--prometheus", help="Also write the run metrics to this Prometheus textfile, updated while "
+                        "the run goes. " + METRICS_NAME + " is always written to the output folder", default=None,
+                        type=str, dest='prometheus', metavar='PATH')
+
+    parser.add_argument("--mount", help="Mount the backup given with -i read only at this directory instead of "
+                        "recreating it, decrypting on the fly. Only needs -i (and -p), runs until unmounted. "
+                        "Needs fusepy", default=None, type=str, dest='mount', metavar='MOUNTPOINT')
+
+    parser.add_argument("--jobs", help="Number of backups processed in parallel in bulk or IR mode. Each backup "
+                        "logs to its own file. Default is 1", default=1, type=int, dest='jobs')
+
     args = parser.parse_args()
 
 
     '''Gets all values from users'''
     input_dir = args.inputDir
     output_dir = args.outputDir
-    recreate = args.recreate
+    '''A metadata only scan runs the recreator without copying anything'''
+    recreate = args.recreate or args.metadata_only
     verbose = args.verbose
     out_type = args.out_type
     password = args.password
     bulk = args.bulk
     ir_mode = args.ir
+    jobs = args.jobs
+
+    '''Selects the files to recreate, None recreates everything'''
+    file_filter = FileFilter(args.include, args.exclude, args.ext.split(",") if args.ext else None, args.min_size,
+                             args.max_size)
+    if not file_filter.active:
+        file_filter = None
+
+    '''Stage timers and counters are process wide, the progress line and textfile are set up once here'''
+    if args.progress:
+        METRICS.progress = ProgressLine()
+    METRICS.prometheus_path = args.prometheus
+
+    '''Options handed straight through to the recreator'''
+    recreate_options = {'workers': args.workers, 'key_cache': args.key_cache, 'resume': args.resume,
+                        'link_mode': args.link_mode, 'dedup': args.dedup, 'metadata_only': args.metadata_only,
+                        'file_filter': file_filter, 'hash_files': args.hash_files, 'hash_cache': args.hash_cache}
 
 
     '''Check output directory and create directory if not exists'''
@@ -135,8 +362,20 @@ def parseArgs():
             logger.error("Admin rights not found! Exiting")
             sys.exit()
 
+    if args.workers < 1:
+        logger.error("Number of workers must be at least 1")
+        sys.exit()
+
+    if jobs < 1:
+        logger.error("Number of jobs must be at least 1")
+        sys.exit()
+
+    if args.min_size is not None and args.max_size is not None and args.min_size > args.max_size:
+        logger.error("--min-size cannot be larger than --max-size")
+        sys.exit()
+
 
-    return input_dir, output_dir, recreate, out_type, ir_mode, bulk, password, logger
+    return input_dir, output_dir, recreate, out_type, ir_mode, bulk, password, logger, recreate_options, jobs
 
 
 def main():
@@ -145,47 +384,52 @@ def main():
     start_time = time.time()
 
     '''Gets all user arguments'''
-    input_dir, output_dir, recreate, out_type, ir_mode, bulk, password, logger = parseArgs()
+    input_dir, output_dir, recreate, out_type, ir_mode, bulk, password, logger, recreate_options, jobs = parseArgs()
 
     '''Parse a single backup'''
     if not bulk and not ir_mode:
         logger.info("Starting to read backup at: " + input_dir)
-        plist_parser.parsePlists(input_dir, output_dir, out_type, logger)
+        with METRICS.stage("plist_parse"):
+            plist_parser.parsePlists(input_dir, output_dir, out_type, logger)
 
         if recreate:
             logger.debug("User chose to recreate folders. Starting process now")
-            recreator.startRecreate(input_dir, output_dir, password, logger)
+            recreator.startRecreate(input_dir, output_dir, password, logger, **recreate_options)
     '''Bulk parse'''
     if bulk:
-        subfolders = os.listdir(input_dir)
-        for folders in subfolders:
-            current_folder = os.path.join(input_dir, folders)
-            logger.info("Starting to read backup at: " + current_folder)
-            plist_parser.parsePlists(current_folder, output_dir, out_type, logger)
-
-            if recreate:
-                logger.info("User chose to recreate folders. Starting process now")
-                recreator.startRecreate(current_folder, output_dir, password, logger)
+        subfolders = [os.path.join(input_dir, folders) for folders in sorted(os.listdir(input_dir))]
+        subfolders = [folders for folders in subfolders if os.path.isdir(folders)]
+        processBackups(subfolders, output_dir, out_type, recreate, password, recreate_options, jobs, logger)
 
     if ir_mode:
         path = "\\Users\\*\\AppData\\Roaming\\Apple Computer\\MobileSync\\Backup\\*"
         all_paths = glob.glob(path)
 
+        processBackups(all_paths, output_dir, out_type, recreate, password, recreate_options, jobs, logger)
 
-        for folders in all_paths:
-
-            logger.info("Starting to read backup at: " + folders)
-            plist_parser.parsePlists(folders, output_dir, out_type, logger)
-
-            if recreate:
-                logger.info("User chose to recreate folders. Starting process now")
-                recreator.startRecreate(folders, output_dir, password, logger)
 
+    writeMetrics(output_dir, logger)
 
     end_time = time.time()
     logger.info("Program ended in: " + str(end_time - start_time) + " seconds")
 
 
+def writeMetrics(output_dir, logger):
+    '''Writes Run_Metrics.json and the Prometheus textfile, and logs where the time went'''
+    snapshot = METRICS.snapshot()
+    for name, stage in snapshot["stages"].items():
+        if stage["calls"]:
+            logger.info("Stage " + name + ": " + str(round(stage["seconds"], 2)) + " seconds")
+    logger.info("Counters: " + ", ".join(name + "=" + str(value) for name, value in snapshot["counters"].items()))
+    metrics_path = os.path.join(output_dir, METRICS_NAME)
+    try:
+        METRICS.writeJson(metrics_path)
+        logger.info("Wrote run metrics to " + metrics_path)
+        METRICS.writePrometheus()
+    except OSError as ex:
+        logger.exception("Could not write the run metrics Exception was: " + str(ex))
+
+
 
 if __name__ == "__main__":
     print(ASCII_ART)
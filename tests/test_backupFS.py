@@ -0,0 +1,143 @@
+'''
+   Copyright (c) 2019 Jack Farley
+   This file is part of iTunes_Backup_Reader
+   Usage or distribution of this software/code is subject to the
+   terms of the GNU GENERAL PUBLIC LICENSE.
+   test_backupFS.py
+   ------------
+
+   Read only access to plain, encrypted and Manifest.mbdb synthetic backups through Backup and
+   the path based BackupVFS the mount is built on: read, listdir, seek and missing paths.
+'''
+
+import errno
+import hashlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [REPO_DIR, os.path.join(REPO_DIR, "benchmarks")]
+
+from helpers.backupFS import Backup  # noqa: E402
+from helpers.backupMount import BackupVFS  # noqa: E402
+from syntheticBackup import FILE_TYPES, generateBackup  # noqa: E402
+
+
+'''Header every synthetic file of an extension starts with'''
+HEADERS = {extension.lower(): header for extension, header, _ in FILE_TYPES}
+
+
+class BackupTests:
+    '''Run against the backup setUpClass generates, kind and encrypted are set by each subclass'''
+
+    kind = None
+    encrypted = False
+
+    @classmethod
+    def setUpClass(cls):
+        cls.temp = tempfile.TemporaryDirectory()
+        cls.backupDir = os.path.join(cls.temp.name, "backup")
+        summary = generateBackup(cls.backupDir, files=40, kind=cls.kind, encrypted=cls.encrypted, meanSize=4096,
+                                 maxSize=64 * 1024)
+        cls.backup = Backup(cls.backupDir, summary["password"])
+        cls.files = [entry for entry in cls.backup.glob("*") if entry.isFile]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.backup.close()
+        cls.temp.cleanup()
+
+    def expected(self, entry):
+        '''The file's content as stored in the backup, or None when it is encrypted there'''
+        if self.encrypted:
+            return None
+        with open(self.backup.blobPath(entry), "rb") as f:
+            return f.read()
+
+    def testRead(self):
+        self.assertEqual(len(self.files), 40)
+        for entry in self.files:
+            data = self.backup.read(entry.domain, entry.relativePath)
+            self.assertEqual(len(data), entry.size)
+            self.assertTrue(data.startswith(HEADERS[os.path.splitext(entry.relativePath)[1].lower()]))
+            if not self.encrypted:
+                self.assertEqual(data, self.expected(entry))
+
+    def testSeek(self):
+        entry = max(self.files, key=lambda e: e.size)
+        data = self.backup.read(entry.domain, entry.relativePath)
+        with self.backup.open(entry.domain, entry.relativePath) as f:
+            for offset, length in ((0, 10), (15, 17), (16, 4096), (entry.size - 20, 100), (entry.size, 10), (1, 0)):
+                f.seek(offset)
+                self.assertEqual(f.tell(), offset)
+                self.assertEqual(f.read(length), data[offset:offset + length])
+            f.seek(-7, io.SEEK_END)
+            self.assertEqual(f.read(), data[-7:])
+
+    def testListdir(self):
+        domains = sorted({entry.domain for entry in self.files})
+        for domain in domains:
+            self.assertIn(domain, self.backup.listdir())
+        for entry in self.files:
+            parent, _, name = entry.relativePath.rpartition("/")
+            self.assertIn(name, self.backup.listdir(entry.domain, parent))
+            self.assertIn(parent.split("/")[0], self.backup.listdir(entry.domain))
+
+    def testNotFound(self):
+        with self.assertRaises(FileNotFoundError):
+            self.backup.stat("HomeDomain", "No/Such/File")
+        with self.assertRaises(FileNotFoundError):
+            self.backup.read("NoSuchDomain", "file")
+        self.assertFalse(self.backup.exists("HomeDomain", "No/Such/File"))
+        self.assertEqual(self.backup.listdir("HomeDomain", "No/Such"), [])
+
+    def testVFS(self):
+        vfs = BackupVFS(self.backup)
+        entry = self.files[0]
+        path = "/" + entry.domain + "/" + entry.relativePath
+        data = self.backup.read(entry.domain, entry.relativePath)
+
+        self.assertEqual(vfs.getattr(path)['st_size'], entry.size)
+        self.assertIn(entry.domain, vfs.readdir("/"))
+        self.assertIn(entry.relativePath.rpartition("/")[2], vfs.readdir(path.rpartition("/")[0]))
+
+        fh = vfs.open(path)
+        try:
+            self.assertEqual(vfs.read(path, 100, 3, fh), data[3:103])
+        finally:
+            vfs.release(path, fh)
+
+        for call in (vfs.getattr, vfs.open, vfs.readdir):
+            with self.assertRaises(OSError) as raised:
+                call("/" + entry.domain + "/No/Such/File")
+            self.assertEqual(raised.exception.errno, errno.ENOENT)
+        with self.assertRaises(OSError) as raised:
+            vfs.open(path, os.O_WRONLY)
+        self.assertEqual(raised.exception.errno, errno.EROFS)
+
+
+class ManifestDbTest(BackupTests, unittest.TestCase):
+    kind = "manifestdb"
+
+
+class EncryptedManifestDbTest(BackupTests, unittest.TestCase):
+    kind = "manifestdb"
+    encrypted = True
+
+
+class MbdbTest(BackupTests, unittest.TestCase):
+    kind = "mbdb"
+
+    def testDataHash(self):
+        '''Manifest.mbdb records the SHA-1 of each file, which what is read has to match'''
+        for entry in self.files:
+            record = self.backup._index[(entry.domain, entry.relativePath)]
+            data = self.backup.read(entry.domain, entry.relativePath)
+            self.assertEqual(hashlib.sha1(data).digest(), record.DataHash)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+'''
+   Copyright (c) 2019 Jack Farley
+   This file is part of iTunes_Backup_Reader
+   Usage or distribution of this software/code is subject to the
+   terms of the GNU GENERAL PUBLIC LICENSE.
+   test_fileFilter.py
+   ------------
+
+   Extension and size filters only select files, folders must survive them both in the
+   recreated tree and in File_Metadata.db, for Manifest.db and Manifest.mbdb backups alike.
+'''
+
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [REPO_DIR, os.path.join(REPO_DIR, "benchmarks")]
+
+from helpers import recreator  # noqa: E402
+from helpers.fileFilter import FileFilter  # noqa: E402
+from helpers.mbdbReader import readMbdb  # noqa: E402
+from syntheticBackup import generateBackup  # noqa: E402
+
+
+LOGGER = logging.getLogger("test_fileFilter")
+
+
+class SqlWhereTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        self.conn.execute("CREATE TABLE Files (fileID TEXT, domain TEXT, relativePath TEXT, flags INTEGER)")
+        self.conn.executemany("INSERT INTO Files VALUES (?, ?, ?, ?)", [
+            ("1", "HomeDomain", "", 2),
+            ("2", "HomeDomain", "Library", 2),
+            ("3", "HomeDomain", "Library/Preferences.plist", 1),
+            ("4", "HomeDomain", "Library/photo.JPG", 1),
+            ("5", "HomeDomain", "Library/link", 4),
+        ])
+
+    def selected(self, file_filter):
+        where, params = file_filter.sqlWhere()
+        query = "SELECT relativePath FROM Files" + (" WHERE " + where if where else "") + " ORDER BY fileID"
+        return [row[0] for row in self.conn.execute(query, params)]
+
+    def testExtensionsKeepFolders(self):
+        self.assertEqual(self.selected(FileFilter(extensions=["plist"])),
+                         ["", "Library", "Library/Preferences.plist", "Library/link"])
+
+    def testExtensionsAreCaseInsensitive(self):
+        self.assertEqual(self.selected(FileFilter(extensions=["jpg"])), ["", "Library", "Library/photo.JPG",
+                                                                         "Library/link"])
+
+    def testMatchKeepsFolders(self):
+        file_filter = FileFilter(extensions=["plist"])
+        self.assertTrue(file_filter.match("HomeDomain", "Library", isFile=False))
+        self.assertTrue(file_filter.match("HomeDomain", "Library/Preferences.plist"))
+        self.assertFalse(file_filter.match("HomeDomain", "Library/photo.JPG"))
+
+    def testExcludeStillAppliesToFolders(self):
+        file_filter = FileFilter(exclude=["HomeDomain:Library*"], extensions=["plist"])
+        self.assertEqual(self.selected(file_filter), [""])
+        self.assertFalse(file_filter.match("HomeDomain", "Library", isFile=False))
+
+
+class RecreateWithExtensionsTest(unittest.TestCase):
+    '''Recreates synthetic backups keeping only .plist files, every folder has to be there anyway'''
+
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp.cleanup)
+
+    def recreate(self, kind):
+        backupDir = os.path.join(self.temp.name, kind)
+        generateBackup(backupDir, files=60, kind=kind, meanSize=256)
+        outputDir = os.path.join(self.temp.name, "out_" + kind)
+        os.makedirs(outputDir)
+        recreator.startRecreate(backupDir, outputDir, None, LOGGER, file_filter=FileFilter(extensions=["plist"]))
+        deviceDir = os.path.join(outputDir, os.listdir(outputDir)[0])
+        conn = sqlite3.connect(os.path.join(deviceDir, "File_Metadata.db"))
+        try:
+            paths = set(row[0] for row in conn.execute("SELECT RelativePath FROM Metadata"))
+        finally:
+            conn.close()
+        return backupDir, deviceDir, paths
+
+    def testManifestDbFolders(self):
+        backupDir, deviceDir, paths = self.recreate("manifestdb")
+        conn = sqlite3.connect(os.path.join(backupDir, "Manifest.db"))
+        try:
+            folders = conn.execute("SELECT domain, relativePath FROM Files WHERE flags = 2").fetchall()
+            plists = conn.execute("SELECT count(*) FROM Files WHERE flags = 1 AND relativePath LIKE '%.plist'"
+                                  ).fetchone()[0]
+        finally:
+            conn.close()
+        self.assertTrue(folders)
+        for domain, relativePath in folders:
+            self.assertIn(domain + "/" + relativePath, paths)
+            self.assertTrue(os.path.isdir(os.path.join(deviceDir, "Recreated_File_Structure", domain, relativePath)))
+        self.assertEqual(len(paths), len(folders) + plists)
+
+    def testMbdbFolders(self):
+        backupDir, deviceDir, paths = self.recreate("mbdb")
+        records = list(readMbdb(os.path.join(backupDir, "Manifest.mbdb")))
+        folders = [record for record in records if record.Mode & 0xF000 == 0x4000]
+        plists = [record for record in records if record.Mode & 0xF000 == 0x8000 and record.Path.endswith(".plist")]
+        self.assertTrue(folders)
+        self.assertEqual(len(paths), len(folders) + len(plists))
+        '''Manifest.mbdb recreation only writes files, so folders are only checked in File_Metadata.db'''
+        for record in folders:
+            self.assertIn(record.Domain + "/" + record.Path, paths)
+
+
+if __name__ == "__main__":
+    unittest.main()